@@ -0,0 +1,117 @@
+'''Fixtures for the benchmarks in this folder. Run with `pytest benchmarks/ --user ... 
+--password ... --host ... --database ...` against a scratch database, the fixture 
+tables are dropped and recreated. Benchmarks that take a csv_rows argument run once 
+for each of the --bench_sizes, on synthetic CSVs from synthetic.py.'''
+import pytest
+
+from moto.s3 import mock_s3
+import boto3
+
+from databridge_etl_tools.postgres.postgres import Postgres_Connector
+import synthetic  # benchmarks/ has no __init__.py, so pytest puts it on sys.path
+
+BENCH_S3_BUCKET = 'citygeo-airflow-databridge2-benchmarks'
+
+def pytest_addoption(parser):
+    parser.addoption("--user", action="store", default='GIS_TEST', help="db user name")
+    parser.addoption("--host", action="store", default='some-host.gov', help="db host")
+    parser.addoption("--password", action="store", default='password', help="db user password")
+    parser.addoption("--database", action="store", default='adatabase',  help="db database name")
+    parser.addoption("--bench_schema", action="store", default='citygeo',  help="schema to create fixture tables in")
+    parser.addoption("--bench_rows", action="store", default=1_000_000, type=int, help="rows in the fixture tables")
+    parser.addoption("--bench_sizes", action="store", default='10000,1000000', 
+                     help="comma separated row counts of the synthetic CSVs, e.g. 10000,1000000,10000000")
+    parser.addoption("--startup_seconds", action="store", default=1.0, type=float, 
+                     help="slowest acceptable mean time of `databridge_etl_tools postgres --help`")
+
+def pytest_generate_tests(metafunc):
+    if 'csv_rows' in metafunc.fixturenames:
+        sizes = [int(size) for size in metafunc.config.getoption("bench_sizes").split(',')]
+        metafunc.parametrize('csv_rows', sizes, ids=[f'{size:,}_rows' for size in sizes], scope='session')
+
+@pytest.fixture(scope='session')
+def bench_schema(pytestconfig):
+    return pytestconfig.getoption("bench_schema")
+@pytest.fixture(scope='session')
+def bench_rows(pytestconfig):
+    return pytestconfig.getoption("bench_rows")
+
+@pytest.fixture(scope='session')
+def synthetic_csv(tmp_path_factory):
+    '''Return a function that writes a synthetic CSV (see synthetic.write_csv) the 
+    first time it is asked for and returns its path'''
+    directory = tmp_path_factory.mktemp('synthetic')
+    paths = {}
+    def make(geom_type:str, rows:int, null_byte_every:int=None) -> str:
+        key = (geom_type, rows, null_byte_every)
+        if key not in paths:
+            name = f'{geom_type}_{rows}' + (f'_null{null_byte_every}' if null_byte_every else '') + '.csv'
+            paths[key] = synthetic.write_csv(str(directory / name), geom_type, rows, null_byte_every)
+        return paths[key]
+    return make
+
+@pytest.fixture(scope='session')
+def connector(pytestconfig):
+    '''Yield a Postgres Connector object'''
+    user, password, host, database = (pytestconfig.getoption(x) for x in ('user', 'password', 'host', 'database'))
+    with Postgres_Connector(connection_string=f'postgresql://{user}:{password}@{host}:5432/{database}') as connector_obj: 
+        yield connector_obj
+
+@pytest.fixture(scope='session')
+def s3_bucket():
+    '''Mock S3 so that benchmarks never upload anywhere'''
+    with mock_s3():
+        s3_client = boto3.client('s3', region_name='us-east-1')
+        s3_client.create_bucket(Bucket=BENCH_S3_BUCKET)
+        yield BENCH_S3_BUCKET
+
+@pytest.fixture(scope='session')
+def bench_point_table(connector, bench_schema, bench_rows):
+    '''Create a point table with bench_rows rows, return its name'''
+    table_name = 'bench_dbtools_point_2272'
+    with connector.conn.cursor() as cursor:
+        cursor.execute(f'''
+    DROP TABLE IF EXISTS {bench_schema}.{table_name};
+    CREATE TABLE {bench_schema}.{table_name} (
+        objectid int4 NOT NULL,
+        textfield varchar(255) NULL,
+        datefield timestamp NULL,
+        numericfield numeric(38, 8) NULL,
+        shape public.geometry(Point, 2272) NULL,
+        CONSTRAINT {table_name}_pk PRIMARY KEY (objectid)
+    );
+    INSERT INTO {bench_schema}.{table_name}
+    SELECT g, 
+        md5(g::text), 
+        timestamp '2020-01-01' + g * interval '1 minute', 
+        g / 7.0, 
+        ST_SetSRID(ST_MakePoint(2660000 + (g % 1000) * 50.5, 220000 + (g / 1000) * 50.5), 2272)
+    FROM generate_series(1, %s) AS g;
+    ANALYZE {bench_schema}.{table_name};
+        ''', [bench_rows])
+    connector.conn.commit()
+    print(f'Created table {bench_schema}.{table_name} with {bench_rows:,} rows\n')
+    return table_name
+
+@pytest.fixture(scope='session')
+def bench_geom_table(connector, bench_schema):
+    '''Return a function that creates an empty table with the columns of the 
+    synthetic CSVs and a MULTI geometry column of the given type, returning its name'''
+    pg_types = {'point': 'Point', 'line': 'MultiLineString', 'polygon': 'MultiPolygon'}
+    def make(geom_type:str) -> str:
+        table_name = f'bench_dbtools_{geom_type}_synthetic_2272'
+        with connector.conn.cursor() as cursor:
+            cursor.execute(f'''
+    DROP TABLE IF EXISTS {bench_schema}.{table_name};
+    CREATE TABLE {bench_schema}.{table_name} (
+        objectid int4 NOT NULL,
+        textfield varchar(255) NULL,
+        datefield timestamp NULL,
+        numericfield numeric(38, 8) NULL,
+        shape public.geometry({pg_types[geom_type]}, 2272) NULL,
+        CONSTRAINT {table_name}_pk PRIMARY KEY (objectid)
+    );
+            ''')
+        connector.conn.commit()
+        return table_name
+    return make
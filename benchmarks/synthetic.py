@@ -0,0 +1,40 @@
+'''Generators for synthetic staging CSVs of points, lines or polygons, laid out
+on a grid in PA state plane (EPSG:2272) so that projections do real work. Each
+row has the same columns as the benchmark fixture tables.'''
+import csv
+
+GEOM_TYPES = ('point', 'line', 'polygon')
+SRID = 2272
+HEADER = ['objectid', 'textfield', 'datefield', 'numericfield', 'shape']
+
+
+def ewkt(geom_type:str, i:int, srid:int=SRID) -> str:
+    '''Return the i-th geometry of geom_type as EWKT. Every other line or polygon
+    is already MULTI, as a mixed source dataset would be.'''
+    x, y = 2660000 + (i % 1000) * 50, 220000 + (i // 1000) * 50
+    if geom_type == 'point':
+        return f'SRID={srid};POINT ({x} {y})'
+    if geom_type == 'line':
+        path = f'{x} {y}, {x + 20} {y + 15}, {x + 40} {y}'
+        return f'SRID={srid};LINESTRING ({path})' if i % 2 else f'SRID={srid};MULTILINESTRING (({path}))'
+    if geom_type == 'polygon':
+        ring = f'{x} {y}, {x + 40} {y}, {x + 40} {y + 40}, {x} {y + 40}, {x} {y}'
+        return f'SRID={srid};POLYGON (({ring}))' if i % 2 else f'SRID={srid};MULTIPOLYGON ((({ring})))'
+    raise ValueError(f'Geometry type {geom_type} not recognized, expected one of {", ".join(GEOM_TYPES)}')
+
+def rows(geom_type:str, count:int, null_byte_every:int=None):
+    '''Yield count data rows. If null_byte_every, every that many rows has a null
+    byte in its text field.'''
+    for i in range(count):
+        text = f'row {i}'
+        if null_byte_every and i % null_byte_every == 0:
+            text += '\0'
+        yield [i, text, f'2020-01-01 {i % 24:02d}:{i % 60:02d}:00', round(i / 7, 8),
+               ewkt(geom_type, i) if i % 100 else '']
+
+def write_csv(path:str, geom_type:str, count:int, null_byte_every:int=None) -> str:
+    with open(path, 'w', newline='') as f:
+        writer = csv.writer(f)
+        writer.writerow(HEADER)
+        writer.writerows(rows(geom_type, count, null_byte_every))
+    return path
@@ -0,0 +1,82 @@
+'''Time the per-row work of AGO appends and upserts, AGO.format_row() followed by
+AGO.convert_geometry(), on synthetic CSVs: with each shape projected on its own
+through project_and_format_shape(), and a batch_size of shapes at a time
+through iter_projected(), as append(), upsert() and sync() do. The AGO item is
+stood in for by setting the properties that would otherwise be read from it, so
+nothing connects to AGO.'''
+import json
+import pytest
+import petl as etl
+from databridge_etl_tools.ago.ago import AGO
+
+ESRI_GEOMETRY_TYPES = {'point': 'esriGeometryPoint', 'line': 'esriGeometryPolyline',
+                       'polygon': 'esriGeometryPolygon'}
+
+
+def local_ago(geom_type:str, in_srid:int=2272, **kwargs) -> 'AGO':
+    ago = AGO(ago_org_url='https://localhost', ago_user='bench', ago_pw='bench',
+              ago_item_name=f'bench_{geom_type}', s3_bucket=None, s3_key=None, in_srid=in_srid, **kwargs)
+    # Web Mercator, like most AGO items, so every shape is projected
+    ago._ago_srid = (102100, 3857)
+    ago._geometric = ESRI_GEOMETRY_TYPES[geom_type]
+    ago._item_fields = {'objectid': 'esrifieldtypeinteger', 'textfield': 'esrifieldtypestring',
+                        'datefield': 'esrifieldtypedate', 'numericfield': 'esrifieldtypedouble',
+                        'shape': ESRI_GEOMETRY_TYPES[geom_type]}
+    return ago
+
+def format_rows(ago:'AGO', rows) -> int:
+    count = 0
+    for row in rows:
+        row = ago.format_row(dict(row))
+        wkt = row.pop('shape')
+        if wkt:
+            ago.convert_geometry(wkt)
+        count += 1
+    return count
+
+@pytest.mark.parametrize('geom_type', ['point', 'line', 'polygon'])
+def test_ago_format_and_project(benchmark, synthetic_csv, geom_type, csv_rows):
+    benchmark.group = f'ago format_row + project_and_format_shape {geom_type}'
+    # Rows are read from the file as they're formatted, as in AGO.append(), so that 
+    # the larger sizes don't have to fit in memory
+    rows = etl.fromcsv(synthetic_csv(geom_type, csv_rows)).dicts()
+    ago = local_ago(geom_type)
+    result = benchmark.pedantic(format_rows, args=(ago, rows), rounds=3, iterations=1)
+    assert result == csv_rows
+    benchmark.extra_info['rows_per_second'] = round(csv_rows / benchmark.stats.stats.mean)
+
+def format_rows_batched(ago:'AGO', rows) -> int:
+    count = 0
+    for row, projected in ago.iter_projected(rows):
+        row = ago.format_row(dict(row))
+        wkt = row.pop('shape')
+        if wkt:
+            ago.convert_geometry(wkt, projected)
+        count += 1
+    return count
+
+@pytest.mark.parametrize('geom_type', ['point', 'line', 'polygon'])
+def test_ago_format_and_project_batched(benchmark, synthetic_csv, geom_type, csv_rows):
+    benchmark.group = f'ago format_row + project_and_format_shapes {geom_type}'
+    rows = etl.fromcsv(synthetic_csv(geom_type, csv_rows)).dicts()
+    ago = local_ago(geom_type)
+    result = benchmark.pedantic(format_rows_batched, args=(ago, rows), rounds=3, iterations=1)
+    assert result == csv_rows
+    benchmark.extra_info['rows_per_second'] = round(csv_rows / benchmark.stats.stats.mean)
+
+def serialize_features(ago:'AGO', rows) -> int:
+    features = []
+    for row, projected in ago.iter_projected(rows):
+        features.append(ago.format_feature(dict(row), projected))
+    # As edit_features() sends them
+    return len(json.dumps(features, default=str))
+
+@pytest.mark.parametrize('coordinate_precision', [None, 4])
+@pytest.mark.parametrize('geom_type', ['line', 'polygon'])
+def test_ago_serialize_features(benchmark, synthetic_csv, geom_type, coordinate_precision, csv_rows):
+    benchmark.group = f'ago format_feature + json.dumps {geom_type}'
+    rows = etl.fromcsv(synthetic_csv(geom_type, csv_rows)).dicts()
+    ago = local_ago(geom_type, coordinate_precision=coordinate_precision)
+    payload_bytes = benchmark.pedantic(serialize_features, args=(ago, rows), rounds=3, iterations=1)
+    benchmark.extra_info['payload_bytes'] = payload_bytes
+    benchmark.extra_info['rows_per_second'] = round(csv_rows / benchmark.stats.stats.mean)
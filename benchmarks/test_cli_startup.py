@@ -0,0 +1,31 @@
+'''Time the CLI from process start to printing `postgres --help`, which is the
+start-up cost paid by every command. Command groups are only imported when
+they're used and heavy libraries only when they're needed, so this fails if the
+mean goes over --startup_seconds or if one of HEAVY_MODULES is imported.'''
+import sys
+import subprocess
+
+# Imported by the other command groups or only by some methods, never at start-up
+HEAVY_MODULES = ['arcgis', 'pandas', 'numpy', 'shapely', 'pyproj', 'cx_Oracle', 'carto', 
+                 'geopetl', 'boto3', 'botocore']
+
+def run_cli(*args):
+    subprocess.run([sys.executable, '-m', 'databridge_etl_tools', *args], check=True, 
+                   stdout=subprocess.DEVNULL)
+
+def test_postgres_help_startup(benchmark, pytestconfig):
+    benchmark.group = 'cli startup'
+    benchmark.pedantic(run_cli, args=('postgres', '--help'), rounds=5, iterations=1, warmup_rounds=1)
+    target = pytestconfig.getoption('startup_seconds')
+    assert benchmark.stats.stats.mean < target, \
+        f'postgres --help took {benchmark.stats.stats.mean:.2f}s on average, the target is {target:.2f}s'
+
+def test_postgres_help_imports():
+    script = ('import sys\n'
+              'from click.testing import CliRunner\n'
+              'from databridge_etl_tools.cli import main\n'
+              'assert CliRunner().invoke(main, ["postgres", "--help"]).exit_code == 0\n'
+              'print("\\n".join(sys.modules))')
+    output = subprocess.run([sys.executable, '-c', script], check=True, capture_output=True, text=True).stdout
+    imported = {name.split('.')[0] for name in output.splitlines()}
+    assert not imported.intersection(HEAVY_MODULES)
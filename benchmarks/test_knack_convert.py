@@ -0,0 +1,41 @@
+'''Time Knack.convert_to_csv_row() on synthetic Knack records covering each of the
+field types it converts. No requests are made to Knack.'''
+from databridge_etl_tools.knack.knack import Knack
+
+KNACK_FIELDS = [
+    {'key': 'field_1', 'label': 'Name', 'type': 'short_text', 'required': True},
+    {'key': 'field_2', 'label': 'Amount', 'type': 'number', 'required': False},
+    {'key': 'field_3', 'label': 'Inspected At', 'type': 'date_time', 'required': False},
+    {'key': 'field_4', 'label': 'Phone', 'type': 'phone', 'required': False},
+    {'key': 'field_5', 'label': 'Categories', 'type': 'multiple_choice', 'required': False},
+    {'key': 'field_6', 'label': 'Address', 'type': 'address', 'required': False},
+    {'key': 'field_7', 'label': 'Inspector ID', 'type': 'connection', 'required': False},
+    {'key': 'field_8', 'label': 'Active', 'type': 'boolean', 'required': False},
+]
+
+def knack_records(count:int):
+    for i in range(count):
+        yield {
+            'id': f'{i:024x}',
+            'field_1_raw': f'Record {i}',
+            'field_2_raw': i / 4,
+            'field_3_raw': {'timestamp': f'01/{i % 28 + 1:02d}/2023 {i % 12 + 1:02d}:{i % 60:02d} pm'},
+            'field_4_raw': {'full': f'215555{i % 10000:04d}'},
+            'field_5_raw': ['Residential', 'Commercial'] if i % 2 else 'Residential',
+            'field_6_raw': {'street': f'{i} Market St', 'city': 'Philadelphia', 'state': 'PA'},
+            'field_7_raw': [{'id': f'{i % 50:024x}', 'identifier': f'Inspector {i % 50}'}],
+            'field_8_raw': bool(i % 2),
+        }
+
+def test_knack_convert_to_csv_row(benchmark, csv_rows):
+    benchmark.group = 'knack convert_to_csv_row'
+    knack = Knack(knack_objectid='object_1', app_id='bench', api_key='bench',
+                  s3_bucket=None, s3_key=None)
+    schema = knack.convert_knack_schema(KNACK_FIELDS)
+    # Records are held in memory so that generating them isn't timed, hence the cap
+    records = list(knack_records(min(csv_rows, 100_000)))
+    def convert():
+        for record in records:
+            knack.convert_to_csv_row(schema, record)
+    benchmark.pedantic(convert, rounds=3, iterations=1)
+    benchmark.extra_info['rows_per_second'] = round(len(records) / benchmark.stats.stats.mean)
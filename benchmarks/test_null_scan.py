@@ -0,0 +1,24 @@
+'''Time the whole-file null byte scan and removal in utils on synthetic CSVs, one
+with no null bytes (the common case, where only the scan runs) and one with a
+null byte in every thousandth row. No database or S3 is involved.'''
+import shutil
+import pytest
+from databridge_etl_tools import utils
+
+@pytest.mark.parametrize('null_byte_every', [None, 1000], ids=['clean', 'null_bytes'])
+def test_file_contains_null_bytes(benchmark, synthetic_csv, csv_rows, null_byte_every):
+    benchmark.group = 'null byte scan'
+    path = synthetic_csv('polygon', csv_rows, null_byte_every)
+    result = benchmark.pedantic(utils.file_contains, args=(path, [b'\0']), rounds=3, iterations=1)
+    assert result == bool(null_byte_every)
+    benchmark.extra_info['rows_per_second'] = round(csv_rows / benchmark.stats.stats.mean)
+
+def test_remove_null_bytes(benchmark, synthetic_csv, csv_rows, tmp_path):
+    benchmark.group = 'null byte removal'
+    source = synthetic_csv('polygon', csv_rows, 1000)
+    path = str(tmp_path / 'scrub.csv')
+    # Copy the file in setup so that every round has null bytes to remove
+    setup = lambda: shutil.copyfile(source, path)
+    benchmark.pedantic(utils.remove_bytes, args=(path, [b'\0']), setup=setup, rounds=3, iterations=1)
+    assert not utils.file_contains(path, [b'\0'])
+    benchmark.extra_info['rows_per_second'] = round(csv_rows / benchmark.stats.stats.mean)
@@ -0,0 +1,16 @@
+'''Time OpenData.project_points(), the point projection and lat/lng fields that
+transform_and_upload_data() applies before writing the open data CSV, on
+synthetic point CSVs. No database or S3 is involved.'''
+import petl as etl
+from databridge_etl_tools.opendata.opendata import OpenData
+
+
+def test_opendata_project_points(benchmark, synthetic_csv, csv_rows, tmp_path):
+    benchmark.group = 'opendata project_points'
+    opendata = OpenData(table_name='bench_point', table_schema='citygeo', s3_bucket=None, 
+                        s3_key='staging/citygeo/bench_point.csv', opendata_bucket=None)
+    path = synthetic_csv('point', csv_rows)
+    out = str(tmp_path / 'bench_point_final.csv')
+    benchmark.pedantic(lambda: opendata.project_points(etl.fromcsv(path), 2272, 4326).tocsv(out), 
+                       rounds=3, iterations=1)
+    benchmark.extra_info['rows_per_second'] = round(csv_rows / benchmark.stats.stats.mean)
@@ -0,0 +1,25 @@
+'''Compare the geopetl and COPY extract engines on the same fixture table'''
+import pytest
+from databridge_etl_tools.postgres.postgres import Postgres
+
+
+@pytest.fixture(scope='module')
+def pg(connector, bench_point_table, bench_schema, s3_bucket):
+    pg_obj = Postgres(connector=connector,
+                      table_name=bench_point_table,
+                      table_schema=bench_schema,
+                      s3_bucket=s3_bucket,
+                      s3_key=f'staging/{bench_schema}/{bench_point_table}.csv', 
+                      with_srid=True)
+    yield pg_obj
+    connector.conn.rollback()
+    pg_obj.cleanup()
+
+@pytest.mark.parametrize('engine', ['geopetl', 'copy'])
+def test_extract_engine(benchmark, pg, engine):
+    benchmark.group = 'postgres extract'
+    benchmark.pedantic(pg.extract, kwargs={'engine': engine}, rounds=3, iterations=1)
+
+def test_extract_parallel(benchmark, pg):
+    benchmark.group = 'postgres extract'
+    benchmark.pedantic(pg.extract, kwargs={'workers': 4}, rounds=3, iterations=1)
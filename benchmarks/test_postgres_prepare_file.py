@@ -0,0 +1,58 @@
+'''Compare the multi-geometry promotion in Postgres.prepare_file() before and after
+it became a single convert() pass, which only involves petl and local files, and
+time prepare_file() itself on synthetic CSVs against tables in the scratch
+database. Rows per second are reported in each result's extra_info.'''
+import csv
+import pytest
+import petl as etl
+from databridge_etl_tools.postgres.postgres import Postgres
+from databridge_etl_tools.postgres._stream import to_multi_geom
+
+
+def three_pass_multi(rows, geom_field):
+    '''The original addfield/convert/cutout implementation'''
+    rows = rows.addfield('row_geom_type', lambda a: a[f'{geom_field}'].split('(')[0].split(';')[1].strip() if a[f'{geom_field}'] and '(' in a[f'{geom_field}'] else None)
+    rows = rows.convert(geom_field, lambda u, row: u.replace(row.row_geom_type, 'MULTI' + row.row_geom_type + ' (' ) + ')' if 'MULTI' not in row.row_geom_type else u, pass_row=True)
+    return rows.cutout('row_geom_type')
+
+def single_pass_multi(rows, geom_field):
+    return rows.convert(geom_field, to_multi_geom)
+
+@pytest.fixture(scope='module')
+def polygon_csv(tmp_path_factory, bench_rows):
+    '''Write a CSV of bench_rows EWKT polygons, every other one already MULTI'''
+    path = tmp_path_factory.mktemp('prepare_file') / 'polygons.csv'
+    with open(path, 'w', newline='') as f:
+        writer = csv.writer(f)
+        writer.writerow(['objectid', 'textfield', 'shape'])
+        for i in range(bench_rows):
+            x, y = 2660000 + (i % 1000) * 50, 220000 + (i // 1000) * 50
+            ring = f'{x} {y}, {x + 40} {y}, {x + 40} {y + 40}, {x} {y + 40}, {x} {y}'
+            shape = f'SRID=2272;POLYGON (({ring}))' if i % 2 else f'SRID=2272;MULTIPOLYGON ((({ring})))'
+            writer.writerow([i, f'row {i}', shape])
+    return str(path)
+
+@pytest.mark.parametrize('transform', [three_pass_multi, single_pass_multi], ids=['three_pass', 'single_pass'])
+def test_prepare_file_multi_geom(benchmark, polygon_csv, bench_rows, tmp_path, transform):
+    benchmark.group = 'postgres prepare_file multi-geometry'
+    out = str(tmp_path / 'polygons_t.csv')
+    benchmark.pedantic(lambda: transform(etl.fromcsv(polygon_csv), 'shape').tocsv(out),
+                       rounds=3, iterations=1)
+    benchmark.extra_info['rows_per_second'] = round(bench_rows / benchmark.stats.stats.mean)
+
+def test_multi_geom_same_output(polygon_csv):
+    '''Both transforms should write identical files'''
+    rows = etl.fromcsv(polygon_csv).head(1000)
+    assert list(three_pass_multi(rows, 'shape')) == list(single_pass_multi(rows, 'shape'))
+
+@pytest.mark.parametrize('geom_type', ['point', 'line', 'polygon'])
+def test_prepare_file(benchmark, connector, bench_schema, bench_geom_table, synthetic_csv, 
+                      geom_type, csv_rows):
+    '''Postgres.prepare_file() on a synthetic CSV, with the geometry and header 
+    fixes it applies for a table in the scratch database'''
+    benchmark.group = f'postgres prepare_file {geom_type}'
+    path = synthetic_csv(geom_type, csv_rows)
+    pg = Postgres(connector=connector, table_name=bench_geom_table(geom_type), 
+                  table_schema=bench_schema)
+    benchmark.pedantic(pg.prepare_file, kwargs={'file': path}, rounds=3, iterations=1)
+    benchmark.extra_info['rows_per_second'] = round(csv_rows / benchmark.stats.stats.mean)
@@ -0,0 +1,17 @@
+'''Time S3 uploads and downloads of synthetic CSVs through s3_transfer, plain and
+compressed as they are uploaded, against moto's mock S3. Mocked S3 has no network
+cost, so this mostly measures hashing, compression and part handling.'''
+import pytest
+from databridge_etl_tools import s3_transfer
+
+@pytest.mark.parametrize('compression', [None, 'gzip'], ids=['plain', 'gzip'])
+def test_s3_upload_download(benchmark, s3_bucket, synthetic_csv, csv_rows, compression, tmp_path):
+    benchmark.group = 's3 upload + download'
+    path = synthetic_csv('point', csv_rows)
+    key = f'staging/bench/point_{csv_rows}.csv' + ('.gz' if compression else '')
+    out = str(tmp_path / 'download.csv')
+    def round_trip():
+        s3_transfer.upload_file(path, s3_bucket, key, compression=compression)
+        s3_transfer.download_file(s3_bucket, key, out)
+    benchmark.pedantic(round_trip, rounds=3, iterations=1)
+    benchmark.extra_info['rows_per_second'] = round(csv_rows / benchmark.stats.stats.mean)
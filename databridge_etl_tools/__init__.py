@@ -1,9 +1,37 @@
+import sys
+import types
+import importlib
 from .cli import main
-from .ago import ago
-from .carto import carto_ as carto
-from .oracle import oracle
-from .db2 import db2
-from .opendata import opendata
-from .postgres import postgres
-from .knack import knack
-from .airtable import airtable
+
+# Modules exported by the package, e.g. `from databridge_etl_tools import postgres`
+# gives databridge_etl_tools.postgres.postgres. They're imported on first use rather
+# than here, so that running one command doesn't import every other's dependencies.
+LAZY_MODULES = {
+    'ago':      '.ago.ago',
+    'carto':    '.carto.carto_',
+    'oracle':   '.oracle.oracle',
+    'db2':      '.db2.db2',
+    'opendata': '.opendata.opendata',
+    'postgres': '.postgres.postgres',
+    'knack':    '.knack.knack',
+    'airtable': '.airtable.airtable',
+}
+
+
+def __getattr__(name):
+    if name in LAZY_MODULES:
+        module = importlib.import_module(LAZY_MODULES[name], __name__)
+        globals()[name] = module
+        return module
+    raise AttributeError(f'module {__name__!r} has no attribute {name!r}')
+
+
+class _Package(types.ModuleType):
+    '''Importing a subpackage sets it as an attribute of this package, which would
+    hide the module exported under the same name, so that's skipped'''
+    def __setattr__(self, name, value):
+        if name in LAZY_MODULES and getattr(value, '__name__', None) == f'{__name__}.{name}':
+            return
+        super().__setattr__(name, value)
+
+sys.modules[__name__].__class__ = _Package
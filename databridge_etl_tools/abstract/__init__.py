@@ -4,7 +4,7 @@ import sys
 from abc import abstractmethod
 import json
 
-import boto3
+from .. import s3_transfer
 
 
 class Client():
@@ -172,15 +172,13 @@ class Client():
     def get_json_schema_from_s3(self):
         self.logger.info('Fetching json schema: s3://{}/{}'.format(self.s3_bucket, self.json_schema_s3_key))
 
-        s3 = boto3.resource('s3')
-        s3.Object(self.s3_bucket, self.json_schema_s3_key).download_file(self.json_schema_path)
+        s3_transfer.download_file(self.s3_bucket, self.json_schema_s3_key, self.json_schema_path)
 
         self.logger.info('Json schema successfully downloaded.\n'.format(self.s3_bucket, self.json_schema_s3_key))
 
     def get_csv_from_s3(self):
         self.logger.info('Fetching csv s3://{}/{}'.format(self.s3_bucket, self.csv_s3_key))
 
-        s3 = boto3.resource('s3')
-        s3.Object(self.s3_bucket, self.csv_s3_key).download_file(self.csv_path)
+        s3_transfer.download_file(self.s3_bucket, self.csv_s3_key, self.csv_path)
 
         self.logger.info('CSV successfully downloaded.\n'.format(self.s3_bucket, self.csv_s3_key))
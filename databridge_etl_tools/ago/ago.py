@@ -4,24 +4,65 @@ import logging
 import zipfile
 import click
 import petl as etl
-import boto3
-import botocore
-import pyproj
-import shapely.wkt
-import numpy as np
 import csv
 from pprint import pprint
-import pandas as pd
 from copy import deepcopy
-#from threading import Thread
-from shapely.ops import transform as shapely_transformer
-from arcgis import GIS
-from arcgis.features import FeatureLayerCollection
+import threading
 from time import sleep, time
 import dateutil.parser
 import requests
 import json
-from datetime import datetime
+import hashlib
+from datetime import datetime, timezone
+from collections import Counter
+from .. import s3_transfer, parquet, metrics
+from .batches import Batch_Pipeline
+from .geometry import Geometry_Encoder, resolution_decimals, default_decimals
+
+
+def _shape_parts(wkt_shapes):
+    '''
+    Parse WKT shapes one at a time and return `(coordinates, part sizes, parts
+    per shape, validity per shape)`: the x and y of every point, polygon
+    exterior ring and path, in order, as one (n, 2) array, the number of
+    coordinates in each of those parts, and how many parts each shape has.
+    Validity is only checked for polygons and multilinestrings.
+    '''
+    import numpy as np
+    import shapely.wkt
+    parts, shape_parts, valid = [], [], []
+    for wkt_shape in wkt_shapes:
+        geom = shapely.wkt.loads(wkt_shape)
+        if 'POINT' in wkt_shape or ('LINESTRING' in wkt_shape and 'MULTI' not in wkt_shape):
+            geom_parts = [geom]
+        elif 'MULTIPOLYGON' in wkt_shape:
+            geom_parts = [poly.exterior for poly in geom.geoms]
+        elif 'POLYGON' in wkt_shape:
+            geom_parts = [geom.exterior]
+        else:
+            geom_parts = list(geom.geoms)
+        parts.extend(np.asarray(part.coords)[:, :2] for part in geom_parts)
+        shape_parts.append(len(geom_parts))
+        valid.append(geom.is_valid if 'POLYGON' in wkt_shape or 'MULTILINESTRING' in wkt_shape else True)
+    return np.concatenate(parts), [len(part) for part in parts], shape_parts, valid
+
+def _shape_parts_vectorized(wkt_shapes):
+    '''_shape_parts() with shapely 2's array functions'''
+    import numpy as np
+    import shapely
+    geoms = shapely.from_wkt(wkt_shapes)
+    type_ids = shapely.get_type_id(geoms)
+    parts, shape_index = shapely.get_parts(geoms, return_index=True)
+    # Polygons contribute their exterior rings, points and lines themselves
+    polygonal = np.isin(type_ids[shape_index], (3, 6))
+    parts = np.where(polygonal, shapely.get_exterior_ring(parts), parts)
+    part_sizes = shapely.get_num_coordinates(parts)
+    coords = shapely.get_coordinates(parts)
+    shape_parts = np.bincount(shape_index, minlength=len(geoms)).tolist()
+    # POLYGON, MULTILINESTRING and MULTIPOLYGON
+    checked = np.isin(type_ids, (3, 5, 6))
+    valid = np.where(checked, shapely.is_valid(geoms), True).tolist()
+    return coords, part_sizes, shape_parts, valid
 
 
 class AGO():
@@ -35,6 +76,8 @@ class AGO():
     _projection = None
     _geometric = None
     _transformer = None
+    _geometry_encoder = None
+    _geometry_decimals = None
     _primary_key = None
     _json_schema_s3_key = None
 
@@ -68,6 +111,12 @@ class AGO():
         self.export_format = kwargs.get('export_format', None)
         self.export_zipped = kwargs.get('export_zipped', False)
         self.batch_size = kwargs.get('batch_size', 500)
+        # How many batches edit_features() may be sending at once, see Batch_Pipeline
+        self.concurrent_batches = kwargs.get('concurrent_batches', 1)
+        # Decimal places to round coordinates to, or 'auto' for the layer's xy resolution,
+        # and the tolerance to generalize shapes to, see Geometry_Encoder
+        self.coordinate_precision = kwargs.get('coordinate_precision', None)
+        self.generalize_tolerance = kwargs.get('generalize_tolerance', None)
         self.export_dir_path = kwargs.get('export_dir_path', os.getcwd() + '\\' + self.item_name.replace(' ', '_'))
         # Try to use /tmp dir, it should exist. Else, use our current user's home dir
         if not os.path.isdir('/tmp'):
@@ -79,6 +128,13 @@ class AGO():
         self.upserting = None
         if self.clean_columns == 'False':
             self.clean_columns = None
+        # Batches may fail from several threads at once, write their error files one at a time
+        self._errors_lock = threading.Lock()
+        self._error_files = 0
+        # Rows written to error files, by batch, so that a batch written more than once counts once
+        self._error_batches = {}
+        # Appends that timed out with other batches in flight, so couldn't be checked by count
+        self._unchecked_batches = 0
 
     @property
     def logger(self):
@@ -95,6 +151,8 @@ class AGO():
     def org(self):
         if self._org is None:
             self.logger.info(f'Making connection to AGO account at {self.ago_org_url} with user {self.ago_user} ...')
+            # arcgis takes seconds to import, so only import it once we connect
+            from arcgis import GIS
             try:
                 if self.proxy_host is None:
                     self._org = GIS(self.ago_org_url,
@@ -147,7 +205,7 @@ class AGO():
     @property
     def json_schema_s3_key(self):
         if self._json_schema_s3_key is None:
-            self._json_schema_s3_key = self.s3_key.replace('staging', 'schemas').replace('.csv', '.json')
+            self._json_schema_s3_key = s3_transfer.strip_compression_suffix(self.s3_key).replace('staging', 'schemas').replace('.csv', '.json').replace('.parquet', '.json')
         return self._json_schema_s3_key
 
 
@@ -263,7 +321,14 @@ class AGO():
         if self.geometric:
             raise NotImplementedError('Overwrite with CSVs only works for non-spatial datasets (maybe?)')
         #self.logger.info(vars(self.item))
+        from arcgis.features import FeatureLayerCollection
         flayer_collection = FeatureLayerCollection.fromitem(self.item)
+        # AGO needs the plain CSV under its original file name
+        if parquet.is_parquet_file(self.csv_path):
+            parquet.Parquet_View(self.csv_path).tocsv(self.csv_path + '.tmp')
+            os.replace(self.csv_path + '.tmp', self.csv_path)
+        else:
+            s3_transfer.decompress_file(self.csv_path)
         # call the overwrite() method which can be accessed using the manager property
         flayer_collection.manager.overwrite(self.csv_path)
 
@@ -302,9 +367,10 @@ class AGO():
     def get_csv_from_s3(self):
         self.logger.info('Fetching csv s3://{}/{}'.format(self.s3_bucket, self.s3_key))
 
-        s3 = boto3.resource('s3')
+        import botocore.exceptions
+
         try:
-            s3.Object(self.s3_bucket, self.s3_key).download_file(self.csv_path)
+            s3_transfer.download_file(self.s3_bucket, self.s3_key, self.csv_path)
         except botocore.exceptions.ClientError as e:
             if e.response['Error']['Code'] == "404":
                 raise AssertionError(f'CSV file doesnt appear to exist in S3 bucket! key: {self.s3_key}')
@@ -316,11 +382,36 @@ class AGO():
         self.logger.info('CSV successfully downloaded.\n'.format(self.s3_bucket, self.s3_key))
 
 
-    def write_errors_to_s3(self, rows):
+    def read_rows(self):
+        '''Return a petl table of the downloaded staging file: a CSV, possibly 
+        compressed, or a Parquet file read in record batches with its geometries 
+        given as EWKT, the same as a CSV extract'''
+        if parquet.is_parquet_file(self.csv_path):
+            return parquet.Parquet_View(self.csv_path)
+        source = s3_transfer.read_source(self.csv_path)
+        try:
+            rows = etl.fromcsv(source, encoding='utf-8')
+        except UnicodeError:
+            self.logger.info("Exception encountered trying to import rows wtih utf-8 encoding, trying latin-1...")
+            rows = etl.fromcsv(source, encoding='latin-1')
+        return rows
+
+
+    def write_errors_to_s3(self, rows, batch=None):
+        '''Write a batch's rows to an error file in S3. batch identifies the batch, as
+        (method, row_count) from edit_features(), for check_unchecked_batches().'''
+        with self._errors_lock:
+            if batch is not None and isinstance(rows, list):
+                self._error_batches[batch] = len(rows)
+            self._write_errors_to_s3(rows)
+
+    def _write_errors_to_s3(self, rows):
+        # Numbered too, so that batches failing in the same second don't overwrite each other's file
+        self._error_files += 1
         try:
             ts = int(time())
-            file_timestamp_name = f'-{ts}-errors.txt'
-            error_s3_key = self.s3_key.replace('.csv', file_timestamp_name)
+            file_timestamp_name = f'-{ts}-{self._error_files}-errors.txt'
+            error_s3_key = s3_transfer.strip_compression_suffix(self.s3_key).replace('.csv', file_timestamp_name)
             self.logger.info(f'Writing bad rows to file in s3 {error_s3_key}...')
             if not os.path.isdir('/tmp'):
                 homedir = os.path.expanduser('~')
@@ -334,8 +425,7 @@ class AGO():
                 #writer = csv.writer(csv_file)
                 #writer.writerows(rows)
 
-            s3 = boto3.resource('s3')
-            s3.Object(self.s3_bucket, error_s3_key).put(Body=open(error_filepath, 'rb'))
+            s3_transfer.upload_file(error_filepath, self.s3_bucket, error_s3_key)
         except KeyboardInterrupt as e:
             raise e
         except Exception as e:
@@ -348,14 +438,64 @@ class AGO():
     def transformer(self):
         '''transformer needs to be defined outside of our row loop to speed up projections.'''
         if self._transformer is None:
+            import pyproj
             self._transformer = pyproj.Transformer.from_crs(f'epsg:{self.in_srid}',
                                                       f'epsg:{self.ago_srid[1]}',
                                                       always_xy=True)
         return self._transformer
 
 
+    @property
+    def xy_tolerance(self):
+        '''The xy tolerance of the AGO item's spatial reference, or None if it doesn't report one'''
+        return self.layer_object.container.properties.initialExtent.spatialReference.get('xyTolerance')
+
+
+    @property
+    def geometry_decimals(self):
+        '''Decimal places that sync() compares coordinates to: the rounding we send them
+        with, else the item's xy resolution, else the default resolution for its units'''
+        if self._geometry_decimals is None:
+            if self.geometry_encoder.precision is not None:
+                self._geometry_decimals = self.geometry_encoder.precision
+            elif self.xy_tolerance:
+                self._geometry_decimals = resolution_decimals(self.xy_tolerance)
+            else:
+                self._geometry_decimals = default_decimals(self.ago_srid[1])
+        return self._geometry_decimals
+
+
+    @property
+    def geometry_encoder(self):
+        '''Encodes our projected shapes as AGO geometries, see Geometry_Encoder'''
+        if self._geometry_encoder is None:
+            precision = self.coordinate_precision
+            if precision == 'auto':
+                xy_tolerance = self.xy_tolerance
+                if xy_tolerance:
+                    precision = resolution_decimals(xy_tolerance)
+                    self.logger.info(f'Rounding coordinates to {precision} decimal places, from the xy tolerance of {xy_tolerance}\n')
+                else:
+                    self.logger.info('AGO item does not report an xy tolerance, not rounding coordinates.\n')
+                    precision = None
+            elif precision is not None:
+                precision = int(precision)
+            self._geometry_encoder = Geometry_Encoder(self.geometric, self.ago_srid[0], self.ago_srid[1],
+                                                      precision=precision, generalize=self.generalize_tolerance)
+        return self._geometry_encoder
+
+
     def project_and_format_shape(self, wkt_shape):
         ''' Helper function to help format spatial fields properly for AGO '''
+        # Called once per row, so only the totals are logged, see metrics.flush()
+        with metrics.span('project', rows=1, log=False):
+            return self._format_shape(wkt_shape)
+
+
+    def _format_shape(self, wkt_shape):
+        ''' Project (if needed) and format a WKT shape's coordinates for AGO '''
+        import shapely.wkt
+        from shapely.ops import transform as shapely_transformer
         # Note: list of coordinates for polygons are called "rings" for some reason
         def format_ring(poly):
             if self.projection:
@@ -427,8 +567,94 @@ class AGO():
             raise NotImplementedError('Shape unrecognized.')
 
 
+    def project_and_format_shapes(self, wkt_shapes):
+        '''
+        Batch version of project_and_format_shape(): return the same output for
+        each of a list of WKT shapes (without "SRID="). Every point, exterior
+        ring and path of the batch is gathered into one numpy array of
+        coordinates, projected with a single transformer call and split back by
+        offsets, instead of projecting ring by ring. See iter_projected().
+        '''
+        with metrics.span('project', rows=len(wkt_shapes), log=False):
+            return self._format_shapes(wkt_shapes)
+
+
+    def _format_shapes(self, wkt_shapes):
+        import numpy as np
+        import shapely
+        for wkt_shape in wkt_shapes:
+            if 'MULTIPOINT' in wkt_shape:
+                raise NotImplementedError("MULTIPOINTs not implemented yet..")
+            if not any(t in wkt_shape for t in ('POINT', 'POLYGON', 'LINESTRING')):
+                raise NotImplementedError('Shape unrecognized.')
+        if not wkt_shapes:
+            return []
+        # shapely 2 parses and takes coordinates apart a whole array at a time
+        if hasattr(shapely, 'from_wkt'):
+            coords, part_sizes, shape_parts, valid = _shape_parts_vectorized(wkt_shapes)
+        else:
+            coords, part_sizes, shape_parts, valid = _shape_parts(wkt_shapes)
+        for wkt_shape, is_valid in zip(wkt_shapes, valid):
+            if not is_valid:
+                self.logger.info('Warning, shapely found this WKT to be invalid! Might want to fix this!')
+                self.logger.info(wkt_shape)
+        if self.projection:
+            xs, ys = self.transformer.transform(coords[:, 0], coords[:, 1])
+            coords = np.column_stack([xs, ys])
+        parts = self.geometry_encoder.compact_parts(coords, part_sizes)
+        formatted = []
+        start = 0
+        for wkt_shape, count in zip(wkt_shapes, shape_parts):
+            shape = parts[start:start + count]
+            start += count
+            if 'POINT' in wkt_shape:
+                formatted.append(tuple(shape[0][0]))
+            elif 'MULTIPOLYGON' in wkt_shape or 'MULTILINESTRING' in wkt_shape:
+                formatted.append(shape)
+            else:
+                formatted.append(shape[0])
+        return formatted
+
+
+    def iter_projected(self, row_dicts):
+        '''
+        Yield `(row, projected)` for each row, where projected is the row's shape
+        from project_and_format_shapes(), which is run on batch_size rows at a time.
+        projected is None for blank or EMPTY shapes, and for shapes without an
+        SRID when no in_srid was given, which the caller rejects.
+        '''
+        batch = []
+        for row in row_dicts:
+            batch.append(row)
+            if len(batch) == self.batch_size:
+                yield from self._project_batch(batch)
+                batch = []
+        if batch:
+            yield from self._project_batch(batch)
+
+
+    def _project_batch(self, rows):
+        wkts = {}
+        for i, row in enumerate(rows):
+            wkt = (row.get('shape') or '').strip()
+            if not wkt or 'EMPTY' in wkt:
+                continue
+            if 'SRID=' in wkt:
+                if not self.in_srid:
+                    self.logger.info('Getting SRID from csv...')
+                    self.in_srid = wkt.split(';')[0].strip("SRID=")
+                wkt = wkt.split(';')[1]
+            elif not self.in_srid:
+                continue
+            wkts[i] = wkt
+        projected = dict(zip(wkts, self.project_and_format_shapes(list(wkts.values()))))
+        for i, row in enumerate(rows):
+            yield row, projected.get(i)
+
+
     def return_coords_only(self,wkt_shape):
         ''' Do not perform project, simply extract and return our coords lists.'''
+        import shapely.wkt
         poly = shapely.wkt.loads(wkt_shape)
         return poly.exterior.xy[0], poly.exterior.xy[1]
 
@@ -478,11 +704,7 @@ class AGO():
         '''
         Appends rows from our CSV into a matching item in AGO
         '''
-        try:
-            rows = etl.fromcsv(self.csv_path, encoding='utf-8')
-        except UnicodeError:
-            self.logger.info("Exception encountered trying to import rows wtih utf-8 encoding, trying latin-1...")
-            rows = etl.fromcsv(self.csv_path, encoding='latin-1')
+        rows = self.read_rows()
         # Compare headers in the csv file vs the fields in the ago item.
         # If the names don't match and we were to upload to AGO anyway, AGO will not actually do 
         # anything with our rows but won't tell us anything is wrong!
@@ -555,162 +777,111 @@ class AGO():
         if truncate is True:
             self.truncate()
 
-        # loop through and accumulate appends into adds[]
-        adds = []
-        if not self.geometric:
-            for i, row in enumerate(row_dicts):
-                # clean up row and perform basic non-geometric transformations
-                row = self.format_row(row)
+        if self.concurrent_batches > 1:
+            start_count = self.layer_object.query(return_count_only=True)
+        # Format and project rows into batches here while up to concurrent_batches 
+        # earlier batches are sent to AGO
+        with Batch_Pipeline(self.edit_features, self.concurrent_batches) as batches:
+            # loop through and accumulate appends into adds[]
+            adds = []
+            if not self.geometric:
+                for i, row in enumerate(row_dicts):
+                    # clean up row and perform basic non-geometric transformations
+                    row = self.format_row(row)
 
-                adds.append({"attributes": row})
-                if (len(adds) != 0) and (len(adds) % self.batch_size == 0):
-                    start = time()
+                    adds.append({"attributes": row})
+                    if (len(adds) != 0) and (len(adds) % self.batch_size == 0):
+                        row_count = i+1
+                        self.logger.info(f'Adding batch of {len(adds)}, at row #: {row_count}...')
+                        batches.submit(rows=adds, row_count=row_count, method='adds')
+                        adds = []
+                if adds:
                     row_count = i+1
-                    self.logger.info(f'Adding batch of {len(adds)}, at row #: {row_count}...')
-                    self.edit_features(rows=adds, row_count=row_count, method='adds')
-                    adds = []
-                    self.logger.info(f'Duration: {time() - start}\n')
-            if adds:
-                start = time()
-                row_count = i+1
-                self.logger.info(f'Adding last batch of {len(adds)}, at row #: {row_count}...')
-                self.edit_features(rows=adds, row_count=row_count, method='adds')
-                self.logger.info(f'Duration: {time() - start}\n')
-        elif self.geometric:
-            for i, row in enumerate(row_dicts):
-                row_count = i + 1
-                # clean up row and perform basic non-geometric transformations
-                row = self.format_row(row)
-
-                # remove the shape field so we can replace it with SHAPE with the spatial reference key
-                # and also store in 'wkt' var (well known text) so we can project it
-                wkt = row.pop('shape')
-
-                # Set WKT to empty string so next conditional doesn't fail on a Nonetype
-                if wkt is None:
-                    wkt = ''
-
-                # if the wkt is not empty, and SRID isn't in it, fail out.
-                # empty geometries come in with some whitespace, so test truthiness
-                # after stripping whitespace.
-                if 'SRID=' not in wkt and bool(wkt.strip()) is False and (not self.in_srid):
-                    raise AssertionError("Receieved a row with blank geometry, you need to pass an --in_srid so we know if we need to project!")
-                if 'SRID=' not in wkt and bool(wkt.strip()) is True and (not self.in_srid):
-                    raise AssertionError("SRID not found in shape row! Please export your dataset with 'geom_with_srid=True'.")
-
-                if (not self.in_srid) and 'SRID=' in wkt:
-                    self.logger.info('Getting SRID from csv...')
-                    self.in_srid = wkt.split(';')[0].strip("SRID=")
+                    self.logger.info(f'Adding last batch of {len(adds)}, at row #: {row_count}...')
+                    batches.submit(rows=adds, row_count=row_count, method='adds')
+            elif self.geometric:
+                for i, (row, projected) in enumerate(self.iter_projected(row_dicts)):
+                    row_count = i + 1
+                    # clean up row and perform basic non-geometric transformations
+                    row = self.format_row(row)
+
+                    # remove the shape field so we can replace it with SHAPE with the spatial reference key
+                    # and also store in 'wkt' var (well known text) so we can project it
+                    wkt = row.pop('shape')
+
+                    # Set WKT to empty string so next conditional doesn't fail on a Nonetype
+                    if wkt is None:
+                        wkt = ''
+
+                    # if the wkt is not empty, and SRID isn't in it, fail out.
+                    # empty geometries come in with some whitespace, so test truthiness
+                    # after stripping whitespace.
+                    if 'SRID=' not in wkt and bool(wkt.strip()) is False and (not self.in_srid):
+                        raise AssertionError("Receieved a row with blank geometry, you need to pass an --in_srid so we know if we need to project!")
+                    if 'SRID=' not in wkt and bool(wkt.strip()) is True and (not self.in_srid):
+                        raise AssertionError("SRID not found in shape row! Please export your dataset with 'geom_with_srid=True'.")
+
+                    if (not self.in_srid) and 'SRID=' in wkt:
+                        self.logger.info('Getting SRID from csv...')
+                        self.in_srid = wkt.split(';')[0].strip("SRID=")
     
-                # Get just the WKT from the shape, remove SRID after we extract it
-                if 'SRID=' in wkt:
-                    wkt = wkt.split(';')[1]
-
-                # If the geometry cell is blank, properly pass a NaN or empty value to indicate so.
-                # Also account for values like "POINT EMPTY"
-                if not (bool(wkt.strip())) or 'EMPTY' in wkt: 
-                    if self.geometric == 'esriGeometryPoint':
-                        geom_dict = {"x": 'NaN',
-                                     "y": 'NaN',
-                                     "spatial_reference": {"wkid": self.ago_srid[1]}
-                                     }
-                    elif self.geometric == 'esriGeometryPolyline':
-                        geom_dict = {"paths": [],
-                                     "spatial_reference": {"wkid": self.ago_srid[1]}
-                                     }
-                    elif self.geometric == 'esriGeometryPolygon':
-                        geom_dict = {"rings": [],
-                                     "spatial_reference": {"wkid": self.ago_srid[1]}
-                                     }
-                    else:
-                        raise TypeError(f'Unexpected geomtry type!: {self.geometric}')
-                # For different types we can consult this for the proper json format:
-                # https://developers.arcgis.com/documentation/common-data-types/geometry-objects.htm
-                # If it's not blank,
-                elif bool(wkt.strip()): 
-                    if 'POINT' in wkt:
-                        projected_x, projected_y = self.project_and_format_shape(wkt)
-                        # Format our row, following the docs on this one, see section "In [18]":
-                        # https://developers.arcgis.com/python/sample-notebooks/updating-features-in-a-feature-layer/
-                        # create our formatted point geometry
-                        geom_dict = {"x": projected_x,
-                                     "y": projected_y,
-                                     "spatial_reference": {"wkid": self.ago_srid[1]}
-                                     }
-                    elif 'MULTIPOINT' in wkt:
-                        raise NotImplementedError("MULTIPOINTs not implemented yet..")
-                    elif 'MULTIPOLYGON' in wkt:
-                        rings = self.project_and_format_shape(wkt)
-                        geom_dict = {"rings": rings,
-                                     "spatial_reference": {"wkid": self.ago_srid[1]}
-                                     }
-                    elif 'POLYGON' in wkt:
-                        #xlist, ylist = return_coords_only(wkt)
-                        ring = self.project_and_format_shape(wkt)
-                        geom_dict = {"rings": [ring],
-                                     "spatial_reference": {"wkid": self.ago_srid[1]}
-                                     }
-                    elif 'MULTILINESTRING' in wkt:
-                        paths = self.project_and_format_shape(wkt)
-                        # Don't know why yet but some bug is sending us multilines with an already enclosing list
-                        # Don't enclose in list if multilinestring
-                        geom_dict = {"paths": paths,
-                                    "spatial_reference": {"wkid": self.ago_srid[0], "latestWkid": self.ago_srid[1]}
-                                    } 
-                    elif 'LINESTRING' in wkt:
-                        paths = self.project_and_format_shape(wkt)
-                        geom_dict = {"paths": [paths],
-                                     "spatial_reference": {"wkid": self.ago_srid[1]}
-                                     }
-                    else:
-                        self.logger.info('Did not recognize geometry in our WKT. Did we extract the dataset properly?')
-                        self.logger.info(f'Geometry value is: {wkt}')
-                        raise AssertionError('Unexpected/unreadable geometry value')
+                    # Get just the WKT from the shape, remove SRID after we extract it
+                    if 'SRID=' in wkt:
+                        wkt = wkt.split(';')[1]
 
-                # Create our formatted row after geometric stuff
-                try:
+                    # Blank geometries and values like "POINT EMPTY" are sent as empty geometries
+                    geom_dict = self.geometry_encoder.encode(wkt, projected)
+
+                    # Create our formatted row after geometric stuff
                     formatted_row = {"attributes": row,
                                      "geometry": geom_dict
                                      }
-                except UnboundLocalError as e:
-                    # If somehow geom_dict is unbound, self.logger.info the wkt to help figure out why
-                    self.logger.info(f'DEBUG! {wkt}')
-                    raise e
-
-                adds.append(formatted_row)
 
-                if (len(adds) != 0) and (len(adds) % self.batch_size == 0):
-                    self.logger.info(f'Adding batch of {len(adds)}, at row #: {row_count}...')
-                    start = time()
-                    self.edit_features(rows=adds, row_count=row_count, method='adds')
-
-                    # Commenting out multithreading for now.
-                    #split_batches = np.array_split(adds,2)
-                    # Where we actually append the rows to the dataset in AGO
-                    #t1 = Thread(target=self.edit_features,
-                    #            args=(list(split_batches[0]), 'adds'))
-                    #t2 = Thread(target=self.edit_features,
-                    #            args=(list(split_batches[1]), 'adds'))
-                    #t1.start()
-                    #t2.start()
+                    adds.append(formatted_row)
 
-                    #t1.join()
-                    #t2.join()
+                    if (len(adds) != 0) and (len(adds) % self.batch_size == 0):
+                        self.logger.info(f'Adding batch of {len(adds)}, at row #: {row_count}...')
+                        batches.submit(rows=adds, row_count=row_count, method='adds')
 
-                    adds = []
-                    self.logger.info(f'Duration: {time() - start}\n')
-            # add leftover rows outside the loop if they don't add up to 4000
-            if adds:
-                start = time()
-                self.logger.info(f'Adding last batch of {len(adds)}, at row #: {i+1}...')
-                #self.logger.info(f'Example row: {adds[0]}')
-                #self.logger.info(f'batch: {adds}')
-                self.edit_features(rows=adds, row_count=row_count, method='adds')
-                self.logger.info(f'Duration: {time() - start}')
+                        adds = []
+                # add leftover rows outside the loop if they don't add up to 4000
+                if adds:
+                    self.logger.info(f'Adding last batch of {len(adds)}, at row #: {i+1}...')
+                    #self.logger.info(f'Example row: {adds[0]}')
+                    #self.logger.info(f'batch: {adds}')
+                    batches.submit(rows=adds, row_count=row_count, method='adds')
 
         ago_count = self.layer_object.query(return_count_only=True)
         self.logger.info(f'count after batch adds: {str(ago_count)}')
         assert ago_count != 0
+        if self.concurrent_batches > 1:
+            self.check_unchecked_batches(ago_count, start_count + self._num_rows_in_upload_file)
+
+
+    def check_unchecked_batches(self, ago_count, expected_count):
+        '''
+        With concurrent batches, appends that time out can't be checked against the
+        count right away, as in edit_features(), because other batches are in flight.
+        They're assumed to have worked, so once every batch is done check that all
+        of the rows are in AGO, apart from any written to error files.
+        '''
+        if not self._unchecked_batches:
+            return
+        min_count = expected_count - sum(self._error_batches.values())
+        self.logger.info(f'{self._unchecked_batches:,} batches timed out and were assumed to have worked, '
+                         f'expecting {min_count:,} to {expected_count:,} rows, AGO has {ago_count:,}.')
+        if ago_count < min_count:
+            raise AssertionError('AGO count out of sync with our progress! Batches that timed out did not all go through, retry when AGO is less busy.')
+        if ago_count > expected_count:
+            raise AssertionError('Error, ago_count is greater than our row_count! Some appends doubled up?')
+
+
+    def apply_edits(self, rows, method='adds'):
+        '''Send one batch of adds, updates or deletes to the layer, timed as an "api" stage'''
+        # Deletes are sent as a comma separated string of objectids
+        row_count = len(rows.split(',')) if isinstance(rows, str) else len(rows)
+        with metrics.span('api', rows=row_count, method=method):
+            return self.layer_object.edit_features(**{method: rows}, rollback_on_failure=True)
 
 
     def edit_features(self, rows, row_count, method='adds'):
@@ -749,7 +920,7 @@ class AGO():
                         return True
                     elif "error" in element and element["error"]["code"] != 1000:
                         self.logger.info('Got a a character overflow error. Saving errors.') 
-                        self.write_errors_to_s3(rows)
+                        self.write_errors_to_s3(rows, batch=(method, row_count))
                     elif "error" in element and element["error"]["code"] != 1003:
                         raise Exception(f'Got this error returned from AGO (unhandled error): {element["error"]}')
                 return False
@@ -770,18 +941,13 @@ class AGO():
                 if is_rolled_back(result):
                     #raise Exception("Retry on rollback didn't work.")
                     self.logger.info("Retry on rollback didn't work. Writing errors to file and continuing...")
-                    self.write_errors_to_s3(rows)
+                    self.write_errors_to_s3(rows, batch=(method, row_count))
                     success = True
                     continue
 
             # Add the batch
             try:
-                if method == "adds":
-                    result = self.layer_object.edit_features(adds=rows, rollback_on_failure=True)
-                elif method == "updates":
-                    result = self.layer_object.edit_features(updates=rows, rollback_on_failure=True)
-                elif method == "deletes":
-                    result = self.layer_object.edit_features(deletes=rows, rollback_on_failure=True)
+                result = self.apply_edits(rows, method)
             except Exception as e:
                 if 'request has timed out' in str(e):
                     tries += 1
@@ -789,6 +955,14 @@ class AGO():
                     # Instead we'll just have to assume success (which it usually appears to be?)
                     if self.upserting:
                         self.logger.info(f'Got a request timed out back, assuming it worked... Error: {str(e)}')
+                    # With concurrent batches the count includes the other batches in flight,
+                    # so append() checks it once they're all done instead
+                    if not self.upserting and self.concurrent_batches > 1:
+                        self.logger.info(f'Got a request timed out with other batches in flight, assuming it worked and checking the count at the end. Error: {str(e)}')
+                        with self._errors_lock:
+                            self._unchecked_batches += 1
+                        success = True
+                        continue
                     if not self.upserting:
                         self.logger.info(f'Got a request timed out, checking counts. Error: {str(e)}')
                         # slow down requests if we're getting timeouts
@@ -845,7 +1019,7 @@ class AGO():
                     self.logger.info(f'Unexpected Exception from AGO on this batch! Writing these rows to error file and continuing to next batch...')
                     self.logger.info('If this is a fail on a specific row, consider passing it into the --clean_columns arg.')
                     self.logger.info(f'Exception error: {str(e)}')
-                    self.write_errors_to_s3(rows)
+                    self.write_errors_to_s3(rows, batch=(method, row_count))
                     success = True
                     continue
 
@@ -853,12 +1027,7 @@ class AGO():
                 self.logger.info("Results rolled back, retrying our batch adds in 60 seconds....")
                 sleep(60)
                 try:
-                    if method == "adds":
-                        result = self.layer_object.edit_features(adds=rows, rollback_on_failure=True)
-                    elif method == "updates":
-                        result = self.layer_object.edit_features(updates=rows, rollback_on_failure=True)
-                    elif method == "deletes":
-                        result = self.layer_object.edit_features(deletes=rows, rollback_on_failure=True)
+                    result = self.apply_edits(rows, method)
                 except Exception as e:
                     if 'request has timed out' in str(e):
                         tries += 1
@@ -866,6 +1035,14 @@ class AGO():
                         # Instead we'll just have to assume success (which it usually appears to be?)
                         if self.upserting:
                             self.logger.info(f'Got a request timed out back, assuming it worked... Error: {str(e)}')
+                        # With concurrent batches the count includes the other batches in flight,
+                        # so append() checks it once they're all done instead
+                        if not self.upserting and self.concurrent_batches > 1:
+                            self.logger.info(f'Got a request timed out with other batches in flight, assuming it worked and checking the count at the end. Error: {str(e)}')
+                            with self._errors_lock:
+                                self._unchecked_batches += 1
+                            success = True
+                            continue
                         if not self.upserting:
                             self.logger.info(f'Got a request timed out, checking counts. Error: {str(e)}')
                             # slow down requests if we're getting timeouts
@@ -922,7 +1099,7 @@ class AGO():
                         self.logger.info(f'Unexpected Exception from AGO on this batch! Writing these rows to error file and continuing to next batch...')
                         self.logger.info('If this is a fail on a specific row, consider passing it into the --clean_columns arg.')
                         self.logger.info(f'Exception error: {str(e)}')
-                        self.write_errors_to_s3(rows)
+                        self.write_errors_to_s3(rows, batch=(method, row_count))
                         success = True
                         continue
 
@@ -951,61 +1128,17 @@ class AGO():
             self.unzip()
 
 
-    def convert_geometry(self, wkt):
-        '''Convert WKT geometry to the special type AGO requires.'''
+    def convert_geometry(self, wkt, projected=None):
+        '''Convert WKT geometry to the special type AGO requires. Pass projected if
+        the shape was already projected, see iter_projected().'''
         if 'SRID=' not in wkt:
             raise AssertionError("SRID not found in shape row! Please export your dataset with 'geom_with_srid=True'.")
         if self.in_srid == None:
             self.in_srid = wkt.split(';')[0].strip("SRID=")
         wkt = wkt.split(';')[1]
-        # For different types we can consult this for the proper json format:
-        # https://developers.arcgis.com/documentation/common-data-types/geometry-objects.htm
-        if 'POINT' in wkt:
-            projected_x, projected_y = self.project_and_format_shape(wkt)
-                           # Format our row, following the docs on this one, see section "In [18]":
-            # https://developers.arcgis.com/python/sample-notebooks/updating-features-in-a-feature-layer/
-            # create our formatted point geometry
-            geom_dict = {"x": projected_x,
-                         "y": projected_y,
-                         "spatial_reference": {"wkid": self.ago_srid[0], "latestWkid": self.ago_srid[1]}
-                         }
-            #row_to_append = {"attributes": row,
-            #                 "geometry": geom_dict}
-        elif 'MULTIPOINT' in wkt:
-            raise NotImplementedError("MULTIPOINTs not implemented yet..")
-        elif 'MULTIPOLYGON' in wkt:
-            rings = self.project_and_format_shape(wkt)
-            geom_dict = {"rings": rings,
-                         "spatial_reference": {"wkid": self.ago_srid[0], "latestWkid": self.ago_srid[1]}
-                         }
-            #row_to_append = {"attributes": row,
-            #                 "geometry": geom_dict
-            #                 }
-        elif 'POLYGON' in wkt:
-            #xlist, ylist = return_coords_only(wkt)
-            ring = self.project_and_format_shape(wkt)
-            geom_dict = {"rings": [ring],
-                         "spatial_reference": {"wkid": self.ago_srid[0], "latestWkid": self.ago_srid[1]}
-                         }
-            #row_to_append = {"attributes": row,
-            #                 "geometry": geom_dict
-            #                 }
-        elif 'MULTILINESTRING' in wkt:
-            paths = self.project_and_format_shape(wkt)
-            # Don't know why yet but some bug is sending us multilines with an already enclosing list
-            # Don't enclose in list if multilinestring
-            geom_dict = {"paths": paths,
-                         "spatial_reference": {"wkid": self.ago_srid[0], "latestWkid": self.ago_srid[1]}
-                         } 
-        elif 'LINESTRING' in wkt:
-            paths = self.project_and_format_shape(wkt)
-            geom_dict = {"paths": [paths],
-                         "spatial_reference": {"wkid": self.ago_srid[0], "latestWkid": self.ago_srid[1]}
-                         }
-            #row_to_append = {"attributes": row,
-            #                 "geometry": geom_dict
-            #                 }
-        return geom_dict
+        if projected is None:
+            projected = self.project_and_format_shapes([wkt])[0]
+        return self.geometry_encoder.encode(wkt, projected)
 
 
     def upsert(self):
@@ -1025,11 +1158,7 @@ class AGO():
         # Global variable to inform other processes that we're upserting
         self.upserting = True
 
-        try:
-            rows = etl.fromcsv(self.csv_path, encoding='utf-8')
-        except UnicodeError:
-            self.logger.info("Exception encountered trying to import rows wtih utf-8 encoding, trying latin-1...")
-            rows = etl.fromcsv(self.csv_path, encoding='latin-1')
+        rows = self.read_rows()
         # Compare headers in the csv file vs the fields in the ago item.
         # If the names don't match and we were to upload to AGO anyway, AGO will not actually do
         # anything with our rows but won't tell us anything is wrong!
@@ -1048,273 +1177,382 @@ class AGO():
 
         self._num_rows_in_upload_file = rows.nrows()
         row_dicts = rows.dicts()
-        adds = []
-        updates = []
-        if not self.geometric:
-            for i, row in enumerate(row_dicts):
-                row_count = i + 1
+        # One pass through the layer rather than a query for every row
+        pk_objectids = self.primary_key_objectids()
+        # Look up and format rows here while up to concurrent_batches earlier batches
+        # are sent to AGO
+        with Batch_Pipeline(self.edit_features, self.concurrent_batches) as batches:
+            adds = []
+            updates = []
+            if not self.geometric:
+                for i, row in enumerate(row_dicts):
+                    row_count = i + 1
+
+                    # We need an OBJECTID in our row for upserting. Assert that we have that, bomb out if we don't
+                    assert row['objectid']
+
+                    # clean up row and perform basic non-geometric transformations
+                    row = self.format_row(row)
+
+                    # Figure out if row exists in AGO, and what it's object ID is.
+                    ago_objectid = self.upsert_objectid(row[self.primary_key], pk_objectids, row_count)
+
+                    #self.logger.info(f'DEBUG! ago_objectid: {ago_objectid}')
+    
+                    # Reassign the objectid or assign it to match the row in AGO. This will
+                    # make it work with AGO's 'updates' endpoint and work like an upsert.
+                    row['objectid'] = ago_objectid
+
+                    # If we didn't get anything back from AGO, then we can simply append our row
+                    if not ago_objectid:
+                        adds.append({"attributes": row})
+
+                    # If we did get something back from AGO, then we're upserting our row
+                    if ago_objectid:
+                        updates.append({"attributes": row})
+
+                    if (len(adds) != 0) and (len(adds) % self.batch_size == 0):
+                        self.logger.info(f'(non geometric) Adding batch of appends, {len(adds)}, at row #: {row_count}...')
+                        batches.submit(rows=adds, row_count=row_count, method='adds')
+                        adds = []
+                    if (len(updates) != 0) and (len(adds) % self.batch_size == 0):
+                        self.logger.info(f'(non geometric) Adding batch of updates {len(updates)}, at row #: {row_count}...')
+                        batches.submit(rows=updates, row_count=row_count, method='updates')
+                        updates = []
+                if adds:
+                    self.logger.info(f'(non geometric) Adding last batch of appends, {len(adds)}, at row #: {row_count}...')
+                    batches.submit(rows=adds, row_count=row_count, method='adds')
+                if updates:
+                    self.logger.info(f'(non geometric) Adding last batch of updates, {len(updates)}, at row #: {row_count}...')
+                    batches.submit(rows=updates, row_count=row_count, method='updates')
+
+            elif self.geometric:
+                for i, (row, projected) in enumerate(self.iter_projected(row_dicts)):
+                    row_count = i+1
+                    # We need an OBJECTID in our row for upserting. Assert that we have that, bomb out if we don't
+                    assert row['objectid']
 
-                # We need an OBJECTID in our row for upserting. Assert that we have that, bomb out if we don't
-                assert row['objectid']
-
-                # clean up row and perform basic non-geometric transformations
-                row = self.format_row(row)
-
-                # Figure out if row exists in AGO, and what it's object ID is.
-                row_primary_key = row[self.primary_key]
-                wherequery = f"{self.primary_key} = '{row_primary_key}'"
-                ago_row = self.query_features(wherequery=wherequery)
-
-                # Should be length 0 or 1
-                # If we got two or more, we're doubled up and we can delete one.
-                if len(ago_row.sdf) == 2:
-                    self.logger.info(f'Got two results for one primary key "{row_primary_key}". Deleting second one.')
-                    # Delete the 2nd one.
-                    del_objectid = ago_row.sdf.iloc[1]['OBJECTID']
-                    # Docs say you can simply pass only the ojbectid as a string and it should work.
-                    self.edit_features(rows=str(del_objectid), row_count=row_count, method='deletes')
-                # If it's more than 2, then just except out.
-                elif len(ago_row.sdf) > 1:
-                    raise AssertionError(f'Should have only gotten 1 or 0 rows from AGO! Instead we got: {len(ago_row.sdf)}')
-
-                # If our row is in AGO, then we need the objectid for the upsert/update
-                if not ago_row.sdf.empty:
-                    ago_objectid = ago_row.sdf.iloc[0]['OBJECTID']
-                else:
-                    #self.logger.info(f'DEBUG! ago_row is empty?: {ago_row}')
-                    self.logger.info(ago_row.sdf)
-                    ago_objectid = False
+                    # clean up row and perform basic non-geometric transformations
+                    row = self.format_row(row)
 
-                #self.logger.info(f'DEBUG! ago_objectid: {ago_objectid}')
-    
-                # Reassign the objectid or assign it to match the row in AGO. This will
-                # make it work with AGO's 'updates' endpoint and work like an upsert.
-                row['objectid'] = ago_objectid
+                    # Figure out if row exists in AGO, and what it's object ID is.
+                    ago_objectid = self.upsert_objectid(row[self.primary_key], pk_objectids, row_count)
 
-                # If we didn't get anything back from AGO, then we can simply append our row
-                if ago_row.sdf.empty:
-                    adds.append({"attributes": row})
+                    #self.logger.info(f'DEBUG! ago_objectid: {ago_objectid}')
+    
+                    # Reassign the objectid or assign it to match the row in AGO. This will
+                    # make it work with AGO's 'updates' endpoint and work like an upsert.
+                    row['objectid'] = ago_objectid
+
+                    # remove the shape field so we can replace it with SHAPE with the spatial reference key
+                    # and also store in 'wkt' var (well known text) so we can project it
+                    wkt = row.pop('shape')
+
+                    # if the wkt is not empty, and SRID isn't in it, fail out.
+                    # empty geometries come in with some whitespace, so test truthiness
+                    # after stripping whitespace.
+                    if 'SRID=' not in wkt and bool(wkt.strip()) is False and (not self.in_srid):
+                        raise AssertionError("Receieved a row with blank geometry, you need to pass an --in_srid so we know if we need to project!")
+                    if 'SRID=' not in wkt and bool(wkt.strip()) is True and (not self.in_srid):
+                        raise AssertionError("SRID not found in shape row! Please export your dataset with 'geom_with_srid=True'.")
+
+                    if (not self.in_srid) and 'SRID=' in wkt:
+                        self.logger.info('Getting SRID from csv...')
+                        self.in_srid = wkt.split(';')[0].strip("SRID=")
+
+                    # Get just the WKT from the shape, remove SRID after we extract it
+                    if 'SRID=' in wkt:
+                        wkt = wkt.split(';')[1]
+
+                    # Blank geometries and values like "POINT EMPTY" are sent as empty geometries
+                    geom_dict = self.geometry_encoder.encode(wkt, projected)
+
+                    # Once we're done our shape stuff, put our row into it's final format
+                    formatted_row = {"attributes": row,
+                                     "geometry": geom_dict
+                                     }
+                    ##################################
+                    # END geometry handling
+                    ##################################
 
-                # If we did get something back from AGO, then we're upserting our row
-                if ago_objectid:
-                    updates.append({"attributes": row})
+                    # If we didn't get anything back from AGO, then we can simply append our row
+                    if not ago_objectid:
+                        adds.append(formatted_row)
 
-                if (len(adds) != 0) and (len(adds) % self.batch_size == 0):
-                    start = time()
-                    self.logger.info(f'(non geometric) Adding batch of appends, {len(adds)}, at row #: {row_count}...')
-                    self.edit_features(rows=adds, row_count=row_count, method='adds')
-                    adds = []
-                    self.logger.info(f'Duration: {time() - start}\n')
-                if (len(updates) != 0) and (len(adds) % self.batch_size == 0):
-                    start = time()
-                    self.logger.info(f'(non geometric) Adding batch of updates {len(updates)}, at row #: {row_count}...')
-                    self.edit_features(rows=updates, row_count=row_count, method='updates')
-                    updates = []
-                    self.logger.info(f'Duration: {time() - start}\n')
-            if adds:
-                start = time()
-                self.logger.info(f'(non geometric) Adding last batch of appends, {len(adds)}, at row #: {row_count}...')
-                self.edit_features(rows=adds, row_count=row_count, method='adds')
-                self.logger.info(f'Duration: {time() - start}\n')
-            if updates:
-                start = time()
-                self.logger.info(f'(non geometric) Adding last batch of updates, {len(updates)}, at row #: {row_count}...')
-                self.edit_features(rows=updates, row_count=row_count, method='updates')
-                self.logger.info(f'Duration: {time() - start}\n')
+                    # If we did get something back from AGO, then we're upserting our row
+                    if ago_objectid:
+                        updates.append(formatted_row)
 
-        elif self.geometric:
-            for i, row in enumerate(row_dicts):
-                row_count = i+1
-                # We need an OBJECTID in our row for upserting. Assert that we have that, bomb out if we don't
-                assert row['objectid']
-
-                # clean up row and perform basic non-geometric transformations
-                row = self.format_row(row)
-
-                # Figure out if row exists in AGO, and what it's object ID is.
-                row_primary_key = row[self.primary_key]
-                wherequery = f"{self.primary_key} = '{row_primary_key}'"
-                ago_row = self.query_features(wherequery=wherequery)
-
-                # Should be length 0 or 1
-                # If we got two or more, we're doubled up and we can delete one.
-                if len(ago_row.sdf) == 2:
-                    self.logger.info(f'Got two results for one primary key "{row_primary_key}". Deleting second one.')
-                    # Delete the 2nd one.
-                    del_objectid = ago_row.sdf.iloc[1]['OBJECTID']
-                    # Docs say you can simply pass only the ojbectid as a string and it should work.
-                    self.edit_features(rows=str(del_objectid), row_count=row_count, method='deletes')
-                # Should be length 0 or 1
-                elif len(ago_row.sdf) > 1:
-                    raise AssertionError(f'Should have only gotten 1 or 0 rows from AGO! Instead we got: {len(ago_row.sdf)}')
-
-                # If our row is in AGO, then we need the objectid for the upsert/update
-                if not ago_row.sdf.empty:
-                    ago_objectid = ago_row.sdf.iloc[0]['OBJECTID']
-                else:
-                    ago_objectid = False
+                    if (len(adds) != 0) and (len(adds) % self.batch_size == 0):
+                        self.logger.info(f'Adding batch of appends, {len(adds)}, at row #: {row_count}...')
+                        batches.submit(rows=adds, row_count=row_count, method='adds')
 
-                #self.logger.info(f'DEBUG! ago_objectid: {ago_objectid}')
-    
-                # Reassign the objectid or assign it to match the row in AGO. This will
-                # make it work with AGO's 'updates' endpoint and work like an upsert.
-                row['objectid'] = ago_objectid
+                        adds = []
 
-                # remove the shape field so we can replace it with SHAPE with the spatial reference key
-                # and also store in 'wkt' var (well known text) so we can project it
-                wkt = row.pop('shape')
+                    if (len(updates) != 0) and (len(updates) % self.batch_size == 0):
+                        self.logger.info(f'Adding batch of updates, {len(updates)}, at row #: {row_count}...')
+                        batches.submit(rows=updates, row_count=row_count, method='updates')
 
-                # if the wkt is not empty, and SRID isn't in it, fail out.
-                # empty geometries come in with some whitespace, so test truthiness
-                # after stripping whitespace.
-                if 'SRID=' not in wkt and bool(wkt.strip()) is False and (not self.in_srid):
-                    raise AssertionError("Receieved a row with blank geometry, you need to pass an --in_srid so we know if we need to project!")
-                if 'SRID=' not in wkt and bool(wkt.strip()) is True and (not self.in_srid):
-                    raise AssertionError("SRID not found in shape row! Please export your dataset with 'geom_with_srid=True'.")
+                        updates = []
+                # add leftover rows outside the loop if they don't add up to 4000
+                if adds:
+                    self.logger.info(f'Adding last batch of appends, {len(adds)}, at row #: {row_count}...')
+                    batches.submit(rows=adds, row_count=row_count, method='adds')
+                if updates:
+                    self.logger.info(f'Adding last batch of updates, {len(updates)}, at row #: {row_count}...')
+                    batches.submit(rows=updates, row_count=row_count, method='updates')
 
-                if (not self.in_srid) and 'SRID=' in wkt:
-                    self.logger.info('Getting SRID from csv...')
-                    self.in_srid = wkt.split(';')[0].strip("SRID=")
+        ago_count = self.layer_object.query(return_count_only=True)
+        self.logger.info(f'count after batch adds: {str(ago_count)}')
+        assert ago_count != 0
 
-                # Get just the WKT from the shape, remove SRID after we extract it
-                if 'SRID=' in wkt:
-                    wkt = wkt.split(';')[1]
 
-                # If the geometry cell is blank, properly pass a NaN or empty value to indicate so.
-                if not (bool(wkt.strip())):
-                    if self.geometric == 'esriGeometryPoint':
-                        geom_dict = {"x": 'NaN',
-                                     "y": 'NaN',
-                                     "spatial_reference": {"wkid": self.ago_srid[1]}
-                                     }
-                    elif self.geometric == 'esriGeometryPolyline':
-                        geom_dict = {"paths": [],
-                                     "spatial_reference": {"wkid": self.ago_srid[1]}
-                                     }
-                    elif self.geometric == 'esriGeometryPolygon':
-                        geom_dict = {"rings": [],
-                                     "spatial_reference": {"wkid": self.ago_srid[1]}
-                                     }
-                    else:
-                        raise TypeError(f'Unexpected geomtry type!: {self.geometric}')
-                # For different types we can consult this for the proper json format:
-                # https://developers.arcgis.com/documentation/common-data-types/geometry-objects.htm
-                if bool(wkt.strip()): 
-                    if 'POINT' in wkt:
-                        projected_x, projected_y = self.project_and_format_shape(wkt)
-                        # Format our row, following the docs on this one, see section "In [18]":
-                        # https://developers.arcgis.com/python/sample-notebooks/updating-features-in-a-feature-layer/
-                        # create our formatted point geometry
-                        geom_dict = {"x": projected_x,
-                                     "y": projected_y,
-                                     "spatial_reference": {"wkid": self.ago_srid[1]}
-                                     }
-                    elif 'MULTIPOINT' in wkt:
-                        raise NotImplementedError("MULTIPOINTs not implemented yet..")
-                    elif 'MULTIPOLYGON' in wkt:
-                        rings = self.project_and_format_shape(wkt)
-                        geom_dict = {"rings": rings,
-                                     "spatial_reference": {"wkid": self.ago_srid[1]}
-                                     }
-                    elif 'POLYGON' in wkt:
-                        #xlist, ylist = return_coords_only(wkt)
-                        ring = self.project_and_format_shape(wkt)
-                        geom_dict = {"rings": [ring],
-                                     "spatial_reference": {"wkid": self.ago_srid[1]}
-                                     }
-                    elif 'MULTILINESTRING' in wkt:
-                        paths = self.project_and_format_shape(wkt)
-                        # Don't know why yet but some bug is sending us multilines with an already enclosing list
-                        # Don't enclose in list if multilinestring
-                        geom_dict = {"paths": paths,
-                                    "spatial_reference": {"wkid": self.ago_srid[0], "latestWkid": self.ago_srid[1]}
-                                    } 
-                    elif 'LINESTRING' in wkt:
-                        paths = self.project_and_format_shape(wkt)
-                        geom_dict = {"paths": [paths],
-                                     "spatial_reference": {"wkid": self.ago_srid[1]}
-                                     }
-                    else:
-                        self.logger.info('Did not recognize geometry in our WKT. Did we extract the dataset properly?')
-                        self.logger.info(f'Geometry value is: {wkt}')
-                        raise AssertionError('Unexpected/unreadable geometry value')
-
-                # Once we're done our shape stuff, put our row into it's final format
-                formatted_row = {"attributes": row,
-                                 "geometry": geom_dict
-                                 }
-                ##################################
-                # END geometry handling
-                ##################################
-
-                # If we didn't get anything back from AGO, then we can simply append our row
-                if ago_row.sdf.empty:
-                    adds.append(formatted_row)
+    def normalize_attribute(self, col, value):
+        '''Normalize a value from format_row() or from AGO according to the AGO type of
+        its field, so that unchanged values compare equal: dates as epoch
+        milliseconds (as AGO returns them, naive datetimes taken as UTC), numbers as
+        numbers rather than CSV strings, and blanks as None.'''
+        if value is None or value == '':
+            return None
+        data_type = self.item_fields.get(col)
+        try:
+            if data_type == 'esrifieldtypedate':
+                if isinstance(value, datetime):
+                    if value.tzinfo is None:
+                        value = value.replace(tzinfo=timezone.utc)
+                    return int(value.timestamp() * 1000)
+                return int(value)
+            if data_type in ('esrifieldtypeoid', 'esrifieldtypeinteger', 'esrifieldtypesmallinteger', 
+                             'esrifieldtypebiginteger'):
+                return int(float(value))
+            if data_type == 'esrifieldtypesingle':
+                return float(f'{float(value):.6g}')
+            if data_type == 'esrifieldtypedouble':
+                return float(value)
+        except (TypeError, ValueError):
+            pass
+        return str(value)
+
+    def normalize_geometry(self, geometry):
+        '''Normalize an AGO geometry dict, ours or AGO's, to its coordinates rounded to
+        geometry_decimals places, or None if it's empty'''
+        if not geometry:
+            return None
+        decimals = self.geometry_decimals
+        def rounded(value):
+            # Rings and paths are nested lists of coordinates
+            if isinstance(value, (list, tuple)):
+                return [rounded(v) for v in value]
+            return round(float(value), decimals)
+        if 'x' in geometry:
+            if geometry['x'] in (None, 'NaN') or geometry['x'] != geometry['x']:
+                return None
+            return rounded([geometry['x'], geometry['y']])
+        return rounded(geometry.get('rings') or geometry.get('paths') or []) or None
+
+    def feature_hash(self, attributes, geometry, fields, compare_geometry):
+        '''Hash the normalized values of fields (and geometry) of a feature'''
+        values = {col: self.normalize_attribute(col, attributes.get(col)) for col in fields}
+        if compare_geometry:
+            values['shape'] = self.normalize_geometry(geometry)
+        return hashlib.sha1(json.dumps(values, sort_keys=True, default=str).encode()).hexdigest()
+
+    def format_feature(self, row, projected=None):
+        '''Format a CSV row, as format_row() does, into an AGO feature with its shape
+        projected into an AGO geometry dict, see convert_geometry()'''
+        row = self.format_row(row)
+        if not self.geometric:
+            return {"attributes": row}
+        wkt = (row.pop('shape') or '').strip()
+        if wkt and 'SRID=' not in wkt:
+            if not self.in_srid:
+                raise AssertionError("SRID not found in shape row! Please export your dataset with 'geom_with_srid=True'.")
+            wkt = f'SRID={self.in_srid};{wkt}'
+        # Blank geometries and values like "POINT EMPTY" are sent as empty geometries
+        if not wkt or 'EMPTY' in wkt:
+            geom_dict = self.geometry_encoder.empty()
+        else:
+            geom_dict = self.convert_geometry(wkt, projected)
+        return {"attributes": row, "geometry": geom_dict}
 
-                # If we did get something back from AGO, then we're upserting our row
-                if ago_objectid:
-                    updates.append(formatted_row)
+    def sync(self, compare_geometry=True):
+        '''
+        Make the AGO item match our CSV by sending only the differences, keyed on
+        primary_key: rows whose key isn't in AGO are added, rows whose values differ
+        from the AGO feature's are sent as updates, and features whose key isn't in
+        the CSV (or that duplicate another feature's key) are deleted. Unchanged
+        rows aren't sent at all, so syncing a mostly unchanged dataset costs one
+        paged read of the layer plus a small delta, rather than a truncate and a
+        full reload.
+
+        Rows and features are compared by hashes of their values normalized by
+        field type (see normalize_attribute()), and of their geometries rounded to
+        the item's xy resolution (see geometry_decimals) unless compare_geometry is
+        False, in which case a feature whose only change is its shape is not
+        updated. A geometry that AGO stores differently, e.g. with its rings
+        reordered, is just sent as an update.
+        '''
+        assert self.primary_key
+        # Updates and deletes change the count unpredictably, see edit_features()
+        self.upserting = True
 
-                if (len(adds) != 0) and (len(adds) % self.batch_size == 0):
+        rows = self.read_rows()
+        self.logger.info(f'Comparing AGO fields: "{tuple(self.item_fields.keys())}" and CSV fields: "{rows.fieldnames()}"')
+        row_differences = set(self.item_fields.keys()) - set(rows.fieldnames())
+        if row_differences - {'objectid', 'esri_oid'}:
+            self.logger.info(f'Row differences found!: {row_differences}')
+            assert tuple(self.item_fields.keys()) == rows.fieldnames()
+        self.logger.info('Fields are the same! Continuing.')
+        self._num_rows_in_upload_file = rows.nrows()
+        fields = [f for f in rows.fieldnames()
+                  if f in self.item_fields and f not in ('objectid', 'esri_oid', 'shape')]
+        compare_geometry = bool(compare_geometry and self.geometric)
+
+        # Check the keys before anything is sent, rather than leaving AGO half synced
+        keys = Counter(self.primary_key_value(value or None) for value in rows.values(self.primary_key))
+        duplicates = [key for key, count in keys.items() if count > 1]
+        if duplicates:
+            raise AssertionError(f'{len(duplicates):,} primary keys appear more than once in the CSV, '
+                                 f'e.g. "{duplicates[0]}", cannot sync!')
+
+        ago_features = {}
+        extra_objectids = []
+        with metrics.span('fetch') as span:
+            span.rows = 0
+            for attributes, geometry in self.page_features(fields, return_geometry=compare_geometry):
+                key = self.primary_key_value(attributes.get(self.primary_key))
+                if key in ago_features:
+                    extra_objectids.append(attributes['objectid'])
+                else:
+                    ago_features[key] = (attributes['objectid'], 
+                                         self.feature_hash(attributes, geometry, fields, compare_geometry))
+                span.rows += 1
+        self.logger.info(f'Fetched {span.rows:,} features from AGO, {len(extra_objectids):,} of them '
+                         'duplicating another feature\'s primary key.')
+
+        adds, updates = [], []
+        seen = set()
+        unchanged = added = updated = 0
+        with metrics.span('diff', rows=self._num_rows_in_upload_file), \
+                Batch_Pipeline(self.edit_features, self.concurrent_batches) as batches:
+            for i, (row, projected) in enumerate(self.iter_projected(rows.dicts())):
+                row_count = i + 1
+                feature = self.format_feature(row, projected)
+                key = self.primary_key_value(feature['attributes'][self.primary_key])
+                seen.add(key)
+                feature_hash = self.feature_hash(feature['attributes'], feature.get('geometry'), 
+                                                 fields, compare_geometry)
+                if key not in ago_features:
+                    feature['attributes']['objectid'] = False
+                    adds.append(feature)
+                    added += 1
+                elif ago_features[key][1] != feature_hash:
+                    feature['attributes']['objectid'] = ago_features[key][0]
+                    updates.append(feature)
+                    updated += 1
+                else:
+                    unchanged += 1
+                if len(adds) == self.batch_size:
                     self.logger.info(f'Adding batch of appends, {len(adds)}, at row #: {row_count}...')
-                    start = time()
-                    self.edit_features(rows=adds, row_count=row_count, method='adds')
-
-                    # Commenting out multithreading for now.
-                    #split_batches = np.array_split(adds,2)
-                    # Where we actually append the rows to the dataset in AGO
-                    #t1 = Thread(target=self.edit_features,
-                    #            args=(list(split_batches[0]), 'adds'))
-                    #t2 = Thread(target=self.edit_features,
-                    #            args=(list(split_batches[1]), 'adds'))
-                    #t1.start()
-                    #t2.start()
-
-                    #t1.join()
-                    #t2.join()
-
+                    batches.submit(rows=adds, row_count=row_count, method='adds')
                     adds = []
-                    self.logger.info(f'Duration: {time() - start}\n')
-
-                if (len(updates) != 0) and (len(updates) % self.batch_size == 0):
+                if len(updates) == self.batch_size:
                     self.logger.info(f'Adding batch of updates, {len(updates)}, at row #: {row_count}...')
-                    start = time()
-                    self.edit_features(rows=updates, row_count=row_count, method='updates')
-
-                    # Commenting out multithreading for now.
-                    #split_batches = np.array_split(updates,2)
-                    # Where we actually append the rows to the dataset in AGO
-                    #t1 = Thread(target=self.edit_features,
-                    #            args=(list(split_batches[0]), 'updates'))
-                    #t2 = Thread(target=self.edit_features,
-                    #            args=(list(split_batches[1]), 'updates'))
-                    #t1.start()
-                    #t2.start()
-
-                    #t1.join()
-                    #t2.join()
-
+                    batches.submit(rows=updates, row_count=row_count, method='updates')
                     updates = []
-                    self.logger.info(f'Duration: {time() - start}\n')
-            # add leftover rows outside the loop if they don't add up to 4000
             if adds:
-                start = time()
-                self.logger.info(f'Adding last batch of appends, {len(adds)}, at row #: {row_count}...')
-                self.edit_features(rows=adds, row_count=row_count, method='adds')
-                self.logger.info(f'Duration: {time() - start}')
+                self.logger.info(f'Adding last batch of appends, {len(adds)}...')
+                batches.submit(rows=adds, row_count=self._num_rows_in_upload_file, method='adds')
             if updates:
-                start = time()
-                self.logger.info(f'Adding last batch of updates, {len(updates)}, at row #: {row_count}...')
-                self.edit_features(rows=updates, row_count=row_count, method='updates')
-                self.logger.info(f'Duration: {time() - start}')
-
-        ago_count = self.layer_object.query(return_count_only=True)
-        self.logger.info(f'count after batch adds: {str(ago_count)}')
-        assert ago_count != 0
-
+                self.logger.info(f'Adding last batch of updates, {len(updates)}...')
+                batches.submit(rows=updates, row_count=self._num_rows_in_upload_file, method='updates')
+
+            deletes = extra_objectids + [objectid for key, (objectid, _) in ago_features.items() 
+                                         if key not in seen]
+            for start in range(0, len(deletes), self.batch_size):
+                batch = deletes[start:start + self.batch_size]
+                self.logger.info(f'Deleting batch of {len(batch)} features...')
+                # A comma separated string of objectids, like the upsert's deletes
+                batches.submit(rows=','.join(str(objectid) for objectid in batch), 
+                               row_count=self._num_rows_in_upload_file, method='deletes')
+        self.logger.info(f'Sync done: {added:,} added, {updated:,} updated, {len(deletes):,} deleted, '
+                         f'{unchanged:,} unchanged.')
+
+
+    @staticmethod
+    def primary_key_value(value):
+        '''Normalize a primary key value from the CSV or from AGO to compare them,
+        e.g. 5, 5.0 and "5" are all "5"'''
+        if value is None:
+            return None
+        if isinstance(value, float) and value.is_integer():
+            value = int(value)
+        return str(value).strip()
+
+    def page_features(self, out_fields, return_geometry=False):
+        '''
+        Page through every feature of the layer by resultOffset, in OBJECTID order,
+        fetching only out_fields (and the OBJECTID), and yield `(attributes,
+        geometry)` for each. Attribute names are lower cased like our CSV headers.
+        '''
+        oid_field = self.layer_object.properties.objectIdField
+        page_size = self.layer_object.properties.get('maxRecordCount') or 2000
+        offset = 0
+        while True:
+            page = self.query_features(wherequery='1=1', out_fields=','.join([*out_fields, oid_field]),
+                                       return_geometry=return_geometry, result_offset=offset,
+                                       result_record_count=page_size, return_all_records=False,
+                                       order_by_fields=oid_field)
+            for feature in page.features:
+                attributes = {k.lower(): v for k, v in feature.attributes.items()}
+                attributes['objectid'] = attributes[oid_field.lower()]
+                yield attributes, getattr(feature, 'geometry', None)
+            offset += len(page.features)
+            if not page.features or len(page.features) < page_size:
+                break
+
+    def primary_key_objectids(self):
+        '''
+        Page through the layer once, fetching only the primary key and OBJECTID of
+        each feature, and return a dict of each primary key value (see
+        primary_key_value()) to its OBJECTIDs in ascending order. Keys with more
+        than one OBJECTID are duplicated in AGO.
+        '''
+        pk_objectids = {}
+        with metrics.span('pk_lookup') as span:
+            span.rows = 0
+            for attributes, _ in self.page_features([self.primary_key]):
+                key = self.primary_key_value(attributes[self.primary_key.lower()])
+                pk_objectids.setdefault(key, []).append(attributes['objectid'])
+                span.rows += 1
+        for objectids in pk_objectids.values():
+            objectids.sort()
+        duplicates = sum(1 for objectids in pk_objectids.values() if len(objectids) > 1)
+        self.logger.info(f'Fetched {span.rows:,} primary keys from AGO, {duplicates:,} of them duplicated.')
+        return pk_objectids
+
+    def upsert_objectid(self, row_primary_key, pk_objectids, row_count):
+        '''
+        Return the AGO OBJECTID of the feature with this primary key from
+        primary_key_objectids(), or False if there isn't one. If there are two, the
+        second is deleted; more than that is an error.
+        '''
+        ago_objectids = pk_objectids.get(self.primary_key_value(row_primary_key), [])
+        # Should be length 0 or 1
+        # If we got two or more, we're doubled up and we can delete one.
+        if len(ago_objectids) == 2:
+            self.logger.info(f'Got two results for one primary key "{row_primary_key}". Deleting second one.')
+            # Delete the 2nd one.
+            del_objectid = ago_objectids.pop(1)
+            # Docs say you can simply pass only the ojbectid as a string and it should work.
+            self.edit_features(rows=str(del_objectid), row_count=row_count, method='deletes')
+        # If it's more than 2, then just except out.
+        elif len(ago_objectids) > 1:
+            raise AssertionError(f'Should have only gotten 1 or 0 rows from AGO! Instead we got: {len(ago_objectids)}')
+        return ago_objectids[0] if ago_objectids else False
 
     # Wrapped AGO function in a retry while loop because AGO is very unreliable.
-    def query_features(self, wherequery=None, outstats=None):
+    def query_features(self, wherequery=None, outstats=None, **query_kwargs):
         tries = 0
         while True:
             if tries > 5:
@@ -1325,7 +1563,7 @@ class AGO():
                 if outstats:
                     output = self.layer_object.query(outStatistics=outstats, outFields='*')
                 elif wherequery:
-                    output = self.layer_object.query(where=wherequery)
+                    output = self.layer_object.query(where=wherequery, **query_kwargs)
                 return output
             except Exception as e:
                 if 'request has timed out' in str(e):
@@ -1379,10 +1617,10 @@ class AGO():
 
         # Import field information from the json schema file generated by dbtools extract (postgres or oracle)
         # We will loop through it and see if any of these fields are unique.
-        s3 = boto3.resource('s3')
         json_local_path = '/tmp/' + self.item_name + '_schema.json'
+        import botocore.exceptions
         try:
-            s3.Object(self.s3_bucket, self.json_schema_s3_key).download_file(json_local_path)
+            s3_transfer.download_file(self.s3_bucket, self.json_schema_s3_key, json_local_path)
         except botocore.exceptions.ClientError as e:
             if e.response['Error']['Code'] == "404":
                 raise AssertionError(f'CSV file doesnt appear to exist in S3! key: {self.json_schema_s3_key}')
@@ -1,5 +1,5 @@
 from .ago import AGO
-from .. import utils
+from .. import utils, metrics
 import click
 
 @click.group()
@@ -12,6 +12,7 @@ import click
 @click.option('--s3_key', required=False)
 def ago(ctx, **kwargs):
     '''Run ETL commands for AGO'''
+    metrics.set_labels(table=kwargs['ago_item_name'])
     ctx.obj = {}
     ctx = utils.pass_params_to_ctx(ctx, **kwargs)
 
@@ -23,6 +24,12 @@ def ago(ctx, **kwargs):
             help='Column, or comma separated list of column names to clean of AGO invalid characters.')
 @click.option('--batch_size', type=click.INT, default=500, required=False,
             help='Size of batch updates to send to AGO')
+@click.option('--concurrent_batches', type=click.INT, default=1, required=False,
+            help='How many batches to send to AGO at once, while the next batch is formatted')
+@click.option('--coordinate_precision', type=click.STRING, default=None, required=False,
+            help='Decimal places to round coordinates to, or "auto" for the xy resolution of the AGO item')
+@click.option('--generalize_tolerance', type=click.FLOAT, default=None, required=False,
+            help='Generalize lines and polygons to this tolerance, in the units of the AGO item')
 def append_group(ctx, **kwargs): 
     '''Use this group for any commands that utilize append'''
     ctx = utils.pass_params_to_ctx(ctx, **kwargs)
@@ -46,6 +53,19 @@ def upsert(ctx, **kwargs):
     ago.get_csv_from_s3()
     ago.upsert()
 
+@append_group.command()
+@click.pass_context
+@click.option('--primary_key', type=click.STRING, required=True)
+@click.option('--skip_geometry', is_flag=True, required=False, 
+            help='Only compare attributes, so features whose only change is their shape are not updated')
+def sync(ctx, skip_geometry, **kwargs):
+    """Makes an AGO item match a CSV by sending only the rows that were added or 
+    changed, and deleting the features whose primary key is no longer in the CSV."""
+    ago = AGO(**ctx.obj, **kwargs) # Combine params
+    ago.get_csv_from_s3()
+    ago.sync(compare_geometry=not skip_geometry)
+    ago.verify_count()
+
 @append_group.command()
 @click.pass_context
 def truncate_append(ctx):
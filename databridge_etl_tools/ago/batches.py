@@ -0,0 +1,65 @@
+import threading
+from concurrent.futures import ThreadPoolExecutor
+
+
+class Batch_Pipeline():
+    '''
+    Send batches to a function such as `AGO.edit_features()` from a pool of
+    threads, with at most `concurrent` batches in flight, while the calling
+    thread formats and projects the rows of the next batch. `submit()` blocks
+    once `concurrent` batches are in flight, so at most one more batch is held
+    in memory, and raises the error of any batch that has failed so that no
+    more rows are formatted. `close()` waits for the batches in flight and
+    raises the first error, if any. Used as a context manager, it's closed on
+    exit, and if the block raises, the batches in flight are waited for rather
+    than left sending edits after the command has failed:
+    ```
+    with Batch_Pipeline(ago.edit_features, concurrent=4) as batches:
+        batches.submit(rows=adds, row_count=row_count, method='adds')
+    ```
+
+    With concurrent = 1 (the default for AGO) batches are sent from the calling
+    thread, one at a time, exactly as before.
+    '''
+    def __init__(self, send, concurrent:int=1):
+        if concurrent < 1:
+            raise ValueError(f'concurrent must be at least 1, got {concurrent}')
+        self.send = send
+        self.concurrent = concurrent
+        self.submitted = 0
+        self._failures = []
+        self._executor = None
+        if concurrent > 1:
+            self._in_flight = threading.BoundedSemaphore(concurrent)
+            self._executor = ThreadPoolExecutor(max_workers=concurrent, thread_name_prefix='batch')
+
+    def submit(self, *args, **kwargs):
+        self.submitted += 1
+        if self._executor is None:
+            return self.send(*args, **kwargs)
+        self._in_flight.acquire()
+        if self._failures:
+            self._in_flight.release()
+            raise self._failures[0]
+        future = self._executor.submit(self.send, *args, **kwargs)
+        future.add_done_callback(self._done)
+
+    def _done(self, future):
+        if future.exception() is not None:
+            self._failures.append(future.exception())
+        self._in_flight.release()
+
+    def close(self):
+        if self._executor is not None:
+            self._executor.shutdown(wait=True)
+        if self._failures:
+            raise self._failures[0]
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, type, value, traceback):
+        if type is None:
+            self.close()
+        elif self._executor is not None:
+            self._executor.shutdown(wait=True)
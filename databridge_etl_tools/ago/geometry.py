@@ -0,0 +1,95 @@
+import math
+
+# Decimal places of Esri's default xy resolution, for layers that don't report their
+# xy tolerance: 0.0001 in projected units (meters or feet), 0.000000001 degrees
+PROJECTED_DECIMALS = 4
+GEOGRAPHIC_DECIMALS = 9
+
+
+def default_decimals(wkid:int) -> int:
+    '''Return the decimal places of the default xy resolution for a spatial reference'''
+    import pyproj
+    if pyproj.CRS.from_epsg(int(wkid)).is_geographic:
+        return GEOGRAPHIC_DECIMALS
+    return PROJECTED_DECIMALS
+
+def resolution_decimals(xy_tolerance:float) -> int:
+    '''Return the decimal places of a layer's xy resolution, which is a tenth of its
+    xy tolerance by default: coordinates are snapped to it when AGO stores them,
+    so rounding to it first changes nothing that is stored'''
+    return max(0, math.ceil(-math.log10(xy_tolerance / 10)))
+
+
+class Geometry_Encoder():
+    '''
+    Turn projected shapes, see `AGO.project_and_format_shapes()`, into the Esri
+    JSON geometries that `AGO.edit_features()` sends:
+    https://developers.arcgis.com/documentation/common-data-types/geometry-objects.htm
+
+    Every geometry refers to the same spatial reference dict, with both Esri's wkid
+    and its latestWkid (see `AGO.ago_srid`), rather than each row allocating its own. `compact_parts()` rounds coordinates to precision
+    decimal places and, with generalize, simplifies paths and rings with the
+    Douglas-Peucker algorithm to that tolerance (in the layer's units), so that
+    batches are smaller to serialize and send. By default coordinates are sent
+    at full precision and shapes aren't generalized, as before.
+    '''
+    EMPTY = {'esriGeometryPoint': {"x": 'NaN', "y": 'NaN'},
+             'esriGeometryPolyline': {"paths": []},
+             'esriGeometryPolygon': {"rings": []}}
+
+    def __init__(self, geometry_type:str, wkid:int, latest_wkid:int, precision:int=None,
+                 generalize:float=None):
+        self.geometry_type = geometry_type
+        self.spatial_reference = {"wkid": wkid, "latestWkid": latest_wkid}
+        self.precision = precision
+        self.generalize = generalize
+
+    def empty(self) -> dict:
+        '''The geometry sent for blank shapes and values like "POINT EMPTY"'''
+        if self.geometry_type not in self.EMPTY:
+            raise TypeError(f'Unexpected geomtry type!: {self.geometry_type}')
+        return {**self.EMPTY[self.geometry_type], "spatial_reference": self.spatial_reference}
+
+    def encode(self, wkt:str, projected) -> dict:
+        '''Return the geometry of a WKT shape (without "SRID="), from its projected
+        coordinates'''
+        if not wkt.strip() or 'EMPTY' in wkt:
+            return self.empty()
+        if 'MULTIPOINT' in wkt:
+            raise NotImplementedError("MULTIPOINTs not implemented yet..")
+        elif 'POINT' in wkt:
+            x, y = projected
+            return {"x": x, "y": y, "spatial_reference": self.spatial_reference}
+        elif 'MULTIPOLYGON' in wkt:
+            return {"rings": projected, "spatial_reference": self.spatial_reference}
+        elif 'POLYGON' in wkt:
+            return {"rings": [projected], "spatial_reference": self.spatial_reference}
+        # Multilinestrings are already a list of paths
+        elif 'MULTILINESTRING' in wkt:
+            return {"paths": projected, "spatial_reference": self.spatial_reference}
+        elif 'LINESTRING' in wkt:
+            return {"paths": [projected], "spatial_reference": self.spatial_reference}
+        raise AssertionError(f'Unexpected/unreadable geometry value: {wkt}')
+
+    def compact_parts(self, coords, part_sizes) -> list:
+        '''Split an (n, 2) numpy array of coordinates into lists of [x, y] by
+        part_sizes, generalized and rounded'''
+        import numpy as np
+        parts = np.split(coords, np.cumsum(part_sizes)[:-1])
+        if self.generalize:
+            parts = [self.generalize_part(part) for part in parts]
+        if self.precision is not None:
+            parts = [np.round(part, self.precision) for part in parts]
+        return [part.tolist() for part in parts]
+
+    def generalize_part(self, part):
+        '''Simplify a path or ring, keeping it as it is if it would collapse'''
+        if len(part) <= 2:
+            return part
+        import numpy as np
+        from shapely.geometry import LineString
+        closed = bool((part[0] == part[-1]).all())
+        simplified = np.asarray(LineString(part).simplify(self.generalize, preserve_topology=False).coords)
+        if len(simplified) < (4 if closed else 2):
+            return part
+        return simplified
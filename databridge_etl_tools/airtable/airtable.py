@@ -6,8 +6,8 @@ import json
 
 import requests
 import click
-import boto3
 from hurry.filesize import size
+from .. import s3_transfer, metrics
 
 
 class Airtable():
@@ -77,17 +77,19 @@ class Airtable():
                 request_stmt = request_stmt + '&fields%5B%5D=' + field
 
 
-        response = requests.get(
-            request_stmt,
-            headers={
-                'Authorization': f'Bearer {self.pat_token}'
-            },
-            params={
-                'offset': offset
-            }, 
-        timeout=60)
-        
-        data = response.json()
+        with metrics.span('api', log=False) as span:
+            response = requests.get(
+                request_stmt,
+                headers={
+                    'Authorization': f'Bearer {self.pat_token}'
+                },
+                params={
+                    'offset': offset
+                }, 
+            timeout=60)
+            
+            data = response.json()
+            span.rows = len(data.get('records') or [])
         yield data['records']
         
         if 'offset' in data: 
@@ -111,8 +113,8 @@ class Airtable():
         return row
 
     def load_to_s3(self):
-        s3 = boto3.resource('s3')
-        s3.Object(self.s3_bucket, self.s3_key).put(Body=open(self.csv_path, 'rb'))
+        s3_transfer.upload_file(self.csv_path, self.s3_bucket, self.s3_key, 
+                                compression=s3_transfer.compression_for(self.s3_key))
 
     def clean_up(self) -> None:
         if os.path.isfile(self.csv_path):
@@ -122,7 +124,7 @@ class Airtable():
         
         fieldnames = self.get_fieldnames()
 
-        with open(self.csv_path, 'w', newline='') as f:
+        with metrics.span('extract', rows=0) as span, open(self.csv_path, 'w', newline='') as f:
             writer = csv.DictWriter(f, fieldnames=fieldnames)
 
             writer.writeheader()
@@ -131,6 +133,7 @@ class Airtable():
                 for record in records_batch:
                     row = self.process_row(record['fields'])
                     writer.writerow(row)
+                span.rows += len(records_batch)
 
         num_lines = sum(1 for _ in open(self.csv_path)) - 1
         assert num_lines > 0, 'CSV file contains 0 lines??'
@@ -1,4 +1,4 @@
-from .. import utils
+from .. import utils, metrics
 from .airtable import Airtable
 import click
 
@@ -13,6 +13,7 @@ import click
 @click.option('--add_objectid', required=False, is_flag=True, help='Adds an objectid to the CSV')
 @click.option('--get_fields', required=False, help='Fields you want to extract, comma separated string.')
 def airtable(ctx, **kwargs):
+    metrics.set_labels(table=kwargs['table_name'])
     ctx.obj = Airtable(**kwargs)
 
 @airtable.command()
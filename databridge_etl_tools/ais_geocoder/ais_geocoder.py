@@ -1,8 +1,7 @@
 import sys, csv
-from smart_open import open as smopen
-import boto3
 from hurry.filesize import size
 from .ais_request import ais_request
+from .. import metrics
 
 csv.field_size_limit(sys.maxsize)
 
@@ -38,6 +37,8 @@ class AIS_Geocoder():
 
 
     def ais_inner_geocode(self):
+        import boto3
+        from smart_open import open as smopen
 
         out_rows = None
         session = boto3.Session()
@@ -68,7 +69,8 @@ class AIS_Geocoder():
                     result = None
 
                     if not result:
-                        result = ais_request(self.ais_url, self.ais_key, self.ais_user, query_elements, self.srid)
+                        with metrics.span('api', rows=1, log=False):
+                            result = ais_request(self.ais_url, self.ais_key, self.ais_user, query_elements, self.srid)
 
                     if result and 'features' in result and len(result['features']) > 0:
 
@@ -1,5 +1,5 @@
 from .ais_geocoder import AIS_Geocoder
-from .. import utils
+from .. import utils, metrics
 import click
 
 
@@ -17,6 +17,7 @@ import click
 @click.option('--srid', default=4326, type=int, help='SRID of geom to request.')
 def ais_geocoder(ctx, **kwargs):
     "Run geocoding or grabs additional fields from AIS"
+    metrics.set_labels(table=kwargs['s3_output_key'])
     ctx.obj = AIS_Geocoder(**kwargs)
 
 @ais_geocoder.command()
@@ -5,14 +5,9 @@ import os
 import re
 import json
 
-from carto.sql import SQLClient
-from carto.auth import APIKeyAuthClient
-from carto.exceptions import CartoException
-from carto.datasets import DatasetManager
-from carto.auth import APIKeyAuthClient
-import boto3
 import requests
 import petl as etl
+from .. import s3_transfer, parquet, metrics
 
 
 csv.field_size_limit(sys.maxsize)
@@ -89,9 +84,9 @@ class Carto():
     def json_schema_s3_key(self):
         if self._json_schema_s3_key is None:
             print('No json schema arg passed, assuming name matches the csv name..')
-            asplit = self.s3_key.split('/')
+            asplit = s3_transfer.strip_compression_suffix(self.s3_key).split('/')
             json_schema_s3_key = 'schemas/' + '/'.join(asplit[1:])
-            self._json_schema_s3_key = json_schema_s3_key.replace('.csv', '.json')
+            self._json_schema_s3_key = json_schema_s3_key.replace('.csv', '.json').replace('.parquet', '.json')
         return self._json_schema_s3_key
 
 
@@ -107,6 +102,9 @@ class Carto():
     def conn(self):
         if self._conn is None:
             self.logger.info('Making connection to Carto {} account...'.format(self.user))
+            from carto.sql import SQLClient
+            from carto.auth import APIKeyAuthClient
+            from carto.exceptions import CartoException
             try:
                 api_key = self.api_key
                 base_url = USR_BASE_URL.format(user=self.user)
@@ -234,9 +232,8 @@ class Carto():
     def get_json_schema_from_s3(self):
         self.logger.info('Fetching json schema: s3://{}/{}'.format(self.s3_bucket, self.json_schema_s3_key))
 
-        s3 = boto3.resource('s3')
         try:
-            s3.Object(self.s3_bucket, self.json_schema_s3_key).download_file(self.json_schema_path)
+            s3_transfer.download_file(self.s3_bucket, self.json_schema_s3_key, self.json_schema_path)
         except Exception as e:
             if 'HeadObject operation: Not Found' in str(e):
                 msg = f'Json schema file does not exist in S3! Please use databridge-etl-tools "extract-json-schema" command and place the file here: s3:/{self.s3_bucket}/{self.json_schema_s3_key}'
@@ -250,8 +247,7 @@ class Carto():
     def get_csv_from_s3(self):
         self.logger.info('Fetching csv s3://{}/{}'.format(self.s3_bucket, self.s3_key))
 
-        s3 = boto3.resource('s3')
-        s3.Object(self.s3_bucket, self.s3_key).download_file(self.csv_path)
+        s3_transfer.download_file(self.s3_bucket, self.s3_key, self.csv_path)
 
         self.logger.info('CSV successfully downloaded.\n'.format(self.s3_bucket, self.s3_key))
 
@@ -323,11 +319,17 @@ class Carto():
 
     def write(self):
         self.get_csv_from_s3()
-        try:
-            rows = etl.fromcsv(self.csv_path, encoding='utf-8')
-        except UnicodeError:
-            self.logger.info("Exception encountered trying to import rows with utf-8 encoding, trying latin-1...")
-            rows = etl.fromcsv(self.csv_path, encoding='latin-1')
+        # Compressed staging files are decompressed as they're read, Parquet staging 
+        # files are read in record batches
+        if parquet.is_parquet_file(self.csv_path):
+            rows = parquet.Parquet_View(self.csv_path)
+        else:
+            source = s3_transfer.read_source(self.csv_path)
+            try:
+                rows = etl.fromcsv(source, encoding='utf-8')
+            except UnicodeError:
+                self.logger.info("Exception encountered trying to import rows with utf-8 encoding, trying latin-1...")
+                rows = etl.fromcsv(source, encoding='latin-1')
         header = rows[0]
         str_header = ''
         num_fields = len(header)
@@ -345,11 +347,13 @@ class Carto():
         #    rows = rows.convert(self.geom_field,
         #                lambda c: 'SRID={srid};{geom}'.format(srid=self.geom_srid, geom=c) if c else '')
         write_file = self.temp_csv_path
-        rows.tocsv(write_file)
+        with metrics.span('prepare', rows=self._num_rows_in_upload_file):
+            rows.tocsv(write_file)
         q = "COPY {table_name} ({header}) FROM STDIN WITH (FORMAT csv, HEADER true)".format(
             table_name=self.temp_table_name, header=str_header)
         url = USR_BASE_URL.format(user=self.user) + 'api/v2/sql/copyfrom'
-        with open(write_file, 'rb') as f:
+        with open(write_file, 'rb') as f, metrics.span('copy', rows=self._num_rows_in_upload_file, 
+                                                       bytes=os.path.getsize(write_file)):
             r = requests.post(url, params={'api_key': self.api_key, 'q': q}, data=f, stream=True, timeout=60)
 
             if r.status_code != 200:
@@ -385,12 +389,14 @@ class Carto():
 
     def cartodbfytable(self):
         self.logger.info('Cartodbfytable\'ing table: {}'.format(self.temp_table_name))
-        self.execute_sql("select cdb_cartodbfytable('{}', '{}');".format(self.user, self.temp_table_name))
+        with metrics.span('cartodbfy'):
+            self.execute_sql("select cdb_cartodbfytable('{}', '{}');".format(self.user, self.temp_table_name))
         self.logger.info('Successfully Cartodbyfty\'d table.\n')
 
     def vacuum_analyze(self):
         self.logger.info('Vacuum analyzing table: {}'.format(self.temp_table_name))
-        self.execute_sql('VACUUM ANALYZE "{}";'.format(self.temp_table_name))
+        with metrics.span('vacuum'):
+            self.execute_sql('VACUUM ANALYZE "{}";'.format(self.temp_table_name))
         self.logger.info('Vacuum analyze complete.\n')
 
     def generate_select_grants(self):
@@ -431,12 +437,15 @@ class Carto():
 
         self.logger.info('Swapping temporary and production tables...')
         self.logger.info(stmt)
-        self.execute_sql(stmt)
+        with metrics.span('swap'):
+            self.execute_sql(stmt)
         if self.index_fields:
             self.confirm_indexes(self.table_name)
 
     # Force privacy settings because carto is unreliable about privacy
     def enforce_privacy(self):
+        from carto.auth import APIKeyAuthClient
+        from carto.datasets import DatasetManager
         auth_client = APIKeyAuthClient(
                 api_key=self.api_key,
                 base_url=USR_BASE_URL.format(user=self.user)
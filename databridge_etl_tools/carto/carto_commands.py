@@ -1,4 +1,5 @@
 from .carto_ import Carto
+from .. import metrics
 import click
 
 @click.group()
@@ -12,6 +13,7 @@ import click
 @click.option('--index_fields', required=False, default=None)
 def carto(ctx, **kwargs):
     '''Run ETL commands for Carto'''
+    metrics.set_labels(table=kwargs['table_name'])
     ctx.obj = Carto(**kwargs)
 
 @carto.command()
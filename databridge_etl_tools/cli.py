@@ -1,26 +1,57 @@
+import importlib
 import click
 
-from .ago.ago_commands import ago
-from .carto.carto_commands import carto
-from .oracle.oracle_commands import oracle
-from .db2.db2_commands import db2
-from .opendata.opendata_commands import opendata
-from .postgres.postgres_commands import postgres
-from .knack.knack_commands import knack
-from .airtable.airtable_commands import airtable
-from .ais_geocoder.ais_geocoder_commands import ais_geocoder
-
-@click.group()
-def main():
-    pass
-
-main.add_command(ago)
-main.add_command(carto)
-main.add_command(db2)
-main.add_command(oracle)
-main.add_command(opendata)
-main.add_command(postgres)
-main.add_command(knack)
-main.add_command(airtable)
-main.add_command(ais_geocoder)
+from . import metrics
 
+
+class Lazy_Group(click.Group):
+    '''
+    click group whose subcommands are only imported when they're run (or their
+    help is shown). lazy_subcommands maps each command name to the
+    "module:attribute" of its click group, so that e.g. `postgres extract` doesn't
+    import arcgis, cx_Oracle and carto along with every other command.
+    '''
+    def __init__(self, *args, lazy_subcommands:dict=None, **kwargs):
+        super().__init__(*args, **kwargs)
+        self.lazy_subcommands = lazy_subcommands or {}
+
+    def list_commands(self, ctx):
+        return sorted(set(super().list_commands(ctx)) | set(self.lazy_subcommands))
+
+    def get_command(self, ctx, cmd_name):
+        if cmd_name in self.lazy_subcommands and cmd_name not in self.commands:
+            self.add_command(self._load(cmd_name), cmd_name)
+        return super().get_command(ctx, cmd_name)
+
+    def _load(self, cmd_name):
+        module_name, attribute = self.lazy_subcommands[cmd_name].split(':')
+        command = getattr(importlib.import_module(module_name, __package__), attribute)
+        if not isinstance(command, click.Command):
+            raise ValueError(f'{self.lazy_subcommands[cmd_name]} is not a click command')
+        return command
+
+
+@click.group(cls=Lazy_Group, lazy_subcommands={
+    'ago':          '.ago.ago_commands:ago',
+    'carto':        '.carto.carto_commands:carto',
+    'db2':          '.db2.db2_commands:db2',
+    'oracle':       '.oracle.oracle_commands:oracle',
+    'opendata':     '.opendata.opendata_commands:opendata',
+    'postgres':     '.postgres.postgres_commands:postgres',
+    'knack':        '.knack.knack_commands:knack',
+    'airtable':     '.airtable.airtable_commands:airtable',
+    'ais-geocoder': '.ais_geocoder.ais_geocoder_commands:ais_geocoder',
+})
+@click.pass_context
+@click.option('--metrics_file', required=False, help='''
+    File to write per-stage timings and throughput to when the command ends. With the 
+    json format a line is appended for every run; with the prometheus format the file 
+    is replaced, for the node_exporter textfile collector.''')
+@click.option('--metrics_format', type=click.Choice(metrics.FORMATS), default='json', 
+        required=False, show_default=True)
+@click.option('--statsd_address', required=False, help='''
+    host:port of a StatsD server to send per-stage timings and throughput to when the 
+    command ends.''')
+def main(ctx, metrics_file, metrics_format, statsd_address):
+    metrics.configure(metrics_file, metrics_format, statsd_address)
+    ctx.call_on_close(metrics.flush)
@@ -4,8 +4,8 @@ import click
 import json
 import psycopg2
 import psycopg2.extras
-import cx_Oracle
 import re
+from .. import metrics, pg_indexes
 
 
 class Db2():
@@ -88,6 +88,7 @@ class Db2():
     @property
     def oracle_cursor(self):
         if self._oracle_cursor is None: 
+            import cx_Oracle
             conn = cx_Oracle.connect(self.oracle_conn_string)
             conn.autocommit = True
             self._oracle_cursor = conn.cursor()
@@ -355,8 +356,11 @@ class Db2():
         self.generate_ddl()
         self.run_ddl()
 
-    def copy_to_enterprise(self):
-        ''''Copy from either department table or etl_staging temp table, depending on args passed.'''
+    def copy_to_enterprise(self, defer_indexes=False):
+        ''''Copy from either department table or etl_staging temp table, depending on args passed.
+        If defer_indexes, drop the enterprise table's indexes (other than its primary key) before
+        the insert and build them again after it in the same transaction, which blocks readers of
+        the enterprise table until it commits, see pg_indexes.'''
         
         prod_table = f'{self.enterprise_schema}.{self.enterprise_dataset_name}'
         # If etl_staging, that means we got data uploaded from S3 or an ArcPy copy
@@ -546,19 +550,27 @@ class Db2():
             self.logger.info('\nTable not registered.\n')
 
         try:
-            update_stmt = f'''
-                BEGIN;
+            delete_insert_stmt = f'''
                     -- Truncate our table (won't show until commit) 
                     DELETE FROM {prod_table};
                     INSERT INTO {prod_table} ({staging_columns_str})
                         SELECT {enterprise_columns_str}
                         FROM {stage_table};
-                END;
+                '''
+            update_stmt = f'''
+                BEGIN;{delete_insert_stmt}END;
                 '''
             self.logger.info("Running update_stmt: " + str(update_stmt))
             self.remove_locks(self.enterprise_dataset_name, self.enterprise_schema, lock_type='AccessExclusiveLock')
-            self.pg_cursor.execute(update_stmt)
-            self.pg_cursor.execute('COMMIT;')
+            with metrics.span('swap'):
+                if defer_indexes:
+                    # Drop, insert and rebuild all in the transaction psycopg2 opens
+                    with pg_indexes.Deferred_Indexes(self.pg_cursor, self.enterprise_schema,
+                                                     self.enterprise_dataset_name, self.logger):
+                        self.pg_cursor.execute(delete_insert_stmt)
+                else:
+                    self.pg_cursor.execute(update_stmt)
+                self.pg_cursor.execute('COMMIT;')
         except psycopg2.Error as e:
             self.logger.error(f'Error truncating and inserting into enterprise! Error: {str(e)}')
             self.pg_cursor.execute('ROLLBACK;')
@@ -571,8 +583,9 @@ class Db2():
         #    self.pg_cursor.execute('COMMIT')
 
         # Manually run a vacuum on our tables for database performance
-        self.pg_cursor.execute(f'VACUUM VERBOSE {self.enterprise_schema}.{self.enterprise_dataset_name}')
-        self.pg_cursor.execute('COMMIT')
+        with metrics.span('vacuum'):
+            self.pg_cursor.execute(f'VACUUM VERBOSE {self.enterprise_schema}.{self.enterprise_dataset_name}')
+            self.pg_cursor.execute('COMMIT')
 
         # Run a quick select statement to test, use objectid if available
         if oid_column:
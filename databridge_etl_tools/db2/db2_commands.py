@@ -1,5 +1,5 @@
 from .db2 import Db2
-from .. import utils
+from .. import utils, metrics
 import click
 
 @click.group()
@@ -10,19 +10,28 @@ import click
 @click.option('--libpq_conn_string', required=True)
 def db2(ctx, **kwargs):
     '''Run ETL commands for DB2'''
+    metrics.set_labels(table=f"{kwargs['enterprise_schema']}.{kwargs['table_name']}")
     ctx.obj = {}
     ctx = utils.pass_params_to_ctx(ctx, **kwargs)
 
 @db2.command()
 @click.pass_context
-def copy_dept_to_enterprise(ctx, **kwargs):
+@click.option('--defer_indexes', is_flag=True, required=False, help='''
+    Drop the enterprise table's indexes (other than its primary key) before the insert 
+    and build them again after it, in the same transaction. Blocks every reader of 
+    the enterprise table until the transaction commits.''')
+def copy_dept_to_enterprise(ctx, defer_indexes, **kwargs):
     """Copy from the dept table directly to an enterpise able in a single transaction that can roll back if it fails."""
     db2 = Db2(**ctx.obj, **kwargs, copy_from_source_schema=ctx.obj['account_name'])
-    db2.copy_to_enterprise()
+    db2.copy_to_enterprise(defer_indexes=defer_indexes)
 
 @db2.command()
 @click.pass_context
-def copy_staging_to_enterprise(ctx, **kwargs):
+@click.option('--defer_indexes', is_flag=True, required=False, help='''
+    Drop the enterprise table's indexes (other than its primary key) before the insert 
+    and build them again after it, in the same transaction. Blocks every reader of 
+    the enterprise table until the transaction commits.''')
+def copy_staging_to_enterprise(ctx, defer_indexes, **kwargs):
     """Copies from etl_staging to the specified enterprise authoritative dataset."""
     db2 = Db2(**ctx.obj, **kwargs, copy_from_source_schema='etl_staging')
-    db2.copy_to_enterprise()
+    db2.copy_to_enterprise(defer_indexes=defer_indexes)
@@ -3,10 +3,10 @@ import requests
 import csv
 import json
 import os,sys
-import boto3
 import stringcase
 from datetime import datetime
 from hurry.filesize import size
+from .. import s3_transfer, metrics
 
 csv.field_size_limit(sys.maxsize)
 
@@ -96,18 +96,20 @@ class Knack():
         return self.convert_knack_schema(data['fields'])
 
     def get_records(self, page=1, rows_per_page=1000):
-        response = requests.get(
-            f'https://api.knack.com/v1/objects/{self.knack_objectid}/records',
-            params={
-                'rows_per_page': rows_per_page,
-                'page': page
-            },
-            headers={
-                'X-Knack-Application-Id': self.app_id,
-                'X-Knack-REST-API-KEY':  self.api_key
-            }, timeout=60)
-
-        data = response.json()
+        with metrics.span('api', log=False) as span:
+            response = requests.get(
+                f'https://api.knack.com/v1/objects/{self.knack_objectid}/records',
+                params={
+                    'rows_per_page': rows_per_page,
+                    'page': page
+                },
+                headers={
+                    'X-Knack-Application-Id': self.app_id,
+                    'X-Knack-REST-API-KEY':  self.api_key
+                }, timeout=60)
+
+            data = response.json()
+            span.rows = len(data.get('records') or [])
 
         if not data['records']:
             raise Exception(f"Failed to fetch data. Status Code: {response.status_code}. Reason: {response.text}")
@@ -156,8 +158,8 @@ class Knack():
 
 
     def load_to_s3(self):
-        s3 = boto3.resource('s3')
-        s3.Object(self.s3_bucket, self.s3_key).put(Body=open(self.csv_path, 'rb'))
+        s3_transfer.upload_file(self.csv_path, self.s3_bucket, self.s3_key, 
+                                compression=s3_transfer.compression_for(self.s3_key))
 
     def extract(self):
         schema = self.get_schema()
@@ -170,7 +172,7 @@ class Knack():
         for field in schema['fields']:
             headers.append(field['name'])
  
-        with open(self.csv_path, 'w', newline='') as f:
+        with metrics.span('extract', rows=0) as span, open(self.csv_path, 'w', newline='') as f:
             writer = csv.DictWriter(f, fieldnames=headers)
 
             writer.writeheader()
@@ -179,6 +181,7 @@ class Knack():
                 for record in records_batch:
                     out_record = self.convert_to_csv_row(schema, record)
                     writer.writerow(out_record)
+                span.rows += len(records_batch)
                     
         num_lines = sum(1 for _ in open(self.csv_path)) - 1
         assert num_lines > 0, 'CSV file contains 0 lines??'
@@ -1,5 +1,5 @@
 from .knack import Knack
-from .. import utils
+from .. import utils, metrics
 import click
 
 
@@ -12,6 +12,7 @@ import click
 @click.option('--s3_key', required=True, help='key under the bucket, example: "staging/dept/table_name.csv')
 @click.option('--indent', type=int, default=None, help='???')
 def knack(ctx, **kwargs):
+    metrics.set_labels(table=kwargs['knack_objectid'])
     ctx.obj = Knack(**kwargs)
 
 @knack.command()
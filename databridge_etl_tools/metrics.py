@@ -0,0 +1,282 @@
+'''
+Per-stage timing and throughput. Wrap a stage of a command in a span
+```
+with metrics.span('copy', rows=row_count) as s:
+    ...
+    s.rows = cursor.rowcount
+```
+and its wall time, rows and bytes are added to a per-process recorder, keyed by
+stage and labels (e.g. the table). Spans are cheap enough to wrap per-row work
+such as geometry projection; pass log=False there so each one isn't logged.
+
+At the end of a CLI command the recorder is written out if asked for (see the
+--metrics_file, --metrics_format and --statsd_address options of `main`):
+    - json: one JSON object per run appended to the file, so it can be trended
+    - prometheus: a node_exporter textfile collector file, replaced on every run
+    - statsd: timers and counters sent over UDP to host:port
+'''
+import os
+import re
+import sys
+import json
+import time
+import socket
+import logging
+import threading
+from contextlib import contextmanager
+from datetime import datetime, timezone
+
+FORMATS = ('json', 'prometheus')
+PREFIX = 'dbtools'
+
+
+def get_logger():
+    logger = logging.getLogger(__name__)
+    logger.setLevel(logging.INFO)
+    if logger.handlers == []:
+        sh = logging.StreamHandler(sys.stdout)
+        logger.addHandler(sh)
+    return logger
+
+
+class Span():
+    '''One timed stage. rows and bytes may be set while the span is open.'''
+    __slots__ = ('stage', 'labels', 'rows', 'bytes', 'seconds')
+
+    def __init__(self, stage:str, labels:dict, rows:int=None, bytes:int=None):
+        self.stage = stage
+        self.labels = labels
+        self.rows = rows
+        self.bytes = bytes
+        self.seconds = None
+
+    def describe(self) -> str:
+        text = f'{self.stage}: {self.seconds:,.2f}s'
+        if self.rows is not None:
+            text += f', {self.rows:,} rows ({_rate(self.rows, self.seconds):,.0f}/s)'
+        if self.bytes is not None:
+            text += f', {self.bytes / 1024 / 1024:,.1f} MB ({_rate(self.bytes, self.seconds) / 1024 / 1024:,.1f} MB/s)'
+        return text
+
+
+def _rate(amount:int, seconds:float) -> float:
+    return amount / seconds if seconds else 0.0
+
+
+class Recorder():
+    '''
+    Thread-safe totals of every span recorded in this process, per stage and
+    labels: the number of spans, their seconds, rows and bytes, and how many
+    raised.
+    '''
+    def __init__(self):
+        self.labels = {}
+        self.command = None
+        self.started = datetime.now(timezone.utc)
+        self._stages = {}
+        self._lock = threading.Lock()
+        self._local = threading.local()
+
+    def current_labels(self) -> dict:
+        return {**self.labels, **getattr(self._local, 'labels', {})}
+
+    @contextmanager
+    def labelled(self, **labels):
+        '''Add labels to the spans opened by this thread inside the block'''
+        previous = getattr(self._local, 'labels', {})
+        self._local.labels = {**previous, **labels}
+        try:
+            yield
+        finally:
+            self._local.labels = previous
+
+    def add(self, span:'Span', failed:bool=False):
+        key = (span.stage, tuple(sorted(span.labels.items())))
+        with self._lock:
+            totals = self._stages.setdefault(key, {'count': 0, 'seconds': 0.0, 'rows': None,
+                                                   'bytes': None, 'errors': 0})
+            totals['count'] += 1
+            totals['seconds'] += span.seconds
+            totals['errors'] += failed
+            for name in ('rows', 'bytes'):
+                value = getattr(span, name)
+                if value is not None:
+                    totals[name] = (totals[name] or 0) + value
+
+    def stages(self) -> list:
+        '''Return the totals of each stage, with rows and bytes per second'''
+        with self._lock:
+            items = [(key, dict(totals)) for key, totals in self._stages.items()]
+        stages = []
+        for (stage, labels), totals in items:
+            entry = {'stage': stage, 'labels': dict(labels), **totals}
+            entry['seconds'] = round(entry['seconds'], 6)
+            for name in ('rows', 'bytes'):
+                if entry[name] is not None:
+                    entry[f'{name}_per_second'] = round(_rate(entry[name], totals['seconds']), 3)
+            stages.append(entry)
+        return stages
+
+    def clear(self):
+        with self._lock:
+            self._stages = {}
+
+
+recorder = Recorder()
+_outputs = {'metrics_file': None, 'metrics_format': 'json', 'statsd_address': None}
+
+
+def set_labels(**labels):
+    '''Label every span recorded from now on, e.g. `set_labels(table='citygeo.table_a')`'''
+    recorder.labels.update({name: value for name, value in labels.items() if value is not None})
+
+def labels(**labels):
+    '''Context manager that labels the spans opened by the current thread inside it,
+    for work on several tables in one process'''
+    return recorder.labelled(**labels)
+
+
+@contextmanager
+def span(stage:str, rows:int=None, bytes:int=None, log:bool=True, **labels):
+    '''Time a stage, see the module docstring. Extra keyword arguments are labels.'''
+    if recorder.command is None:
+        _set_command()
+    s = Span(stage, {**recorder.current_labels(), **labels}, rows, bytes)
+    start = time.perf_counter()
+    failed = False
+    try:
+        yield s
+    except BaseException:
+        failed = True
+        raise
+    finally:
+        s.seconds = time.perf_counter() - start
+        recorder.add(s, failed)
+        if log and not failed:
+            get_logger().info(f'Stage {s.describe()}\n')
+
+def _set_command():
+    '''Record the CLI command (e.g. "postgres load") the first spans run under'''
+    import click
+    ctx = click.get_current_context(silent=True)
+    if ctx is not None:
+        # Drop the program name from e.g. "databridge_etl_tools postgres load"
+        recorder.command = ctx.command_path.split(' ', 1)[-1]
+
+
+def configure(metrics_file:str=None, metrics_format:str='json', statsd_address:str=None):
+    '''Choose where `flush()` writes the recorded metrics'''
+    if metrics_format not in FORMATS:
+        raise ValueError(f'Metrics format {metrics_format} not recognized, expected one of {", ".join(FORMATS)}')
+    if statsd_address is not None and ':' not in statsd_address:
+        raise ValueError(f'StatsD address {statsd_address} should be host:port')
+    _outputs.update(metrics_file=metrics_file, metrics_format=metrics_format,
+                    statsd_address=statsd_address)
+
+
+def to_json(run_status:str='succeeded') -> dict:
+    return {
+        'command': recorder.command,
+        'labels': dict(recorder.labels),
+        'status': run_status,
+        'started': recorder.started.isoformat(),
+        'finished': datetime.now(timezone.utc).isoformat(),
+        'stages': recorder.stages(),
+    }
+
+def format_summary() -> str:
+    '''Return a plain text table of the recorded stages, slowest first'''
+    lines = [f'{"stage":<12} {"count":>8} {"seconds":>10} {"rows/s":>12} {"MB/s":>8}  labels']
+    for entry in sorted(recorder.stages(), key=lambda e: e['seconds'], reverse=True):
+        rows_per_second = entry.get('rows_per_second')
+        bytes_per_second = entry.get('bytes_per_second')
+        labels = ', '.join(f'{key}={value}' for key, value in entry['labels'].items())
+        lines.append(f'{entry["stage"]:<12} {entry["count"]:>8,} {entry["seconds"]:>10,.2f} '
+                     f'{"" if rows_per_second is None else f"{rows_per_second:,.0f}":>12} '
+                     f'{"" if bytes_per_second is None else f"{bytes_per_second / 1024 / 1024:,.1f}":>8}  {labels}')
+    return '\n'.join(lines)
+
+def _prometheus_name(name:str) -> str:
+    return re.sub(r'[^a-zA-Z0-9_]', '_', name)
+
+def _prometheus_value(value) -> str:
+    return str(value).replace('\\', r'\\').replace('"', r'\"').replace('\n', r'\n')
+
+def to_prometheus() -> str:
+    '''Render the recorded stages in the Prometheus text exposition format'''
+    metrics = {
+        'seconds': 'Wall time spent in the stage',
+        'rows': 'Rows handled by the stage',
+        'bytes': 'Bytes handled by the stage',
+        'rows_per_second': 'Rows per second of wall time',
+        'bytes_per_second': 'Bytes per second of wall time',
+        'count': 'Number of times the stage ran',
+        'errors': 'Number of times the stage raised',
+    }
+    stages = recorder.stages()
+    lines = []
+    for metric, description in metrics.items():
+        name = f'{PREFIX}_stage_{metric}'
+        samples = []
+        for entry in stages:
+            if entry.get(metric) is None:
+                continue
+            stage_labels = {'command': recorder.command or '', 'stage': entry['stage'], **entry['labels']}
+            text = ','.join(f'{_prometheus_name(key)}="{_prometheus_value(value)}"'
+                            for key, value in stage_labels.items())
+            samples.append(f'{name}{{{text}}} {entry[metric]}')
+        if samples:
+            lines += [f'# HELP {name} {description}', f'# TYPE {name} gauge', *samples]
+    lines += [f'# HELP {PREFIX}_last_run_timestamp_seconds When the run finished',
+              f'# TYPE {PREFIX}_last_run_timestamp_seconds gauge',
+              f'{PREFIX}_last_run_timestamp_seconds{{command="{_prometheus_value(recorder.command or "")}"}} {time.time():.0f}']
+    return '\n'.join(lines) + '\n'
+
+def _statsd_name(name:str) -> str:
+    return re.sub(r'[^a-zA-Z0-9_\-]', '_', str(name))
+
+def to_statsd() -> list:
+    '''Render the recorded stages as StatsD lines, named
+    dbtools.<command>.<label values>.<stage>.<metric>'''
+    lines = []
+    for entry in recorder.stages():
+        parts = [PREFIX, _statsd_name(recorder.command or 'none')]
+        parts += [_statsd_name(value) for value in entry['labels'].values()]
+        name = '.'.join(parts + [_statsd_name(entry['stage'])])
+        lines.append(f'{name}.time:{entry["seconds"] * 1000:.0f}|ms')
+        for metric in ('rows', 'bytes', 'errors'):
+            if entry.get(metric) is not None:
+                lines.append(f'{name}.{metric}:{entry[metric]}|c')
+    return lines
+
+def _send_statsd(address:str, lines:list):
+    host, port = address.rsplit(':', 1)
+    with socket.socket(socket.AF_INET, socket.SOCK_DGRAM) as sock:
+        for line in lines:
+            sock.sendto(line.encode(), (host, int(port)))
+
+def flush():
+    '''Write the recorded metrics to the configured outputs. Called as a click
+    close callback, where an exception that ended the command is still current.'''
+    run_status = 'failed' if sys.exc_info()[0] is not None else 'succeeded'
+    metrics_file, metrics_format = _outputs['metrics_file'], _outputs['metrics_format']
+    logger = get_logger()
+    if recorder.stages():
+        logger.info(f'Stage totals:\n{format_summary()}\n')
+    if metrics_file:
+        if metrics_format == 'json':
+            with open(metrics_file, 'a') as f:
+                f.write(json.dumps(to_json(run_status)) + '\n')
+        else:
+            # Write then rename, so the textfile collector never reads half a file
+            temp_file = f'{metrics_file}.{os.getpid()}.tmp'
+            with open(temp_file, 'w') as f:
+                f.write(to_prometheus())
+            os.replace(temp_file, metrics_file)
+        logger.info(f'Wrote {metrics_format} metrics to {metrics_file}\n')
+    if _outputs['statsd_address']:
+        try:
+            _send_statsd(_outputs['statsd_address'], to_statsd())
+        except OSError as e:
+            # Metrics shouldn't fail an otherwise successful run
+            logger.info(f'Could not send metrics to StatsD at {_outputs["statsd_address"]}: {e!r}\n')
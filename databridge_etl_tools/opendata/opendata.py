@@ -2,14 +2,12 @@ import logging
 import sys, os
 import csv
 import pytz
-import boto3,botocore
 import petl as etl
 import psycopg2
 import psycopg2.extras
-import pyproj
 import re
-from shapely import wkt
 import gzip, shutil
+from .. import s3_transfer, parquet, metrics
 
 
 class OpenData():
@@ -55,9 +53,10 @@ class OpenData():
     def download_csv_from_s3(self):
         self.logger.info('Fetching csv s3://{}/{}'.format(self.s3_bucket, self.s3_key))
 
-        s3 = boto3.resource('s3')
+        import botocore.exceptions
+
         try:
-            s3.Object(self.s3_bucket, self.s3_key).download_file(self.csv_path)
+            s3_transfer.download_file(self.s3_bucket, self.s3_key, self.csv_path)
         except botocore.exceptions.ClientError as e:
             if e.response['Error']['Code'] == "404":
                 raise AssertionError(f'CSV file doesnt appear to exist in S3! key: {self.s3_key}')
@@ -69,14 +68,55 @@ class OpenData():
         compress_filename = filename + '.gz'
         level = 7
         self.logger.info(f"Gzipping csv file into {compress_filename} with gzip, compression level: {level}")
-        with open(filename, 'rb') as f_in:
-            with gzip.open(filename=compress_filename, mode='wb', compresslevel=level) as f_out:
-                shutil.copyfileobj(f_in, f_out)
+        with metrics.span('compress', bytes=os.path.getsize(filename)):
+            with open(filename, 'rb') as f_in:
+                with gzip.open(filename=compress_filename, mode='wb', compresslevel=level) as f_out:
+                    shutil.copyfileobj(f_in, f_out)
         self.logger.info('Gzipped.')
 
     
+    def project_points(self, rows, from_srid:int, to_srid:int):
+        '''Project the EWKT point shapes of a petl table from from_srid to to_srid,
+        returning it with the shapes as WKT and "lat" and "lng" fields added'''
+        # Remove SRID= from shape field by splitting on semicolon, example shape:
+        # 'SRID=2272;POINT ( 2674485.16144665 240563.70777297)' 
+        rows = rows.convert('shape', lambda s: s.split(';')[1] if s else '')
+
+        import pyproj
+        from shapely import wkt
+
+        # project the dataset from the input srid to the correct srid that we want.
+        # Purposefully defined outside of function to speed up operations.
+        transformer = pyproj.Transformer.from_crs('epsg:{}'.format(from_srid), 'epsg:{}'.format(to_srid),
+                                                always_xy=True)
+
+        def project_shape(shape, from_srid, to_srid, transformer):
+            if from_srid == to_srid:
+                return shape
+            with metrics.span('project', rows=1, log=False):
+                pt = wkt.loads(shape)
+                x,y = transformer.transform(pt.x, pt.y)
+            if (not x) or (not y):
+                return ''
+            return f'POINT({x} {y})' 
+        
+        # project_shape will properly convert the coordinate system
+        rows = rows.convert('shape', lambda s: project_shape(s, from_srid, to_srid, transformer) if s else '')
+
+        # Extract lat/lng from shape TODO use shapely methods instead:
+        return rows \
+            .addfield('lat',
+                    lambda a: float(a['shape'].replace('POINT', '').split(' ')[0].replace('(', '').replace(')', '')) if a['shape'] else '') \
+            .addfield('lng',
+                    lambda a: float(a['shape'].replace('POINT', '').split(' ')[1].replace('(', '').replace(')', '')) if a['shape'] else '')
+
+
     def transform_and_upload_data(self):
-        rows = etl.fromcsv(self.csv_path, encoding='utf-8')
+        # Parquet staging files are read in record batches, with geometries as EWKT
+        if parquet.is_parquet_file(self.csv_path):
+            rows = parquet.Parquet_View(self.csv_path)
+        else:
+            rows = etl.fromcsv(s3_transfer.read_source(self.csv_path), encoding='utf-8')
 
         # make header (field names) lowercase
         header = rows[0]
@@ -209,33 +249,7 @@ class OpenData():
             from_srid = bad_srid_map.get(srid, srid)
             self.logger.info("from_srid: {}, to_srid: {}".format(from_srid, to_srid))
 
-            # Remove SRID= from shape field by splitting on semicolon, example shape:
-            # 'SRID=2272;POINT ( 2674485.16144665 240563.70777297)' 
-            rows = rows.convert('shape', lambda s: s.split(';')[1] if s else '')
-
-            # project the dataset from the input srid to the correct srid that we want.
-            # Purposefully defined outside of function to speed up operations.
-            transformer = pyproj.Transformer.from_crs('epsg:{}'.format(from_srid), 'epsg:{}'.format(to_srid),
-                                                    always_xy=True)
-
-            def project_shape(shape, from_srid, to_srid, transformer):
-                if from_srid == to_srid:
-                    return shape
-                pt = wkt.loads(shape)
-                x,y = transformer.transform(pt.x, pt.y)
-                if (not x) or (not y):
-                    return ''
-                return f'POINT({x} {y})' 
-            
-            # project_shape will properly convert the coordinate system
-            rows = rows.convert('shape', lambda s: project_shape(s, from_srid, to_srid, transformer) if s else '')
-
-            # Extract lat/lng from shape TODO use shapely methods instead:
-            rows_fmt = rows \
-                .addfield('lat',
-                        lambda a: float(a['shape'].replace('POINT', '').split(' ')[0].replace('(', '').replace(')', '')) if a['shape'] else '') \
-                .addfield('lng',
-                        lambda a: float(a['shape'].replace('POINT', '').split(' ')[1].replace('(', '').replace(')', '')) if a['shape'] else '')
+            rows_fmt = self.project_points(rows, from_srid, to_srid)
         else:
             rows_fmt = rows
 
@@ -244,21 +258,23 @@ class OpenData():
             rows_fmt = rows_fmt.cutout('{}'.format(geom_field.lower()))
 
         # Dump to the csv file
-        final_csv_path = self.csv_path.replace('.csv', '_final.csv')
-        rows_fmt.tocsv(final_csv_path, encoding='utf-8')
+        final_csv_path = os.path.splitext(self.csv_path)[0] + '_final.csv'
+        with metrics.span('prepare') as span:
+            rows_fmt.tocsv(final_csv_path, encoding='utf-8')
+            span.bytes = os.path.getsize(final_csv_path)
 
         print('CSV successfully transformed.')
 
-        file_name = self.s3_key.split('/')[2]
+        # Open data files are always plain CSV, whatever the staging format
+        file_name = os.path.splitext(s3_transfer.strip_compression_suffix(self.s3_key.split('/')[2]))[0] + '.csv'
 
-        s3 = boto3.resource('s3')
-        s3.Object(self.opendata_bucket, file_name).upload_file(final_csv_path)
+        s3_transfer.upload_file(final_csv_path, self.opendata_bucket, file_name)
         print(f'Uploaded {final_csv_path} to bucket {self.opendata_bucket} as {file_name}')
 
         self.compress_csv(final_csv_path)
-        s3.Object(self.opendata_bucket, file_name + '.gz').upload_file(final_csv_path + '.gz')
+        s3_transfer.upload_file(final_csv_path + '.gz', self.opendata_bucket, file_name + '.gz')
         # Also set as gzip for now, until I can have kistine change the filenames to the more proper ".gz"
-        s3.Object(self.opendata_bucket, file_name + '.gzip').upload_file(final_csv_path + '.gz')
+        s3_transfer.upload_file(final_csv_path + '.gz', self.opendata_bucket, file_name + '.gzip')
         print(f"Uploaded {final_csv_path + '.gz'} to bucket {self.opendata_bucket} as {file_name + '.gz'}")
 
 
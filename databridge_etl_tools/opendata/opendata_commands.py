@@ -1,4 +1,5 @@
 from .opendata import OpenData
+from .. import metrics
 import click
 
 @click.group()
@@ -11,6 +12,7 @@ import click
 @click.option('--opendata_bucket', required=True)
 def opendata(ctx, **kwargs):
     '''Run ETL commands for OpenData'''
+    metrics.set_labels(table=f"{kwargs['table_schema']}.{kwargs['table_name']}")
     ctx.obj = OpenData(**kwargs)
 
 @opendata.command()
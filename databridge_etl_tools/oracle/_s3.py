@@ -1,17 +1,20 @@
-import boto3
+from .. import s3_transfer
 
 def _interact_with_s3(self, method: str, path: str, s3_key: str): 
     '''
     - method should be one of "get", "load"
+    
+    Keys ending in e.g. ".csv.gz" or ".csv.zst" are compressed on upload; 
+    compressed objects are downloaded as they are, see `s3_transfer.read_source()`
     '''
     self.logger.info(f"{method.upper()}-ing file: s3://{self.s3_bucket}/{s3_key}")
 
-    s3 = boto3.resource('s3')
     if method == 'get': 
-        s3.Object(self.s3_bucket, s3_key).download_file(path)
+        s3_transfer.download_file(self.s3_bucket, s3_key, path)
         self.logger.info(f'File successfully downloaded from S3 to {path}\n')
     elif method == 'load': 
-        s3.Object(self.s3_bucket, s3_key).put(Body=open(path, 'rb'))
+        s3_transfer.upload_file(path, self.s3_bucket, s3_key, 
+                                compression=s3_transfer.compression_for(s3_key))
         self.logger.info(f'File successfully uploaded from {path} to S3\n')
 
 def get_json_schema_from_s3(self):
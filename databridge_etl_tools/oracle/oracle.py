@@ -3,11 +3,10 @@ import sys
 import os
 import csv
 import pytz
-import boto3
 import petl as etl
-import geopetl
 import json
 import hashlib
+from .. import utils, s3_transfer, parquet, metrics
 
 
 
@@ -126,53 +125,78 @@ class Oracle():
     def load_csv_to_s3(self):
         self.logger.info('Starting load to s3: {}'.format(self.s3_key))
 
-        s3 = boto3.resource('s3')
-        s3.Object(self.s3_bucket, self.s3_key).put(Body=open(self.csv_path, 'rb'))
+        s3_transfer.upload_file(self.csv_path, self.s3_bucket, self.s3_key, 
+                                compression=s3_transfer.compression_for(self.s3_key))
         
         self.logger.info('Successfully loaded to s3: {}'.format(self.s3_key))
 
     def load_json_schema_to_s3(self):
-        s3 = boto3.resource('s3')
-
+        # geopetl adds oracle_extract_table_schema() to petl when it's imported
+        import geopetl
         # load the schema into a tmp file in /tmp/
         etl.oracle_extract_table_schema(dbo=self.conn, table_name=self.schema_table_name, table_schema_output_path=self.json_schema_path)
-        json_s3_key = self.s3_key.replace('staging', 'schemas').replace('.csv', '.json')
-        s3.Object(self.s3_bucket, json_s3_key).put(Body=open(self.json_schema_path, 'rb'))
+        json_s3_key = s3_transfer.strip_compression_suffix(self.s3_key).replace('staging', 'schemas').replace('.csv', '.json').replace('.parquet', '.json')
+        s3_transfer.upload_file(self.json_schema_path, self.s3_bucket, json_s3_key)
         self.logger.info('Successfully loaded to s3: {}'.format(json_s3_key))
 
-    def check_remove_nulls(self):
+    @staticmethod
+    def scrub_patterns(encoding:str='utf-8') -> list:
+        '''Bytes to remove from extracted CSVs: null bytes ('\0') and non-breaking 
+        spaces (u'\xa0'), which are encoded differently in utf-8 and latin-1'''
+        return [b'\0', u'\xa0'.encode(encoding)]
+
+    def check_remove_nulls(self, encoding:str='utf-8'):
         '''
-        This function checks for null bytes ('\0'), and if exists replace with null string (''):
-        Check only the first 500 lines to stay efficient, if there aren't
-        any in the first 500, there likely(maybe?) aren't any.
+        This function checks for null bytes ('\0') and non-breaking spaces, and 
+        if exists removes them. The whole file is scanned as bytes in large blocks, 
+        and if needed it is filtered with a streaming byte copy rather than being 
+        re-parsed as CSV.
         '''
-        has_null_bytes = False
-        with open(self.csv_path, 'r', encoding='utf-8') as infile:
-            for i, line in enumerate(infile):
-                if has_null_bytes:
-                # Break the cycle if we already found them 
-                    break
-                if i >= 500:
-                    break
-                for char in line:
-                    #if char == '\0' or char == u'\xa0' or char == b'\xc2\xa0':
-                    if char == '\0' or char == u'\xa0':
-                        has_null_bytes = True
-                        break
-
-
-        if has_null_bytes:
+        patterns = self.scrub_patterns(encoding)
+        if utils.file_contains(self.csv_path, patterns):
             self.logger.info("Dataset has null bytes, removing...")
-            temp_file = self.csv_path.replace('.csv', '_fmt.csv')
-            with open(self.csv_path, 'r', encoding='utf-8') as infile:
-                with open(temp_file, 'w', encoding='utf-8') as outfile:
-                    reader = csv.reader((line.replace('\0', '') \
-                                            .replace(u'\xa0', '') \
-                                            .replace(u'\x00', '') \
-                            for line in infile), delimiter=",")
-                    writer = csv.writer(outfile)
-                    writer.writerows(reader)
-            os.replace(temp_file, self.csv_path)
+            removed = utils.remove_bytes(self.csv_path, patterns)
+            self.logger.info(f'Removed {removed:,} bytes.')
+
+    def parquet_fields(self, header:list) -> tuple:
+        '''Return `[(field, storage type)]` for the fields in header, see 
+        `parquet.ORACLE_TYPES`, along with the name of the geometry field if any'''
+        stmt=f'''
+        SELECT
+            COLUMN_NAME,
+            DATA_TYPE,
+            DATA_SCALE
+        FROM ALL_TAB_COLUMNS
+        WHERE OWNER = '{self.table_schema.upper()}'
+        AND TABLE_NAME = '{self.table_name.upper()}'
+        '''
+        cursor = self.conn.cursor()
+        cursor.execute(stmt)
+        types = {}
+        geom_field = None
+        for column_name, data_type, data_scale in cursor.fetchall(): 
+            data_type = data_type.upper()
+            if data_type in ('ST_GEOMETRY', 'SDO_GEOMETRY'): 
+                geom_field = column_name.lower()
+                storage_type = 'geometry'
+            elif data_type == 'NUMBER': 
+                storage_type = 'int64' if data_scale == 0 else 'float64'
+            elif data_type.startswith('TIMESTAMP'): 
+                storage_type = 'timestamp_utc' if 'TIME ZONE' in data_type else 'timestamp_eastern'
+            else: 
+                storage_type = parquet.ORACLE_TYPES.get(data_type, 'string')
+            types[column_name.lower()] = storage_type
+        return [(field, types.get(field.lower(), 'string')) for field in header], geom_field
+
+    def write_parquet(self, rows, interval:int) -> int: 
+        '''Write rows to a Parquet staging file at self.csv_path, converting the 
+        EWKT geometries from geopetl to EWKB. Return the number of rows written.'''
+        fields, geom_field = self.parquet_fields(list(etl.header(rows)))
+        json_schema = {'fields': [{'name': name, 'type': data_type.lower()} for name, data_type in self.fields]}
+        self.logger.info(f'Writing to temporary local Parquet file {self.csv_path}..')
+        with parquet.Parquet_Writer(self.csv_path, fields, geom_field=geom_field, 
+                                    geometry_format='ewkt', json_schema=json_schema) as writer: 
+            return writer.write_rows(etl.data(rows.progress(interval)))
 
     def extract(self):
         '''
@@ -181,7 +205,8 @@ class Oracle():
         time zone (with historical accuracy for Daylight Savings Time). Oracle also 
         stores DATE fields with a time component as well, so "DATE" fields that may appear 
         without time information will also have timezone niformation added.
-        Append CSV file to S3 bucket.
+        Append CSV file to S3 bucket. If s3_key ends in ".parquet", write a Parquet 
+        staging file instead, see `databridge_etl_tools.parquet`.
         '''
         self.logger.info(f'Starting extract from {self.schema_table_name}')
         self.logger.info(f'Rows to extract: {self.row_count}')
@@ -205,42 +230,52 @@ class Oracle():
 
         interval = self.get_interval(self.row_count)
 
-        if datetime_fields:
-            self.logger.info(f'Converting {datetime_fields} fields to Eastern timezone datetime')
-            #data = etl.convert(data, datetime_fields, pytz.timezone('US/Eastern').localize)
-            # Reasign to new object, so below "times_db_called" works
-            # data_conv unbecomes a geopetl object after a convert() and becomes a 'petl.transform.conversions.FieldConvertView' object
-            data_conv = etl.convert(data, datetime_fields, pytz.timezone('US/Eastern').localize)
-            # Write to a CSV
-            try:
-                self.logger.info(f'Writing to temporary local csv {self.csv_path}..')
-                etl.tocsv(data_conv.progress(interval), self.csv_path, encoding='utf-8')
-            except UnicodeError:
-                self.logger.info("Exception encountered trying to extract to CSV with utf-8 encoding, trying latin-1...")
-                self.logger.info(f'Writing to temporary local csv {self.csv_path}..')
-                etl.tocsv(data_conv.progress(interval), self.csv_path, encoding='latin-1')
-        else:
-            # Write to a CSV
-            try:
-                self.logger.info(f'Writing to temporary local csv {self.csv_path}..')
-                etl.tocsv(data.progress(interval), self.csv_path, encoding='utf-8')
-            except UnicodeError:
-                self.logger.info("Exception encountered trying to extract to CSV with utf-8 encoding, trying latin-1...")
-                self.logger.info(f'Writing to temporary local csv {self.csv_path}..')
-                etl.tocsv(data.progress(interval), self.csv_path, encoding='latin-1')
+        with metrics.span('extract', rows=self.row_count):
+            if parquet.is_parquet_key(self.s3_key): 
+                if datetime_fields: 
+                    self.logger.info(f'Converting {datetime_fields} fields to Eastern timezone datetime')
+                    data_conv = etl.convert(data, datetime_fields, pytz.timezone('US/Eastern').localize)
+                else: 
+                    data_conv = data
+                self.write_parquet(data_conv, interval)
+            elif datetime_fields:
+                self.logger.info(f'Converting {datetime_fields} fields to Eastern timezone datetime')
+                #data = etl.convert(data, datetime_fields, pytz.timezone('US/Eastern').localize)
+                # Reasign to new object, so below "times_db_called" works
+                # data_conv unbecomes a geopetl object after a convert() and becomes a 'petl.transform.conversions.FieldConvertView' object
+                data_conv = etl.convert(data, datetime_fields, pytz.timezone('US/Eastern').localize)
+                # Write to a CSV
+                try:
+                    self.logger.info(f'Writing to temporary local csv {self.csv_path}..')
+                    etl.tocsv(data_conv.progress(interval), utils.Byte_Filter_Source(self.csv_path, self.scrub_patterns('utf-8')), encoding='utf-8')
+                except UnicodeError:
+                    self.logger.info("Exception encountered trying to extract to CSV with utf-8 encoding, trying latin-1...")
+                    self.logger.info(f'Writing to temporary local csv {self.csv_path}..')
+                    etl.tocsv(data_conv.progress(interval), utils.Byte_Filter_Source(self.csv_path, self.scrub_patterns('latin-1')), encoding='latin-1')
+            else:
+                # Write to a CSV
+                try:
+                    self.logger.info(f'Writing to temporary local csv {self.csv_path}..')
+                    etl.tocsv(data.progress(interval), utils.Byte_Filter_Source(self.csv_path, self.scrub_patterns('utf-8')), encoding='utf-8')
+                except UnicodeError:
+                    self.logger.info("Exception encountered trying to extract to CSV with utf-8 encoding, trying latin-1...")
+                    self.logger.info(f'Writing to temporary local csv {self.csv_path}..')
+                    etl.tocsv(data.progress(interval), utils.Byte_Filter_Source(self.csv_path, self.scrub_patterns('latin-1')), encoding='latin-1')
 
         # Used solely in pytest to ensure database is called only once.
         self.times_db_called = data.times_db_called
         self.logger.info(f'Times database queried: {self.times_db_called}')
 
         # Confirm CSV isn't empty
-        try:
-            rows = etl.fromcsv(self.csv_path, encoding='utf-8')
-        except UnicodeError:
-            rows = etl.fromcsv(self.csv_path, encoding='latin-1')
+        if parquet.is_parquet_key(self.s3_key): 
+            rows = parquet.Parquet_View(self.csv_path)
+        else: 
+            try:
+                rows = etl.fromcsv(self.csv_path, encoding='utf-8')
+            except UnicodeError:
+                rows = etl.fromcsv(self.csv_path, encoding='latin-1')
 
-        # Remove bad null characters from the csv
-        self.check_remove_nulls()
+        # Bad null characters were already removed from the csv as it was written
 
         num_rows_in_csv = rows.nrows()
         assert num_rows_in_csv != 0, 'Error! Dataset is empty? Line count of CSV is 0.'
@@ -271,9 +306,11 @@ class Oracle():
 
     def append(self):
         '''append a csv into a table.'''
+        import geopetl
         self.get_csv_from_s3()
         print('loading CSV into geopetl..')
-        rows = etl.fromcsv(self.csv_path)
+        rows = (parquet.Parquet_View(self.csv_path) if parquet.is_parquet_file(self.csv_path) 
+                else etl.fromcsv(s3_transfer.read_source(self.csv_path)))
         num_rows_in_csv = rows.nrows()
         assert num_rows_in_csv != 0, 'Error! Dataset is empty? Line count of CSV is 0.'
         print(f'Rows: {num_rows_in_csv}')
@@ -281,13 +318,16 @@ class Oracle():
         interval = self.get_interval(num_rows_in_csv)
         
         print(f"Loading CSV into Oracle table '{self.table_schema.upper()}.{self.table_name.upper()}..")
-        rows.progress(interval).appendoraclesde(self.conn, f'{self.table_schema.upper()}.{self.table_name.upper()}')
+        with metrics.span('copy', rows=num_rows_in_csv):
+            rows.progress(interval).appendoraclesde(self.conn, f'{self.table_schema.upper()}.{self.table_name.upper()}')
 
     def load(self):
         '''Copy CSV into table by first inserting into a temp table (_T affix) and then deleting and inserting into table in one transaction.'''
+        import geopetl
         self.get_csv_from_s3()
         print('loading CSV into geopetl..')
-        rows = etl.fromcsv(self.csv_path)
+        rows = (parquet.Parquet_View(self.csv_path) if parquet.is_parquet_file(self.csv_path) 
+                else etl.fromcsv(s3_transfer.read_source(self.csv_path)))
         num_rows_in_csv = rows.nrows()
         assert num_rows_in_csv != 0, 'Error! Dataset is empty? Line count of CSV is 0.'
         print(f'Rows: {num_rows_in_csv}')
@@ -360,11 +400,12 @@ class Oracle():
             
             print(f'Loading CSV into {temp_table_name} (note that first printed progress rows are just loading csv into petl object)..')
             # Remove objectid because we're loading into temp table first minus objectid
-            if sde_registered:
-                rows_mod = etl.cutout(rows, 'objectid')
-                rows_mod.progress(interval).tooraclesde(self.conn, temp_table_name, table_srid=srid)
-            else:
-                rows.progress(interval).tooraclesde(self.conn, temp_table_name, table_srid=srid)
+            with metrics.span('copy', rows=num_rows_in_csv):
+                if sde_registered:
+                    rows_mod = etl.cutout(rows, 'objectid')
+                    rows_mod.progress(interval).tooraclesde(self.conn, temp_table_name, table_srid=srid)
+                else:
+                    rows.progress(interval).tooraclesde(self.conn, temp_table_name, table_srid=srid)
 
             if sde_registered:
                 copy_into_cols = 'OBJECTID, ' + cols
@@ -383,9 +424,10 @@ class Oracle():
             print('Begin copying from temp into final table..')
             print(copy_stmt)
             try:            
-                cursor.execute(f'DELETE FROM {self.table_schema.upper()}.{self.table_name.upper()}')
-                cursor.execute(copy_stmt)
-                cursor.execute('COMMIT')
+                with metrics.span('swap', rows=num_rows_in_csv):
+                    cursor.execute(f'DELETE FROM {self.table_schema.upper()}.{self.table_name.upper()}')
+                    cursor.execute(copy_stmt)
+                    cursor.execute('COMMIT')
                 cursor.execute(f'DROP TABLE {temp_table_name}')
                 cursor.execute('COMMIT')
                 cursor.execute(f'SELECT COUNT(*) FROM {self.table_schema.upper()}.{self.table_name.upper()}')
@@ -1,5 +1,5 @@
 from .oracle import Oracle
-from .. import utils
+from .. import utils, metrics
 import click
 
 @click.group()
@@ -11,6 +11,7 @@ import click
 @click.option('--s3_key', required=True)
 def oracle(ctx, **kwargs):
     '''Run ETL commands for Oracle'''
+    metrics.set_labels(table=f"{kwargs['table_schema']}.{kwargs['table_name']}")
     ctx.obj = Oracle(**kwargs)
 
 @oracle.command()
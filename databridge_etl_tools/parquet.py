@@ -0,0 +1,253 @@
+'''
+Parquet staging files, an optional alternative to CSV selected by an S3 key ending
+in ".parquet". Columns keep their types (see POSTGRES_TYPES, ORACLE_TYPES) and the
+geometry column is stored as EWKB, so files are smaller than CSV with EWKT
+geometries and readers don't need to parse text. The table's JSON schema, geometry
+field and SRID are kept in the file's key-value metadata.
+
+Requires pyarrow, install databridge-etl-tools[parquet].
+'''
+import json
+import struct
+from petl.util.base import Table
+
+# Rows per record batch when writing and reading
+BATCH_SIZE = 50_000
+# Key of the file's key-value metadata, see Parquet_Writer
+METADATA_KEY = b'databridge'
+PARQUET_MAGIC = b'PAR1'
+
+# Storage type for each JSON schema / information_schema data_type. Anything not
+# listed (numeric, text, json, arrays, ...) is kept as its text representation so
+# that no precision is lost.
+POSTGRES_TYPES = {
+    'smallint':                    'int32',
+    'integer':                     'int32',
+    'bigint':                      'int64',
+    'real':                        'float64',
+    'double precision':            'float64',
+    'boolean':                     'bool',
+    'date':                        'date',
+    # Naive timestamps are extracted as US/Eastern, the same as CSV extracts
+    'timestamp without time zone': 'timestamp_eastern',
+    'timestamp with time zone':    'timestamp_utc',
+    # pg_type names, which Table_Metadata reports for views
+    'int2':                        'int32',
+    'int4':                        'int32',
+    'int8':                        'int64',
+    'float4':                      'float64',
+    'float8':                      'float64',
+    'bool':                        'bool',
+    'timestamp':                   'timestamp_eastern',
+    'timestamptz':                 'timestamp_utc',
+}
+# Oracle DATA_TYPEs, where NUMBER columns with a DATA_SCALE of 0 are int64
+ORACLE_TYPES = {
+    'FLOAT':         'float64',
+    'BINARY_FLOAT':  'float64',
+    'BINARY_DOUBLE': 'float64',
+    'DATE':          'timestamp_eastern',
+}
+
+
+def _pyarrow():
+    try:
+        import pyarrow
+        import pyarrow.compute
+        import pyarrow.parquet
+    except ImportError:
+        raise ImportError('Parquet staging files require the pyarrow package, install databridge-etl-tools[parquet]')
+    return pyarrow
+
+def arrow_type(name:str):
+    '''Return the pyarrow type for a storage type name from POSTGRES_TYPES or ORACLE_TYPES'''
+    pa = _pyarrow()
+    return {
+        'int32':             pa.int32(),
+        'int64':             pa.int64(),
+        'float64':           pa.float64(),
+        'bool':              pa.bool_(),
+        'date':              pa.date32(),
+        'timestamp_eastern': pa.timestamp('us', tz='US/Eastern'),
+        'timestamp_utc':     pa.timestamp('us', tz='UTC'),
+        'geometry':          pa.binary(),
+    }.get(name, pa.string())
+
+def is_parquet_key(key:str) -> bool:
+    return key is not None and key.lower().endswith('.parquet')
+
+def is_parquet_file(path:str) -> bool:
+    with open(path, 'rb') as f:
+        return f.read(4) == PARQUET_MAGIC
+
+
+def ewkb_srid(value:bytes):
+    '''Return the SRID embedded in an EWKB geometry, or None'''
+    endian = '<' if value[0] == 1 else '>'
+    if struct.unpack(endian + 'I', value[1:5])[0] & 0x20000000:
+        return struct.unpack(endian + 'I', value[5:9])[0]
+    return None
+
+def ewkt_to_ewkb(value:str):
+    '''"SRID=2272;POINT (1 2)" -> EWKB bytes. Empty values become None.'''
+    if not value or not value.strip():
+        return None
+    srid = None
+    if value.startswith('SRID='):
+        srid, value = value.split(';', 1)
+        srid = int(srid[len('SRID='):])
+    from shapely import wkb, wkt
+    return wkb.dumps(wkt.loads(value), srid=srid)
+
+def ewkb_to_ewkt(value:bytes) -> str:
+    '''EWKB bytes -> "SRID=2272;POINT (1 2)", the format CSV extracts use'''
+    if value is None:
+        return ''
+    srid = ewkb_srid(value)
+    from shapely import wkb, wkt
+    text = wkt.dumps(wkb.loads(bytes(value)), trim=True)
+    return text if srid is None else f'SRID={srid};{text}'
+
+def to_multi_ewkb(value:bytes) -> bytes:
+    '''Promote a single-part EWKB point, linestring or polygon to its MULTI
+    equivalent, like `_stream.to_multi_geom()` does for EWKT'''
+    if value is None:
+        return value
+    endian = '<' if value[0] == 1 else '>'
+    geom_type = struct.unpack(endian + 'I', value[1:5])[0]
+    flags, base = geom_type & 0xE0000000, geom_type & 0x0FFFFFFF
+    if base not in (1, 2, 3):
+        return value
+    srid_end = 9 if flags & 0x20000000 else 5
+    # The part keeps the Z/M flags but not the SRID, which stays on the collection
+    part = value[:1] + struct.pack(endian + 'I', base | (flags & ~0x20000000)) + value[srid_end:]
+    return (value[:1] + struct.pack(endian + 'I', (base + 3) | flags) + value[5:srid_end]
+            + struct.pack(endian + 'I', 1) + part)
+
+
+class Parquet_Writer():
+    '''
+    Write rows to a Parquet staging file in record batches, e.g.
+    ```
+    with Parquet_Writer(path, [('objectid', 'int32'), ('shape', 'geometry')], geom_field='shape') as writer:
+        writer.write_rows(rows)
+    ```
+    fields is a list of `(name, storage type)` in row order. Geometry values may
+    be EWKB bytes or, with geometry_format='ewkt', EWKT strings. Null bytes are
+    removed from text columns, as they are for CSV extracts. json_schema is stored
+    in the file's metadata alongside the geometry field and its SRID.
+    '''
+    def __init__(self, path:str, fields:list, geom_field:str=None, geometry_format:str='ewkb',
+                 json_schema:dict=None, batch_size:int=BATCH_SIZE):
+        pa = _pyarrow()
+        self.path = path
+        self.names = [name for name, _ in fields]
+        self.types = [arrow_type('geometry' if name == geom_field else storage_type)
+                      for name, storage_type in fields]
+        self.geom_field = geom_field
+        self.geometry_format = geometry_format
+        self.json_schema = json_schema
+        self.batch_size = batch_size
+        self.srid = None
+        self.row_count = 0
+        self._schema = pa.schema(list(zip(self.names, self.types)))
+        self._writer = pa.parquet.ParquetWriter(path, self._schema, compression='zstd')
+
+    def _column(self, values:list, i:int):
+        pa = _pyarrow()
+        if self.names[i] == self.geom_field:
+            if self.geometry_format == 'ewkt':
+                values = [ewkt_to_ewkb(value) for value in values]
+            if self.srid is None:
+                self.srid = next((ewkb_srid(value) for value in values if value), None)
+            values = [None if value is None else bytes(value) for value in values]
+        elif pa.types.is_string(self.types[i]):
+            values = [value if value is None or isinstance(value, str) else str(value)
+                      for value in values]
+        array = pa.array(values, type=self.types[i])
+        if pa.types.is_string(self.types[i]):
+            array = pa.compute.replace_substring(array, '\0', '')
+        return array
+
+    def write_batch(self, rows:list):
+        if not rows:
+            return
+        columns = [self._column(list(values), i) for i, values in enumerate(zip(*rows))]
+        self._writer.write_batch(_pyarrow().record_batch(columns, schema=self._schema))
+        self.row_count += len(rows)
+
+    def write_rows(self, rows) -> int:
+        '''Write an iterable of rows (without a header), returning the total row count'''
+        batch = []
+        for row in rows:
+            batch.append(row)
+            if len(batch) == self.batch_size:
+                self.write_batch(batch)
+                batch = []
+        self.write_batch(batch)
+        return self.row_count
+
+    def close(self):
+        metadata = {'json_schema': self.json_schema, 'geom_field': self.geom_field, 'srid': self.srid}
+        self._writer.add_key_value_metadata({METADATA_KEY: json.dumps(metadata).encode()})
+        self._writer.close()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, type, value, traceback):
+        self.close()
+
+
+def read_metadata(path:str) -> dict:
+    '''Return the `{json_schema, geom_field, srid}` metadata of a Parquet staging file'''
+    metadata = _pyarrow().parquet.ParquetFile(path).metadata.metadata or {}
+    return json.loads(metadata.get(METADATA_KEY, b'{}'))
+
+def num_rows(path:str) -> int:
+    '''Row count from the file footer, without reading any data'''
+    return _pyarrow().parquet.ParquetFile(path).metadata.num_rows
+
+
+def _text(value) -> str:
+    return '' if value is None else str(value)
+
+class Parquet_View(Table):
+    '''
+    petl table over a Parquet staging file, read in record batches of batch_size
+    rows. Values are returned the way they would be read from a CSV extract: as
+    text, with '' for nulls, so that this can replace `etl.fromcsv()` without
+    changing what comes after it. The geometry column is returned as EWKT, or
+    with geometry_format='hexewkb' as hex EWKB, which Postgres accepts as
+    geometry input without parsing any text.
+    '''
+    def __init__(self, path:str, geometry_format:str='ewkt', batch_size:int=BATCH_SIZE,
+                 to_multi:bool=False):
+        if geometry_format not in ('ewkt', 'hexewkb'):
+            raise ValueError(f'Geometry format {geometry_format} not recognized')
+        self.path = path
+        self.geometry_format = geometry_format
+        self.batch_size = batch_size
+        # Promote single-part geometries to MULTI as they're read, see to_multi_ewkb()
+        self.to_multi = to_multi
+        self.geom_field = read_metadata(path).get('geom_field')
+
+    def _geometry(self, value) -> str:
+        if value is None:
+            return ''
+        if self.to_multi:
+            value = to_multi_ewkb(value)
+        return value.hex() if self.geometry_format == 'hexewkb' else ewkb_to_ewkt(value)
+
+    def __iter__(self):
+        parquet_file = _pyarrow().parquet.ParquetFile(self.path)
+        header = tuple(parquet_file.schema_arrow.names)
+        yield header
+        formatters = [self._geometry if name == self.geom_field else _text for name in header]
+        for batch in parquet_file.iter_batches(batch_size=self.batch_size):
+            columns = [map(formatter, column.to_pylist())
+                       for formatter, column in zip(formatters, batch.columns)]
+            yield from zip(*columns)
+
+    def nrows(self) -> int:
+        return num_rows(self.path)
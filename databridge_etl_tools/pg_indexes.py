@@ -0,0 +1,119 @@
+'''
+Defer a table's index maintenance during a bulk load. Rather than updating every
+btree and GiST index for each row inserted, drop the indexes first and build
+them again once the rows are in, which sorts each index once:
+```
+with cursor, Deferred_Indexes(cursor, schema, table, logger):
+    cursor.execute('INSERT INTO ...')
+conn.commit()
+```
+DROP INDEX is transactional, so the indexes come back by themselves if the load
+fails and is rolled back. They're dropped and rebuilt in the load's own
+transaction, so that no one sees the table without them; as the new rows aren't
+visible to other sessions until it commits, the indexes are built one at a time
+in this session, each with PostgreSQL's parallel index build workers.
+
+Dropping an index takes an ACCESS EXCLUSIVE lock on the table, which is held
+until the load commits. Every other session, readers included, is blocked from
+the first DROP until the indexes are rebuilt and committed, which a plain COPY
+or INSERT never does. Only defer the indexes of tables that aren't read during
+loads; for tables that are, see the swap load of `Postgres.load()` instead.
+
+The primary key is left alone, as are unique constraints that foreign keys
+reference and replica identity or CLUSTER indexes, whose roles would be lost.
+'''
+import time
+import psycopg2.sql as sql
+from . import metrics
+
+# Per-transaction settings for the index builds
+MAINTENANCE_WORK_MEM = '1GB'
+PARALLEL_MAINTENANCE_WORKERS = 4
+
+
+def capture_indexes(cursor, schema:str, table:str) -> list:
+    '''
+    Return `{'schema', 'name', 'definition', 'constraint'}` for each index of
+    schema.table (or TEMP table if schema is None) that can be dropped and built
+    again, from pg_indexes. 'constraint' is the constraint definition of
+    unique and exclusion constraint indexes and None for plain indexes.
+    '''
+    cursor.execute('''
+    SELECT i.schemaname, i.indexname, i.indexdef, pg_get_constraintdef(con.oid)
+    FROM pg_indexes i
+    JOIN pg_index x ON x.indexrelid = format('%%I.%%I', i.schemaname, i.indexname)::regclass
+    LEFT JOIN pg_constraint con ON con.conindid = x.indexrelid AND con.conrelid = x.indrelid
+        AND con.contype IN ('u', 'x')
+    WHERE i.tablename = %s
+        AND i.schemaname = COALESCE(%s, pg_my_temp_schema()::regnamespace::text)
+        AND NOT x.indisprimary AND NOT x.indisreplident AND NOT x.indisclustered
+        AND NOT EXISTS (
+            SELECT 1 FROM pg_constraint f WHERE f.contype = 'f' AND f.conindid = x.indexrelid)
+    ORDER BY i.indexname''', [table, schema])
+    return [{'schema': row[0], 'name': row[1], 'definition': row[2], 'constraint': row[3]}
+            for row in cursor.fetchall()]
+
+def drop_statement(index:dict, table:str) -> 'sql.Composed':
+    if index['constraint'] is not None:
+        return sql.SQL('ALTER TABLE {} DROP CONSTRAINT {}').format(
+            sql.Identifier(index['schema'], table), sql.Identifier(index['name']))
+    return sql.SQL('DROP INDEX {}').format(sql.Identifier(index['schema'], index['name']))
+
+def create_statement(index:dict, table:str) -> 'sql.Composable':
+    if index['constraint'] is not None:
+        return sql.SQL('ALTER TABLE {} ADD CONSTRAINT {} {}').format(
+            sql.Identifier(index['schema'], table), sql.Identifier(index['name']),
+            sql.SQL(index['constraint']))
+    return sql.SQL(index['definition'])
+
+
+class Deferred_Indexes():
+    '''Context manager that drops a table's indexes on entry and builds them again
+    on a clean exit, see the module docstring'''
+    def __init__(self, cursor, schema:str, table:str, logger,
+                 maintenance_work_mem:str=MAINTENANCE_WORK_MEM,
+                 parallel_workers:int=PARALLEL_MAINTENANCE_WORKERS):
+        self.cursor = cursor
+        self.schema = schema
+        self.table = table
+        self.logger = logger
+        self.maintenance_work_mem = maintenance_work_mem
+        self.parallel_workers = parallel_workers
+        self.indexes = []
+        self.load_seconds = None
+        self.rebuild_seconds = None
+        self.index_seconds = {}
+
+    def __enter__(self):
+        self.indexes = capture_indexes(self.cursor, self.schema, self.table)
+        with metrics.span('drop_indexes', rows=len(self.indexes)):
+            for index in self.indexes:
+                self.logger.info(f'Deferring index {index["name"]}: {index["definition"]}')
+                self.cursor.execute(drop_statement(index, self.table))
+        self._start = time.perf_counter()
+        return self
+
+    def __exit__(self, type, value, traceback):
+        if type is not None: # Leave the rollback to put the indexes back
+            return
+        self.load_seconds = time.perf_counter() - self._start
+        start = time.perf_counter()
+        self.cursor.execute('SET LOCAL maintenance_work_mem = %s', [self.maintenance_work_mem])
+        self.cursor.execute('SET LOCAL max_parallel_maintenance_workers = %s', [self.parallel_workers])
+        # Other sessions can't see the loaded rows yet, so the indexes can't be built
+        # concurrently on connections of their own; each build runs in parallel instead
+        self.cursor.execute("SELECT least(current_setting('max_parallel_maintenance_workers')::int, "
+                            "current_setting('max_parallel_workers')::int)")
+        workers = self.cursor.fetchone()[0]
+        for index in self.indexes:
+            index_start = time.perf_counter()
+            with metrics.span('index', index=index['name']):
+                self.cursor.execute(create_statement(index, self.table))
+            self.index_seconds[index['name']] = time.perf_counter() - index_start
+            self.logger.info(f'Rebuilt index {index["name"]} in {self.index_seconds[index["name"]]:,.2f}s')
+        self.rebuild_seconds = time.perf_counter() - start
+        total_seconds = self.load_seconds + self.rebuild_seconds
+        self.logger.info(f'Loaded with {len(self.indexes):,} indexes deferred in {self.load_seconds:,.2f}s, '
+                         f'then rebuilt them in {self.rebuild_seconds:,.2f}s with up to {workers} '
+                         f'parallel workers each: {self.rebuild_seconds / total_seconds:.0%} '
+                         f'of {total_seconds:,.2f}s in total.\n')
@@ -0,0 +1,239 @@
+import csv
+import re
+import struct
+import uuid
+import datetime
+import decimal
+import psycopg2.sql as sql
+from .. import metrics
+from ._stream import Iterator_File, STREAM_CHUNK_SIZE
+
+# See https://www.postgresql.org/docs/current/sql-copy.html#id-1.9.3.55.9.4
+COPY_BINARY_HEADER = b'PGCOPY\n\xff\r\n\x00' + struct.pack('!ii', 0, 0)
+COPY_BINARY_TRAILER = struct.pack('!h', -1)
+NULL_FIELD = struct.pack('!i', -1)
+
+POSTGRES_EPOCH_DATE = datetime.date(2000, 1, 1)
+POSTGRES_EPOCH = datetime.datetime(2000, 1, 1)
+POSTGRES_EPOCH_UTC = datetime.datetime(2000, 1, 1, tzinfo=datetime.timezone.utc)
+
+HEX_RE = re.compile('^[0-9A-Fa-f]+$')
+TRUE_VALUES = ('t', 'true', 'y', 'yes', 'on', '1')
+FALSE_VALUES = ('f', 'false', 'n', 'no', 'off', '0')
+
+
+def _parse_datetime(value:str) -> datetime.datetime:
+    from dateutil import parser
+    try:
+        return parser.isoparse(value)
+    except ValueError:
+        return parser.parse(value)
+
+def _microseconds(delta:datetime.timedelta) -> int:
+    return (delta.days * 86_400 + delta.seconds) * 1_000_000 + delta.microseconds
+
+def encode_bool(value:str) -> bytes:
+    if value.lower() in TRUE_VALUES:
+        return b'\x01'
+    if value.lower() in FALSE_VALUES:
+        return b'\x00'
+    raise ValueError(f'invalid input syntax for type boolean: "{value}"')
+
+def encode_numeric(value:str) -> bytes:
+    '''Encode a numeric as base 10000 digits, see numeric_send() in Postgres'
+    src/backend/utils/adt/numeric.c'''
+    d = decimal.Decimal(value)
+    if d.is_nan():
+        return struct.pack('!hhHh', 0, 0, 0xC000, 0)
+    if d.is_infinite():
+        raise ValueError(f'Cannot encode numeric value "{value}"')
+    sign, digits, exponent = d.as_tuple()
+    digits = ''.join(str(x) for x in digits)
+    if exponent >= 0:
+        int_part, frac_part = digits + '0' * exponent, ''
+    else:
+        int_part = digits[:exponent] or '0'
+        frac_part = digits[exponent:].rjust(-exponent, '0')
+    int_part = int_part.rjust(-(-len(int_part) // 4) * 4, '0')
+    frac_part = frac_part.ljust(-(-len(frac_part) // 4) * 4, '0')
+    groups = [int(int_part[i:i + 4]) for i in range(0, len(int_part), 4)]
+    weight = len(groups) - 1
+    groups += [int(frac_part[i:i + 4]) for i in range(0, len(frac_part), 4)]
+    while groups and groups[0] == 0:
+        groups.pop(0)
+        weight -= 1
+    while groups and groups[-1] == 0:
+        groups.pop()
+    if not groups:
+        weight, sign = 0, 0
+    return (struct.pack('!hhHh', len(groups), weight, 0x4000 if sign else 0, max(-exponent, 0)) +
+            struct.pack(f'!{len(groups)}H', *groups))
+
+def encode_date(value:str) -> bytes:
+    return struct.pack('!i', (_parse_datetime(value).date() - POSTGRES_EPOCH_DATE).days)
+
+def encode_timestamp(value:str) -> bytes:
+    # Like the text input, any offset given for a timestamp without time zone is ignored
+    dt = _parse_datetime(value).replace(tzinfo=None)
+    return struct.pack('!q', _microseconds(dt - POSTGRES_EPOCH))
+
+def timestamptz_encoder(session_timezone:str):
+    '''Return an encoder for timestamptz values that treats naive values as being
+    in session_timezone, the same as the text input does'''
+    import pytz
+    tz = pytz.timezone(session_timezone)
+    def encode_timestamptz(value:str) -> bytes:
+        dt = _parse_datetime(value)
+        if dt.tzinfo is None:
+            dt = tz.localize(dt)
+        return struct.pack('!q', _microseconds(dt - POSTGRES_EPOCH_UTC))
+    return encode_timestamptz
+
+def encode_time(value:str) -> bytes:
+    t = datetime.time.fromisoformat(value)
+    return struct.pack('!q', ((t.hour * 60 + t.minute) * 60 + t.second) * 1_000_000 + t.microsecond)
+
+def encode_geometry(value:str) -> bytes:
+    '''Encode an EWKT (or hex EWKB) geometry as EWKB'''
+    if HEX_RE.match(value):
+        return bytes.fromhex(value)
+    import shapely.wkt, shapely.wkb
+    srid = None
+    if value.upper().startswith('SRID='):
+        srid, value = value.split(';', 1)
+        srid = int(srid[5:])
+    return shapely.wkb.dumps(shapely.wkt.loads(value), srid=srid)
+
+ENCODERS = {
+    'smallint':                    lambda v: struct.pack('!h', int(v)),
+    'integer':                     lambda v: struct.pack('!i', int(v)),
+    'bigint':                      lambda v: struct.pack('!q', int(v)),
+    'real':                        lambda v: struct.pack('!f', float(v)),
+    'double precision':            lambda v: struct.pack('!d', float(v)),
+    'numeric':                     encode_numeric,
+    'boolean':                     encode_bool,
+    'text':                        lambda v: v.encode('utf-8'),
+    'character varying':           lambda v: v.encode('utf-8'),
+    'character':                   lambda v: v.encode('utf-8'),
+    'date':                        encode_date,
+    'timestamp without time zone': encode_timestamp,
+    'time without time zone':      encode_time,
+    'uuid':                        lambda v: uuid.UUID(v).bytes,
+    'json':                        lambda v: v.encode('utf-8'),
+    'jsonb':                       lambda v: b'\x01' + v.encode('utf-8'),
+    'geometry':                    encode_geometry,
+}
+
+# fields_and_types() returns information_schema names for tables but pg_type
+# names for views
+TYPE_ALIASES = {
+    'int2': 'smallint', 'int4': 'integer', 'int8': 'bigint', 'float4': 'real',
+    'float8': 'double precision', 'bool': 'boolean', 'varchar': 'character varying',
+    'bpchar': 'character', 'timestamp': 'timestamp without time zone',
+    'timestamptz': 'timestamp with time zone', 'time': 'time without time zone',
+}
+
+
+def binary_encoders(self, header:list, mapping_dict:dict={}) -> list:
+    '''Return a list of encoders, one for each column of the data file header,
+    according to the types of the mapped database columns in fields_and_types'''
+    types = {name: TYPE_ALIASES.get(data_type.lower(), data_type.lower())
+             for name, data_type in self.fields_and_types}
+    encoders = []
+    unsupported = []
+    for col in header:
+        mapped_col = mapping_dict.get(col, col)
+        if mapped_col not in types:
+            raise ValueError(f'Column {mapped_col} does not exist in {self.fully_qualified_table_name}')
+        data_type = types[mapped_col]
+        if mapped_col == self.geom_field:
+            data_type = 'geometry'
+        if data_type == 'timestamp with time zone':
+            session_timezone = self.execute_sql('SHOW TimeZone', fetch='one')[0]
+            encoders.append(timestamptz_encoder(session_timezone))
+        elif data_type in ENCODERS:
+            encoders.append(ENCODERS[data_type])
+        else:
+            unsupported.append(f'{mapped_col} ({data_type})')
+    if unsupported:
+        raise ValueError(f'No binary encoder for column(s) {", ".join(unsupported)}, use the text loader instead')
+    return encoders
+
+def iter_binary_chunks(header:list, encoders:list, rows, chunk_size:int=STREAM_CHUNK_SIZE):
+    '''Encode rows of CSV strings in the COPY binary format, yielding chunks of
+    roughly chunk_size bytes. Empty strings are written as NULL, the same as an
+    unquoted empty value in CSV COPY. csv.reader reads a quoted "" as an empty
+    string too, so it is NULL as well, in text columns the same as any other.'''
+    n_fields = struct.pack('!h', len(encoders))
+    pack_length = struct.Struct('!i').pack
+    parts = [COPY_BINARY_HEADER]
+    size = 0
+    for line_num, row in enumerate(rows, start=2):
+        parts.append(n_fields)
+        for col, encoder, value in zip(header, encoders, row):
+            if value == '':
+                parts.append(NULL_FIELD)
+                continue
+            try:
+                data = encoder(value)
+            except Exception as e:
+                raise ValueError(f'Could not encode line {line_num}, column {col}: "{value[:100]}"') from e
+            parts.append(pack_length(len(data)))
+            parts.append(data)
+            size += len(data)
+        if size >= chunk_size:
+            yield b''.join(parts)
+            parts = []
+            size = 0
+    parts.append(COPY_BINARY_TRAILER)
+    yield b''.join(parts)
+
+def _copy_binary(self, rows, header:list, table_identifier:'sql.Identifier',
+                 mapping_dict:dict={}):
+    '''Run COPY FROM STDIN (FORMAT binary) for an iterator of rows of CSV strings,
+    where header is the list of data file columns. Return the number of rows copied.'''
+    encoders = self.binary_encoders(header, mapping_dict)
+    f = Iterator_File(iter_binary_chunks(header, encoders, rows))
+    with self.conn.cursor() as cursor:
+        cols_composed = sql.Composed(
+            [sql.Identifier(mapping_dict.get(col, col)) for col in header]).join(', ')
+        copy_stmt = sql.SQL('''
+    COPY {table} ({cols_composed})
+    FROM STDIN WITH (FORMAT binary)''').format(
+            table=table_identifier,
+            cols_composed=cols_composed)
+        self.logger.info(f'copy_statement:{cursor.mogrify(copy_stmt).decode()}')
+        with metrics.span('copy', format='binary') as span: 
+            cursor.copy_expert(copy_stmt, f, STREAM_CHUNK_SIZE)
+            span.rows = cursor.rowcount
+
+        self.logger.info(f'Postgres Write Successful: {cursor.rowcount:,} rows imported.\n')
+        return cursor.rowcount
+
+def write_binary(self, write_file:str, table_name:str, schema_name:str,
+                 mapping_dict:dict={}, temp_table:bool=False):
+    '''
+    Alternative to `write_csv()` that encodes each value of the CSV according to its
+    database column type and sends it with COPY ... (FORMAT binary), so the server
+    doesn't need to parse numbers, dates and geometries from text. Geometries are
+    sent as EWKB.
+
+    Column types are taken from this object's table, so the destination must have
+    the same columns, i.e. be this table or a TEMP table created from it.
+
+    Every empty value is loaded as NULL, whether or not it was quoted in the file.
+    CSV COPY would keep a quoted "" as an empty string, but `write_csv()` is given
+    the file written by `prepare_file()`, where csv.writer leaves empty strings
+    unquoted, so it loads them as NULL too (apart from a file with one column).
+    '''
+    if temp_table: # temp_tables do not exist in a user-defined schema
+        self.logger.info(f'Writing binary to TEMP table {table_name} from {write_file}...')
+        table_identifier = sql.Identifier(table_name)
+    else:
+        self.logger.info(f'Writing binary to table {schema_name}.{table_name} from {write_file}...')
+        table_identifier = sql.Identifier(schema_name, table_name)
+
+    with open(write_file, 'r', newline='', encoding='utf-8') as f:
+        reader = csv.reader(f)
+        header = next(reader)
+        self._copy_binary(reader, header, table_identifier, mapping_dict)
@@ -1,6 +1,6 @@
 import os
-import csv
 import psycopg2
+from .. import utils, metrics
 
 def vacuum_analyze(self):
     self.logger.info('Vacuum analyzing table: {}'.format(self.fully_qualified_table_name))
@@ -9,8 +9,12 @@ def vacuum_analyze(self):
     # https://stackoverflow.com/questions/1017463/postgresql-how-to-run-vacuum-from-code-outside-transaction-block
     old_isolation_level = self.conn.isolation_level
     self.conn.set_isolation_level(psycopg2.extensions.ISOLATION_LEVEL_AUTOCOMMIT)
-    self.execute_sql('VACUUM ANALYZE {};'.format(self.fully_qualified_table_name))
-    self.conn.set_isolation_level(old_isolation_level)
+    try: 
+        with metrics.span('vacuum'): 
+            self.execute_sql('VACUUM ANALYZE {};'.format(self.fully_qualified_table_name))
+    finally: 
+        # Pooled connections are reused by other tables, so never leave this one in autocommit
+        self.conn.set_isolation_level(old_isolation_level)
     
     self.logger.info('Vacuum analyze complete.\n')
 
@@ -29,26 +33,11 @@ def cleanup(self):
 
 def check_remove_nulls(self):
     '''
-    This function checks for null bytes ('\0'), and if exists replace with null string (''):
-    Check only the first 500 lines to stay efficient, if there aren't 
-    any in the first 500, there likely(maybe?) aren't any.
+    This function checks for null bytes ('\0'), and if exists removes them. 
+    The whole file is scanned as bytes in large blocks, and if needed it is 
+    filtered with a streaming byte copy rather than being re-parsed as CSV.
     '''
-    has_null_bytes = False
-    with open(self.csv_path, 'r') as infile:
-        for i, line in enumerate(infile):
-            if i >= 500:
-                break
-            for char in line:
-                if char == '\0':
-                    has_null_bytes = True
-                    break
-
-    if has_null_bytes:
+    if utils.file_contains(self.csv_path, [b'\0']):
         self.logger.info("Dataset has null bytes, removing...")
-        temp_file = self.csv_path.replace('.csv', '_fmt.csv')
-        with open(self.csv_path, 'r') as infile:
-            with open(temp_file, 'w') as outfile:
-                reader = csv.reader((line.replace('\0', '') for line in infile), delimiter=",")
-                writer = csv.writer(outfile)
-                writer.writerows(reader)
-        os.replace(temp_file, self.csv_path)
+        removed = utils.remove_bytes(self.csv_path, [b'\0'])
+        self.logger.info(f'Removed {removed:,} null bytes.')
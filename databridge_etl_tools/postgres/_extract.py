@@ -0,0 +1,268 @@
+import os
+import csv
+import json
+import math
+import shutil
+from concurrent.futures import ThreadPoolExecutor
+import psycopg2.sql as sql
+from .. import parquet, metrics
+
+
+def naive_datetime_fields(self) -> list:
+    '''Return the lower-cased names of timestamp/date fields that are not timezone
+    aware. These are exported as US/Eastern datetimes. '''
+    datetime_fields = []
+    for field in self.fields_and_types:
+        if ('timestamp' in field[1].lower() or 'date' in field[1].lower()) and \
+            ('tz' not in field[1].lower() and 'with time zone' not in field[1].lower()):
+            datetime_fields.append(field[0].lower())
+    return datetime_fields
+
+def eastern_timestamp(col:'sql.Composable') -> 'sql.Composed':
+    '''
+    Format a naive timestamp column as text the way the geopetl extract writes a
+    pytz-localized US/Eastern datetime, i.e. Python's str(): 
+    "2024-01-31 12:00:00-05:00", with ".ffffff" only when there are microseconds.
+    Postgres's own timestamptz output would be "2024-01-31 12:00:00-05". Needs
+    the session TimeZone to be 'US/Eastern', for the offset. 
+    '''
+    return sql.SQL('''to_char({v}, 'YYYY-MM-DD HH24:MI:SS')
+        || CASE WHEN to_char({v}, 'US') = '000000' THEN '' ELSE to_char({v}, '.US') END
+        || to_char({v}, 'OF') || ':00'
+    ''').format(v=sql.SQL("({} AT TIME ZONE 'US/Eastern')").format(col))
+
+def export_select_stmt(self) -> 'tuple[list, sql.Composed]':
+    '''
+    Return `(header, stmt)` where stmt is a SELECT of this table that formats
+    values the same way `extract()` does, but on the server:
+        - the geometry field as EWKT (or WKT if with_srid is not True)
+        - naive datetime fields converted to US/Eastern timezone aware datetimes,
+          written as text in the same format as the geopetl extract, see 
+          `eastern_timestamp()`
+
+    The session TimeZone should be 'US/Eastern' so that the converted values are
+    also written out with an Eastern offset.
+    '''
+    datetime_fields = self.naive_datetime_fields()
+    header = []
+    cols_composables = []
+    for field in self.fields:
+        # See fields_and_types
+        if field == 'gdb_geomattr_data':
+            continue
+        if field == self.geom_field:
+            geom_function = 'ST_AsEWKT' if self.with_srid is True else 'ST_AsText'
+            col = sql.SQL(geom_function + '({})').format(sql.Identifier(field))
+        elif field.lower() in datetime_fields:
+            col = eastern_timestamp(sql.Identifier(field))
+        else:
+            col = sql.Identifier(field)
+        header.append(field)
+        cols_composables.append(sql.SQL('{} AS {}').format(col, sql.Identifier(field)))
+
+    stmt = sql.SQL('SELECT {cols} FROM {table}').format(
+        cols=sql.Composed(cols_composables).join(', '),
+        table=self.table_self_identifier)
+    return header, stmt
+
+def copy_extract(self):
+    '''
+    Extract the table to self.csv_path with a single `COPY (SELECT ...) TO STDOUT`
+    where all formatting is done by the server (see `export_select_stmt`), then
+    load it to S3. Python never touches individual rows.
+    '''
+    row_count = self.get_row_count()
+    self.logger.info(f'Starting COPY extract from {self.fully_qualified_table_name}')
+    assert row_count != 0, 'Error! Row count of dataset in database is 0??'
+
+    header, select_stmt = self.export_select_stmt()
+    with self.conn.cursor() as cursor, open(self.csv_path, 'w', encoding='utf-8', newline='') as f:
+        # SET LOCAL only lasts until the end of the current transaction
+        cursor.execute("SET LOCAL TIME ZONE 'US/Eastern'")
+        copy_stmt = sql.SQL('COPY ({}) TO STDOUT WITH (FORMAT csv, HEADER true)').format(select_stmt)
+        self.logger.info(f'copy_statement:{cursor.mogrify(copy_stmt).decode()}')
+        with metrics.span('extract') as span: 
+            cursor.copy_expert(copy_stmt, f, 1024 * 1024)
+            num_rows_in_csv = span.rows = cursor.rowcount
+
+    db_newest_row_count = self.get_row_count()
+    self.logger.info(f'Asserting counts match between current db count and extracted csv')
+    self.logger.info(f'{db_newest_row_count} == {num_rows_in_csv}')
+    assert db_newest_row_count == num_rows_in_csv
+
+    self.check_remove_nulls()
+    self.load_csv_to_s3(path=self.csv_path)
+
+def parquet_extract(self):
+    '''
+    Extract the table to a Parquet file at self.csv_path and load it to S3, see 
+    `databridge_etl_tools.parquet`. Geometries are selected as EWKB (or WKB if 
+    with_srid is not True), naive datetimes as US/Eastern and any type without a 
+    native Parquet equivalent as text, so rows go from a server-side cursor into 
+    record batches without being formatted or parsed in Python. 
+    '''
+    row_count = self.get_row_count()
+    self.logger.info(f'Starting Parquet extract from {self.fully_qualified_table_name}')
+    assert row_count != 0, 'Error! Row count of dataset in database is 0??'
+
+    fields = []
+    cols_composables = []
+    for field, data_type, _ in self.metadata.columns: 
+        # See fields_and_types
+        if field == 'gdb_geomattr_data':
+            continue
+        if field == self.geom_field: 
+            storage_type = 'geometry'
+            geom_function = 'ST_AsEWKB' if self.with_srid is True else 'ST_AsBinary'
+            col = sql.SQL(geom_function + '({})').format(sql.Identifier(field))
+        else: 
+            storage_type = parquet.POSTGRES_TYPES.get(data_type, 'string')
+            if storage_type == 'timestamp_eastern': 
+                col = sql.SQL("{} AT TIME ZONE 'US/Eastern'").format(sql.Identifier(field))
+            elif storage_type == 'string': 
+                col = sql.SQL('{}::text').format(sql.Identifier(field))
+            else: 
+                col = sql.Identifier(field)
+        fields.append((field, storage_type))
+        cols_composables.append(sql.SQL('{} AS {}').format(col, sql.Identifier(field)))
+    select_stmt = sql.SQL('SELECT {cols} FROM {table}').format(
+        cols=sql.Composed(cols_composables).join(', '),
+        table=self.table_self_identifier)
+
+    writer = parquet.Parquet_Writer(self.csv_path, fields, geom_field=self.geom_field, 
+                                    json_schema=json.loads(self.export_json_schema))
+    with writer, self.conn.cursor(name=f'{self.table_name}_parquet_extract') as cursor: 
+        self.logger.info(f'select_statement:{select_stmt.as_string(self.conn)}')
+        cursor.itersize = parquet.BATCH_SIZE
+        with metrics.span('extract', format='parquet') as span: 
+            cursor.execute(select_stmt)
+            while True: 
+                rows = cursor.fetchmany(parquet.BATCH_SIZE)
+                if not rows: 
+                    break
+                writer.write_batch(rows)
+                self.logger.info(f'Extracted {writer.row_count:,} rows...')
+            span.rows = writer.row_count
+    num_rows_in_file = writer.row_count
+
+    db_newest_row_count = self.get_row_count()
+    self.logger.info(f'Asserting counts match between current db count and extracted file')
+    self.logger.info(f'{db_newest_row_count} == {num_rows_in_file}')
+    assert db_newest_row_count == num_rows_in_file
+
+    self.load_csv_to_s3(path=self.csv_path)
+
+def _partition_predicates(self, cursor, partitions:int, row_count:int) -> list:
+    '''Split the table into at most `partitions` ranges, returning a list of WHERE
+    predicates that together cover every row exactly once. Ranges are taken on the
+    primary key if there is one, otherwise on ctid blocks. Views have neither, so
+    they come back as a single partition.'''
+    if self.primary_keys:
+        # Rows are numbered in key order and every step-th key becomes a boundary,
+        # so partitions have (nearly) equal row counts regardless of key skew
+        keys = sql.Composed([sql.Identifier(pk) for pk in sorted(self.primary_keys)]).join(', ')
+        step = math.ceil(row_count / partitions)
+        cursor.execute(sql.SQL('''
+    SELECT {keys} FROM (
+        SELECT {keys}, row_number() OVER (ORDER BY {keys}) AS rn
+        FROM {table}) AS numbered
+    WHERE rn > 1 AND (rn - 1) %% %s = 0
+    ORDER BY rn''').format(keys=keys, table=self.table_self_identifier), [step])
+        column = sql.SQL('({})').format(keys)
+        bounds = [sql.SQL('({})').format(sql.Composed([sql.Literal(v) for v in row]).join(', '))
+                  for row in cursor.fetchall()]
+    elif self.database_object_type in ('table', 'materialized_view'):
+        cursor.execute(
+            sql.SQL("SELECT pg_relation_size({}::regclass) / current_setting('block_size')::int").format(
+                sql.Literal(self.table_self_identifier.as_string(cursor))))
+        blocks = cursor.fetchone()[0]
+        step = max(math.ceil(blocks / partitions), 1)
+        column = sql.SQL('ctid')
+        bounds = [sql.SQL('{}::tid').format(sql.Literal(f'({block},0)'))
+                  for block in range(step, blocks, step)]
+    else:
+        self.logger.info(f'{self.fully_qualified_table_name} has no primary key or ctid, extracting as one partition.')
+        return [None]
+
+    predicates = []
+    for i in range(len(bounds) + 1):
+        conditions = []
+        if i > 0:
+            conditions.append(sql.SQL('{} >= {}').format(column, bounds[i - 1]))
+        if i < len(bounds):
+            conditions.append(sql.SQL('{} < {}').format(column, bounds[i]))
+        predicates.append(sql.Composed(conditions).join(' AND ') if conditions else None)
+    return predicates
+
+def _copy_partition(self, snapshot_id:str, stmt:'sql.Composed', path:str) -> int:
+    '''COPY one partition to a CSV file without a header on its own connection,
+    seeing the data as of the exported snapshot. Return the number of rows written.'''
+    conn = self.connector.new_conn()
+    try:
+        conn.set_session(isolation_level='REPEATABLE READ', readonly=True)
+        with conn.cursor() as cursor, open(path, 'w', encoding='utf-8', newline='') as f:
+            cursor.execute('SET TRANSACTION SNAPSHOT %s', [snapshot_id])
+            cursor.execute("SET TIME ZONE 'US/Eastern'")
+            cursor.copy_expert(sql.SQL('COPY ({}) TO STDOUT WITH (FORMAT csv)').format(stmt), f)
+            return cursor.rowcount
+    finally:
+        conn.rollback()
+        conn.close()
+
+def parallel_extract(self, workers:int):
+    '''
+    Extract the table to self.csv_path using `workers` connections at once, then
+    load it to S3. The table is split into key (or ctid block) ranges which are
+    each COPY-ed to their own part file, all under one snapshot exported by a
+    coordinating connection so that the parts and the row count are consistent
+    with each other. The parts are then stitched into one CSV.
+    '''
+    self.logger.info(f'Starting parallel extract from {self.fully_qualified_table_name} with {workers} workers')
+    coordinator = self.connector.new_conn()
+    part_paths = []
+    try:
+        coordinator.set_session(isolation_level='REPEATABLE READ', readonly=True)
+        with coordinator.cursor() as cursor:
+            cursor.execute('SELECT pg_export_snapshot()')
+            snapshot_id = cursor.fetchone()[0]
+            cursor.execute(sql.SQL('SELECT count(*) FROM {}').format(self.table_self_identifier))
+            row_count = cursor.fetchone()[0]
+            self.logger.info(f'Rows to extract: {row_count:,}')
+            assert row_count != 0, 'Error! Row count of dataset in database is 0??'
+            predicates = self._partition_predicates(cursor, workers, row_count)
+
+        header, select_stmt = self.export_select_stmt()
+        statements = [select_stmt if where is None else select_stmt + sql.SQL(' WHERE {}').format(where) 
+                      for where in predicates]
+        part_paths = [f'{self.csv_path}.part{i}' for i in range(len(statements))]
+        self.logger.info(f'Extracting {len(statements)} partitions...')
+        with metrics.span('extract') as span, ThreadPoolExecutor(max_workers=workers) as executor:
+            futures = [executor.submit(self._copy_partition, snapshot_id, stmt, path)
+                       for stmt, path in zip(statements, part_paths)]
+            part_counts = [future.result() for future in futures]
+            span.rows = sum(part_counts)
+    except Exception as e:
+        for path in part_paths:
+            if os.path.isfile(path):
+                os.remove(path)
+        raise e
+    finally:
+        # The snapshot stays importable until the coordinating transaction ends
+        coordinator.rollback()
+        coordinator.close()
+
+    self.logger.info(f'Stitching {len(part_paths)} partitions into {self.csv_path}...')
+    with open(self.csv_path, 'w', encoding='utf-8', newline='') as outfile:
+        csv.writer(outfile, lineterminator='\n').writerow(header)
+        for path in part_paths:
+            with open(path, 'r', encoding='utf-8', newline='') as part:
+                shutil.copyfileobj(part, outfile, 1024 * 1024)
+            os.remove(path)
+
+    num_rows_in_csv = sum(part_counts)
+    self.logger.info(f'Asserting counts match between db snapshot and extracted csv')
+    self.logger.info(f'{row_count} == {num_rows_in_csv}')
+    assert row_count == num_rows_in_csv
+
+    self.check_remove_nulls()
+    self.load_csv_to_s3(path=self.csv_path)
@@ -0,0 +1,171 @@
+import os
+import re
+import json
+import hashlib
+import tempfile
+
+# Matches format_type() output for PostGIS and SDE geometry columns, e.g.
+# "geometry", "geometry(MultiPolygonZ,2272)", "public.geometry(Point)", "sde.st_geometry"
+GEOMETRY_FORMAT_RE = re.compile(
+    r'^(?:"?\w+"?\.)?(?:st_)?geometry(?:\((\w+?)(ZM|Z|M)?(?:,\d+)?\))?$', re.IGNORECASE)
+
+# One round trip for everything the Postgres properties need. data_type matches
+# what fields_and_types has always returned: information_schema.columns.data_type
+# for tables and the pg_type name for views and materialized views.
+METADATA_STMT = '''
+    SELECT c.oid, c.relkind,
+        (SELECT json_agg(json_build_array(
+            a.attname,
+            CASE WHEN c.relkind IN ('v', 'm') THEN t.typname
+                 WHEN t.typtype = 'd' THEN format_type(t.typbasetype, NULL)
+                 WHEN t.typelem <> 0 AND t.typlen = -1 THEN 'ARRAY'
+                 WHEN tn.nspname = 'pg_catalog' THEN format_type(a.atttypid, NULL)
+                 ELSE 'USER-DEFINED' END,
+            format_type(a.atttypid, a.atttypmod)) ORDER BY a.attnum)
+         FROM pg_attribute a
+         JOIN pg_type t ON t.oid = a.atttypid
+         JOIN pg_namespace tn ON tn.oid = t.typnamespace
+         WHERE a.attrelid = c.oid AND a.attnum > 0 AND NOT a.attisdropped) AS columns,
+        con.conname,
+        (SELECT json_agg(a.attname ORDER BY a.attnum)
+         FROM pg_attribute a
+         WHERE a.attrelid = c.oid AND a.attnum = ANY(con.conkey)) AS primary_keys,
+        EXISTS(SELECT 1 FROM pg_proc WHERE proname = 'geometry_type') AS has_geometry_type
+    FROM pg_class c
+    LEFT JOIN pg_constraint con ON con.conrelid = c.oid AND con.contype = 'p'
+    WHERE c.oid = to_regclass(%s)
+    '''
+
+# Cheap check of whether a table's definition changed since it was cached. ANALYZE
+# and VACUUM update pg_class in place so they don't change xmin, but DDL does, and
+# any change to a column or to the primary key replaces its catalog row.
+STATE_STMT = '''
+    SELECT c.oid, concat_ws(':', c.xmin,
+        (SELECT max(a.xmin::text::bigint) FROM pg_attribute a WHERE a.attrelid = c.oid),
+        (SELECT string_agg(con.oid || '.' || con.xmin, ',')
+         FROM pg_constraint con WHERE con.conrelid = c.oid AND con.contype = 'p'))
+    FROM pg_class c
+    WHERE c.oid = to_regclass(%s)
+    '''
+
+
+def parse_geometry_format(format_type:str):
+    '''Return `(is_geometry, geom_type)` for a column's format_type(), where
+    geom_type is e.g. "MULTIPOLYGON Z" or None if the column has no type modifier'''
+    match = GEOMETRY_FORMAT_RE.match(format_type)
+    if not match:
+        return False, None
+    base, dims = match.groups()
+    if base is None:
+        return True, None
+    # Name dimensions the same way as MULTI_GEOM_TYPES
+    dims = {'ZM': 'MZ'}.get(dims, dims)
+    return True, base.upper() + (f' {dims}' if dims else '')
+
+
+class Table_Metadata():
+    '''
+    Catalog information about one table or view, loaded with a single query.
+    `columns` is a list of `[name, data_type, format_type]` in column order.
+
+    If cache_dir is given, metadata is also kept there as JSON, one file per
+    database and table OID, and reused for as long as the table's catalog state
+    is unchanged. TEMP tables are never cached on disk.
+    '''
+    def __init__(self, oid:int, relkind:str, columns:list, pk_constraint_name:str,
+                 primary_keys:list, has_geometry_type:bool):
+        self.oid = oid
+        self.relkind = relkind
+        self.columns = columns
+        self.pk_constraint_name = pk_constraint_name
+        self.primary_keys = primary_keys
+        self.has_geometry_type = has_geometry_type
+
+    @property
+    def fields(self) -> list:
+        return [name for name, _, _ in self.columns]
+
+    @property
+    def column_types(self) -> dict:
+        '''{column: type} with type modifiers, e.g. "numeric(38,8)"'''
+        return {name: format_type for name, _, format_type in self.columns}
+
+    @property
+    def geom_field(self):
+        '''The first geometry (PostGIS) or st_geometry (SDE) column, if any'''
+        for name, _, format_type in self.columns:
+            if parse_geometry_format(format_type)[0]:
+                return name
+        return None
+
+    @property
+    def geom_type(self):
+        '''The geometry type from the geometry column's type modifier, if any'''
+        for name, _, format_type in self.columns:
+            is_geometry, geom_type = parse_geometry_format(format_type)
+            if is_geometry:
+                return geom_type
+        return None
+
+    def to_dict(self) -> dict:
+        return {'oid': self.oid, 'relkind': self.relkind, 'columns': self.columns,
+                'pk_constraint_name': self.pk_constraint_name,
+                'primary_keys': self.primary_keys,
+                'has_geometry_type': self.has_geometry_type}
+
+    @classmethod
+    def query(cls, cursor, regclass:str) -> 'Table_Metadata':
+        cursor.execute(METADATA_STMT, [regclass])
+        row = cursor.fetchone()
+        if row is None:
+            raise AssertionError(f'Table doesnt appear to exist?: {regclass}')
+        oid, relkind, columns, pk_constraint_name, primary_keys, has_geometry_type = row
+        return cls(oid, relkind, columns or [], pk_constraint_name, primary_keys or [],
+                   has_geometry_type)
+
+    @classmethod
+    def load(cls, conn, regclass:str, cache_dir:str=None, temporary:bool=False,
+             logger=None) -> 'Table_Metadata':
+        '''Return the metadata for regclass, e.g. '"schema"."table"', from cache_dir
+        if it is still current, else from the database'''
+        with conn.cursor() as cursor:
+            if cache_dir is None or temporary:
+                return cls.query(cursor, regclass)
+
+            cursor.execute(STATE_STMT, [regclass])
+            row = cursor.fetchone()
+            if row is None:
+                raise AssertionError(f'Table doesnt appear to exist?: {regclass}')
+            oid, state = row
+            dsn = conn.get_dsn_parameters()
+            database = hashlib.md5(
+                f'{dsn.get("host")}:{dsn.get("port")}/{dsn.get("dbname")}'.encode()).hexdigest()
+            path = os.path.join(cache_dir, f'{database}_{oid}.json')
+
+            if os.path.isfile(path):
+                with open(path) as f:
+                    cached = json.load(f)
+                if cached['state'] == state:
+                    if logger:
+                        logger.info(f'Using cached metadata for {regclass} from {path}')
+                    return cls(**cached['metadata'])
+
+            metadata = cls.query(cursor, regclass)
+            os.makedirs(cache_dir, exist_ok=True)
+            # Write then rename so that concurrent runs never read a partial file
+            fd, tmp_path = tempfile.mkstemp(dir=cache_dir, suffix='.tmp')
+            with os.fdopen(fd, 'w') as f:
+                json.dump({'state': state, 'metadata': metadata.to_dict()}, f)
+            os.replace(tmp_path, path)
+            return metadata
+
+
+@property
+def metadata(self) -> 'Table_Metadata':
+    '''Get or return the catalog metadata for this table, see Table_Metadata'''
+    if self._metadata is None:
+        self._metadata = Table_Metadata.load(
+            self.conn, self.table_self_identifier.as_string(self.conn),
+            cache_dir=self.metadata_cache_dir, temporary=self.table_schema == None,
+            logger=self.logger)
+    return self._metadata
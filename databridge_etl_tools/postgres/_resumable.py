@@ -0,0 +1,212 @@
+import csv
+import json
+import itertools
+import contextlib
+import psycopg2.sql as sql
+from .. import s3_transfer, parquet, metrics, pg_indexes
+from ._stream import STREAM_CHUNK_SIZE, Iterator_File, iter_lines, iter_csv_chunks
+
+# Default size of each committed chunk of a resumable load
+RESUME_CHUNK_MB = 128
+
+
+def _record_end(data:bytes, end:int, step) -> int:
+    '''Move from the newline at index end with step (bytes.find or bytes.rfind)
+    until the newline is outside quotes, i.e. preceded by an even number of
+    quote characters. Return its index or -1.'''
+    while end >= 0 and data.count(b'"', 0, end) % 2:
+        end = step(end)
+    return end
+
+def iter_record_blocks(chunks):
+    '''
+    Regroup an iterator of CSV byte chunks into blocks that each end on a record
+    boundary, a newline outside quotes, so that the end of any block is a safe
+    offset to resume from. Quotes inside quoted fields are doubled in CSV, so a
+    newline is inside a field exactly when an odd number of quotes precedes it.
+    '''
+    pending = b''
+    for chunk in chunks:
+        data = pending + chunk
+        end = _record_end(data, data.rfind(b'\n'), lambda i: data.rfind(b'\n', 0, i))
+        if end < 0:
+            pending = data
+            continue
+        yield data[:end + 1]
+        pending = data[end + 1:]
+    if pending:
+        yield pending
+
+def split_first_record(block:bytes) -> tuple:
+    '''Return `(first record, rest)` of a block of CSV bytes'''
+    end = _record_end(block, block.find(b'\n'), lambda i: block.find(b'\n', i + 1))
+    if end < 0:
+        return block, b''
+    return block[:end + 1], block[end + 1:]
+
+def iter_chunks(blocks, chunk_bytes:int):
+    '''Group record blocks into lists of at least chunk_bytes bytes, except the last'''
+    chunk, size = [], 0
+    for block in blocks:
+        chunk.append(block)
+        size += len(block)
+        if size >= chunk_bytes:
+            yield chunk
+            chunk, size = [], 0
+    if chunk:
+        yield chunk
+
+
+def _resume_table_identifier(self) -> 'sql.Identifier':
+    return sql.Identifier(self.table_schema, self.resume_table_name)
+
+def _read_checkpoint(self):
+    '''Return the checkpoint of an earlier resumable load of this table, kept as the
+    JSON comment of its resume table, or None if there is no resume table'''
+    if not self.check_exists(self.resume_table_name, self.table_schema):
+        return None
+    comment = self.execute_sql('''
+    SELECT obj_description(c.oid, 'pg_class')
+    FROM pg_class c JOIN pg_namespace n ON n.oid = c.relnamespace
+    WHERE n.nspname = %s AND c.relname = %s''',
+        data=[self.table_schema, self.resume_table_name], fetch='one')[0]
+    return json.loads(comment) if comment else {}
+
+def _write_checkpoint(self, cursor, checkpoint:dict):
+    cursor.execute(sql.SQL('COMMENT ON TABLE {} IS {}').format(
+        self._resume_table_identifier(), sql.Literal(json.dumps(checkpoint))))
+
+def _checkpoint_problem(self, checkpoint:dict, s3_object:dict, mapping_dict:dict):
+    '''Return why a checkpoint can't be resumed from, or None if it can'''
+    if checkpoint.get('s3_bucket') != self.s3_bucket or checkpoint.get('s3_key') != self.s3_key:
+        return 'it was for a different S3 object'
+    if checkpoint.get('etag') != s3_object['etag']:
+        return 'the S3 object has changed since'
+    if checkpoint.get('mapping_dict') != mapping_dict:
+        return 'the column mappings have changed since'
+    rows = self.execute_sql(
+        sql.SQL('SELECT count(*) FROM {}').format(self._resume_table_identifier()), fetch='one')[0]
+    # Unlogged tables are emptied if the server crashes
+    if rows != checkpoint.get('rows'):
+        return f'the resume table has {rows:,} rows rather than {checkpoint.get("rows", 0):,}'
+    return None
+
+def _create_resume_table(self, header:list, mapping_dict:dict, checkpoint:dict):
+    '''Create the UNLOGGED resume table with the mapped columns of header, taking
+    their types (but not their constraints or defaults) from this table, and commit
+    it with its first checkpoint'''
+    cols_composed = sql.Composed(
+        [sql.Identifier(mapping_dict.get(col, col)) for col in header]).join(', ')
+    with self.conn.cursor() as cursor:
+        cursor.execute(sql.SQL('DROP TABLE IF EXISTS {}').format(self._resume_table_identifier()))
+        cursor.execute(sql.SQL('''
+    CREATE UNLOGGED TABLE {resume_table} AS
+    SELECT {cols_composed} FROM {table_schema_name}
+    WITH NO DATA''').format(
+            resume_table=self._resume_table_identifier(),
+            cols_composed=cols_composed,
+            table_schema_name=self.table_self_identifier))
+        self._write_checkpoint(cursor, checkpoint)
+    self.conn.commit()
+    self.logger.info(f'Created resume table {self.table_schema}.{self.resume_table_name}\n')
+
+def _copy_resume_chunk(self, blocks:list, checkpoint:dict, binary:bool, encoding:str):
+    '''COPY one chunk of record blocks into the resume table and commit it together
+    with the checkpoint that moves past it'''
+    header, mapping_dict = checkpoint['header'], checkpoint['mapping_dict']
+    rows = self.multi_geom_rows(checkpoint['source_header'], csv.reader(iter_lines(blocks, encoding)))
+    if binary:
+        count = self._copy_binary(rows, header, self._resume_table_identifier(), mapping_dict)
+    else:
+        count = self._copy_from(Iterator_File(iter_csv_chunks(header, rows)), header,
+                                self._resume_table_identifier(), mapping_dict, size=STREAM_CHUNK_SIZE)
+    checkpoint['offset'] += sum(len(block) for block in blocks)
+    checkpoint['rows'] += count
+    with self.conn.cursor() as cursor:
+        self._write_checkpoint(cursor, checkpoint)
+    self.conn.commit()
+    self.logger.info(f'Committed chunk ending at byte {checkpoint["offset"]:,}, '
+                     f'{checkpoint["rows"]:,} rows loaded so far.\n')
+
+def resumable_load(self, mapping_dict:dict={}, truncate_before_load:bool=False,
+                   binary:bool=False, chunk_mb:int=RESUME_CHUNK_MB, encoding:str='utf-8', 
+                   defer_indexes:bool=False):
+    '''
+    Load the CSV at s3://s3_bucket/s3_key in chunks of about chunk_mb MB, each
+    COPY-ed into an UNLOGGED resume table ("<table>_resume", in the same schema)
+    and committed together with a checkpoint of the S3 byte offset and row count
+    reached, which is kept as the resume table's comment. The object is read with
+    ranged GETs, so if a load fails, running it again resumes from the last
+    committed chunk rather than from the start. A checkpoint is only resumed from
+    if the object's ETag, the column mappings and the resume table's row count
+    still match it.
+
+    Once every chunk is in, the rows are INSERT-ed into this table (after a DELETE
+    of its rows if truncate_before_load) and the resume table is dropped, in the
+    transaction that is committed when the `with Postgres(...)` block exits. With
+    defer_indexes, the table's indexes are dropped before that insert and built
+    again after it, see `databridge_etl_tools.pg_indexes`.
+
+    Chunks must start on a record boundary, so the CSV must be uncompressed. The
+    same geometry and header fixes as `prepare_file()` are applied.
+    '''
+    if parquet.is_parquet_key(self.s3_key):
+        raise ValueError('Resumable loads read CSV files by byte offset, Parquet staging files are not supported')
+    s3_object = s3_transfer.head_object(self.s3_bucket, self.s3_key)
+    if s3_object['compression'] is not None:
+        raise ValueError(f'Resumable loads need an uncompressed CSV, s3://{self.s3_bucket}/{self.s3_key} '
+                         f'is {s3_object["compression"]} compressed')
+
+    checkpoint = self._read_checkpoint()
+    if checkpoint is not None:
+        problem = self._checkpoint_problem(checkpoint, s3_object, mapping_dict)
+        if problem is not None:
+            self.logger.info(f'Not resuming from the existing resume table because {problem}\n')
+            checkpoint = None
+
+    if checkpoint is None:
+        body = s3_transfer.open_range(self.s3_bucket, self.s3_key, 0, s3_object['etag'])
+        blocks = iter_record_blocks(iter(lambda: body.read(STREAM_CHUNK_SIZE), b''))
+        raw_header, rest = split_first_record(next(blocks, b''))
+        if not raw_header.strip():
+            raise AssertionError(f'Error! s3://{self.s3_bucket}/{self.s3_key} is empty?')
+        source_header = next(csv.reader([raw_header.decode(encoding)]))
+        checkpoint = {
+            's3_bucket': self.s3_bucket, 's3_key': self.s3_key, 'etag': s3_object['etag'],
+            'mapping_dict': mapping_dict, 'source_header': source_header,
+            'header': self._fix_header(source_header, mapping_dict),
+            'offset': len(raw_header), 'rows': 0}
+        self._create_resume_table(checkpoint['header'], mapping_dict, checkpoint)
+        if rest:
+            blocks = itertools.chain([rest], blocks)
+    else:
+        self.logger.info(f'Resuming load of s3://{self.s3_bucket}/{self.s3_key} from byte '
+                         f'{checkpoint["offset"]:,} of {s3_object["size"]:,}, with '
+                         f'{checkpoint["rows"]:,} rows already loaded\n')
+        blocks = []
+        if checkpoint['offset'] < s3_object['size']:
+            body = s3_transfer.open_range(self.s3_bucket, self.s3_key, checkpoint['offset'], s3_object['etag'])
+            blocks = iter_record_blocks(iter(lambda: body.read(STREAM_CHUNK_SIZE), b''))
+
+    for chunk in iter_chunks(blocks, chunk_mb * 1024 * 1024):
+        self._copy_resume_chunk(chunk, checkpoint, binary, encoding)
+
+    if truncate_before_load:
+        self.delete_from_truncate()
+    cols_composed = sql.Composed(
+        [sql.Identifier(mapping_dict.get(col, col)) for col in checkpoint['header']]).join(', ')
+    insert_stmt = sql.SQL('''
+    INSERT INTO {table_schema_name} ({cols_composed})
+    SELECT {cols_composed} FROM {resume_table}''').format(
+        table_schema_name=self.table_self_identifier,
+        cols_composed=cols_composed,
+        resume_table=self._resume_table_identifier())
+    with self.conn.cursor() as cursor:
+        self.logger.info(f'insert_statement:{cursor.mogrify(insert_stmt).decode()}')
+        with (pg_indexes.Deferred_Indexes(cursor, self.table_schema, self.table_name, self.logger)
+              if defer_indexes else contextlib.nullcontext()):
+            with metrics.span('insert') as span:
+                cursor.execute(insert_stmt)
+                span.rows = cursor.rowcount
+            self.logger.info(f'Insert from resume table successful: {span.rows:,} rows inserted.\n')
+        cursor.execute(sql.SQL('DROP TABLE {}').format(self._resume_table_identifier()))
@@ -0,0 +1,137 @@
+import codecs
+import csv
+import io
+from .postgres_map import MULTI_GEOM_TYPES
+from .. import parquet
+
+# Size of the chunks read from S3 and handed to psycopg2's copy_expert
+STREAM_CHUNK_SIZE = 1024 * 1024
+
+
+def to_multi_geom(value:str) -> str:
+    '''Promote a single-part EWKT geometry to its MULTI equivalent, e.g.
+    "SRID=2272;POLYGON ((...))" becomes "SRID=2272;MULTIPOLYGON (((...)))". Empty
+    values and geometries that are already MULTI are returned unchanged.'''
+    if not value or '(' not in value:
+        return value
+    row_geom_type = value.split('(')[0].split(';')[-1].strip()
+    if 'MULTI' in row_geom_type:
+        return value
+    return value.replace(row_geom_type, 'MULTI' + row_geom_type + ' (', 1) + ')'
+
+
+class Iterator_File():
+    '''
+    Minimal read-only file-like object over an iterator of str or bytes chunks,
+    suitable for passing to `cursor.copy_expert()` so that data can be streamed
+    into Postgres without first being written to disk.
+    '''
+    def __init__(self, chunks):
+        self._chunks = iter(chunks)
+        self._buffer = None
+        self._empty = ''
+
+    def read(self, size:int=-1):
+        parts = []
+        remaining = size
+        while size < 0 or remaining > 0:
+            if not self._buffer:
+                self._buffer = next(self._chunks, None)
+                if self._buffer is None:
+                    break
+                self._empty = self._buffer[:0]
+            if size < 0:
+                parts.append(self._buffer)
+                self._buffer = None
+            else:
+                parts.append(self._buffer[:remaining])
+                self._buffer = self._buffer[remaining:]
+                remaining -= len(parts[-1])
+        return self._empty.join(parts)
+
+    def readline(self, size:int=-1):
+        raise io.UnsupportedOperation('Iterator_File does not support readline()')
+
+
+def iter_lines(chunks, encoding:str='utf-8'):
+    '''Decode an iterator of byte chunks and yield lines ending with "\\n". Only
+    "\\n" is treated as a line break so that the csv module can still handle
+    other characters inside quoted fields.'''
+    decoder = codecs.getincrementaldecoder(encoding)()
+    pending = ''
+    for chunk in chunks:
+        lines = (pending + decoder.decode(chunk)).split('\n')
+        pending = lines.pop()
+        for line in lines:
+            yield line + '\n'
+    pending += decoder.decode(b'', final=True)
+    if pending:
+        yield pending
+
+
+def iter_csv_chunks(header:list, rows, chunk_size:int=STREAM_CHUNK_SIZE):
+    '''Serialize a header and an iterator of rows back to CSV text, yielding
+    chunks of roughly chunk_size characters'''
+    buffer = io.StringIO()
+    writer = csv.writer(buffer)
+    writer.writerow(header)
+    for row in rows:
+        writer.writerow(row)
+        if buffer.tell() >= chunk_size:
+            yield buffer.getvalue()
+            buffer.seek(0)
+            buffer.truncate()
+    if buffer.tell():
+        yield buffer.getvalue()
+
+
+def stream_rows(self, mapping_dict:dict=None, encoding:str='utf-8'):
+    '''
+    Read the CSV at s3://s3_bucket/s3_key in chunks, decompressing it on the fly if 
+    it is gzip or zstd compressed, and return `(header, rows)`, 
+    where rows is an iterator over the data rows with the same multi-geometry and 
+    header fixes as `prepare_file()` applied. Nothing is written to local disk.
+
+    Unlike `prepare_file()` this cannot fall back to latin-1 part way through the
+    object, so pass `encoding` explicitly for non utf-8 files.
+    '''
+    body = self.get_csv_stream_from_s3()
+    reader = csv.reader(iter_lines(iter(lambda: body.read(STREAM_CHUNK_SIZE), b''), encoding))
+    try:
+        header = next(reader)
+    except StopIteration:
+        raise AssertionError(f'Error! s3://{self.s3_bucket}/{self.s3_key} is empty?')
+
+    self.logger.info(f'self.geom_field is: {self.geom_field}')
+    self.logger.info(f'self.geom_type is: {self.geom_type}\n')
+    if self.geom_field is not None and self.geom_type in MULTI_GEOM_TYPES and self.geom_field in header:
+        self.logger.info('Detected that shape type needs conversion to MULTI....')
+    return self._fix_header(header, mapping_dict), self.multi_geom_rows(header, reader)
+
+def multi_geom_rows(self, header:list, rows):
+    '''Return rows (lists of CSV strings) with single-part geometries promoted to 
+    MULTI where the table needs it, like `prepare_file()` does'''
+    if self.geom_field is None or self.geom_type not in MULTI_GEOM_TYPES or self.geom_field not in header:
+        return rows
+    geom_index = header.index(self.geom_field)
+    return (row[:geom_index] + [to_multi_geom(row[geom_index])] + row[geom_index + 1:]
+            for row in rows)
+
+def parquet_rows(self, mapping_dict:dict=None):
+    '''
+    Read the Parquet staging file at self.csv_path in record batches and return 
+    `(header, rows)` like `stream_rows()`. Geometries are passed on as hex EWKB, 
+    promoted to MULTI where the table needs it, so they are never parsed as text.
+    '''
+    to_multi = self.geom_field is not None and self.geom_type in MULTI_GEOM_TYPES
+    if to_multi: 
+        self.logger.info('Detected that shape type needs conversion to MULTI....')
+    rows = iter(parquet.Parquet_View(self.csv_path, geometry_format='hexewkb', to_multi=to_multi))
+    header = next(rows)
+    return self._fix_header(header, mapping_dict), rows
+
+def prepare_stream(self, mapping_dict:dict=None, encoding:str='utf-8'):
+    '''Streaming equivalent of `prepare_file()`, see `stream_rows()`. Return 
+    `(header, file_obj)` where file_obj can be passed straight to COPY.'''
+    header, rows = self.stream_rows(mapping_dict, encoding)
+    return header, Iterator_File(iter_csv_chunks(header, rows))
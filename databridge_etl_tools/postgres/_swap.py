@@ -0,0 +1,212 @@
+import time
+import psycopg2
+import psycopg2.sql as sql
+from .. import metrics
+
+# How long the swap waits for its ACCESS EXCLUSIVE lock on the table, and how many
+# times it tries, so that it never queues readers behind a long running query
+SWAP_LOCK_TIMEOUT = '5s'
+SWAP_LOCK_ATTEMPTS = 6
+
+
+def _swap_table_identifier(self) -> 'sql.Identifier':
+    return sql.Identifier(self.table_schema, self.swap_table_name)
+
+def _swap_blockers(self) -> list:
+    '''Return the reasons, if any, that this table can't be replaced by a sibling:
+    objects that point at the table itself rather than at its name'''
+    blockers = []
+    oid = self.fully_qualified_table_name
+    views = self.execute_sql('''
+    SELECT DISTINCT v.oid::regclass::text
+    FROM pg_depend d
+    JOIN pg_rewrite r ON r.oid = d.objid
+    JOIN pg_class v ON v.oid = r.ev_class
+    WHERE d.classid = 'pg_rewrite'::regclass AND d.refobjid = %s::regclass
+        AND v.oid <> %s::regclass''', data=[oid, oid], fetch='all')
+    blockers += [f'view {view} depends on it' for view, in views]
+    foreign_keys = self.execute_sql('''
+    SELECT conname, conrelid::regclass::text
+    FROM pg_constraint
+    WHERE contype = 'f' AND confrelid = %s::regclass''', data=[oid], fetch='all')
+    blockers += [f'foreign key {name} on {table} references it' for name, table in foreign_keys]
+    triggers = self.execute_sql('''
+    SELECT tgname FROM pg_trigger WHERE tgrelid = %s::regclass AND NOT tgisinternal''',
+        data=[oid], fetch='all')
+    blockers += [f'it has trigger {name}' for name, in triggers]
+    inherits = self.execute_sql('''
+    SELECT count(*) FROM pg_inherits WHERE inhrelid = %s::regclass OR inhparent = %s::regclass''',
+        data=[oid, oid], fetch='one')[0]
+    if inherits or self.metadata.relkind == 'p':
+        blockers.append('it is partitioned or part of an inheritance tree')
+    return blockers
+
+def _swap_index_statements(self) -> list:
+    '''
+    Return `(temporary name, final name, statement)` for each of this table's
+    indexes, with the statement creating it on the swap table. Indexes behind
+    primary key, unique and exclusion constraints are created by adding the
+    constraint. Index names are unique within a schema, so each is created under
+    a temporary name and renamed once the original table is gone.
+    '''
+    rows = self.execute_sql('''
+    SELECT i.relname, quote_ident(i.relname), pg_get_indexdef(i.oid),
+        con.conname, pg_get_constraintdef(con.oid),
+        quote_ident(n.nspname) || '.' || quote_ident(t.relname)
+    FROM pg_index x
+    JOIN pg_class i ON i.oid = x.indexrelid
+    JOIN pg_class t ON t.oid = x.indrelid
+    JOIN pg_namespace n ON n.oid = t.relnamespace
+    LEFT JOIN pg_constraint con ON con.conindid = x.indexrelid AND con.conrelid = x.indrelid
+        AND con.contype IN ('p', 'u', 'x')
+    WHERE x.indrelid = %s::regclass
+    ORDER BY x.indisprimary DESC, i.relname''', data=[self.fully_qualified_table_name], fetch='all')
+    statements = []
+    for i, (name, quoted_name, index_def, constraint, constraint_def, quoted_table) in enumerate(rows):
+        temp_name = f'{name[:54]}_swap{i}'
+        if constraint is not None:
+            stmt = sql.SQL('ALTER TABLE {} ADD CONSTRAINT {} {}').format(
+                self._swap_table_identifier(), sql.Identifier(temp_name), sql.SQL(constraint_def))
+        else:
+            prefix = f' INDEX {quoted_name} ON {quoted_table} '
+            if prefix not in index_def:
+                raise ValueError(f'Could not parse the definition of index {name}: {index_def}')
+            swap_prefix = sql.SQL(' INDEX {} ON {} ').format(
+                sql.Identifier(temp_name), self._swap_table_identifier()).as_string(self.conn)
+            stmt = sql.SQL(index_def.replace(prefix, swap_prefix, 1))
+        statements.append((temp_name, name, stmt))
+    return statements
+
+def _swap_sequences(self) -> list:
+    '''Return `(sequence schema, sequence name, column, dependency type)` for the
+    sequences owned by this table's columns: "a" for serial columns, "i" for
+    identity columns'''
+    return self.execute_sql('''
+    SELECT n.nspname, s.relname, a.attname, d.deptype
+    FROM pg_depend d
+    JOIN pg_class s ON s.oid = d.objid AND s.relkind = 'S'
+    JOIN pg_namespace n ON n.oid = s.relnamespace
+    JOIN pg_attribute a ON a.attrelid = d.refobjid AND a.attnum = d.refobjsubid
+    WHERE d.classid = 'pg_class'::regclass AND d.refclassid = 'pg_class'::regclass
+        AND d.refobjid = %s::regclass AND d.deptype IN ('a', 'i')''',
+        data=[self.fully_qualified_table_name], fetch='all')
+
+def _create_swap_table(self):
+    '''Create the swap table with the same columns, defaults, identity columns and
+    CHECK constraints as this table, its owner, grants, comment and storage
+    parameters, but no indexes'''
+    swap_table = self._swap_table_identifier()
+    owner, comment, reloptions = self.execute_sql('''
+    SELECT pg_get_userbyid(relowner), obj_description(oid, 'pg_class'),
+        array_to_string(reloptions, ', ')
+    FROM pg_class WHERE oid = %s::regclass''', data=[self.fully_qualified_table_name], fetch='one')
+    grants = self.execute_sql('''
+    SELECT CASE WHEN a.grantee = 0 THEN 'PUBLIC' ELSE quote_ident(pg_get_userbyid(a.grantee)) END,
+        string_agg(a.privilege_type, ', ')
+    FROM pg_class c, aclexplode(c.relacl) a
+    WHERE c.oid = %s::regclass
+    GROUP BY a.grantee''', data=[self.fully_qualified_table_name], fetch='all')
+
+    with self.conn.cursor() as cursor:
+        cursor.execute(sql.SQL('DROP TABLE IF EXISTS {}').format(swap_table))
+        cursor.execute(sql.SQL('CREATE TABLE {} (LIKE {} INCLUDING ALL EXCLUDING INDEXES)').format(
+            swap_table, self.table_self_identifier))
+        if reloptions:
+            cursor.execute(sql.SQL('ALTER TABLE {} SET ({})').format(swap_table, sql.SQL(reloptions)))
+        if comment is not None:
+            cursor.execute(sql.SQL('COMMENT ON TABLE {} IS {}').format(swap_table, sql.Literal(comment)))
+        cursor.execute('SELECT current_user')
+        if cursor.fetchone()[0] != owner:
+            cursor.execute(sql.SQL('ALTER TABLE {} OWNER TO {}').format(swap_table, sql.Identifier(owner)))
+        # grantee is quoted already, or PUBLIC
+        for grantee, privileges in grants:
+            cursor.execute(sql.SQL('GRANT {} ON {} TO {}').format(
+                sql.SQL(privileges), swap_table, sql.SQL(grantee)))
+    self.logger.info(f'Created swap table {self.table_schema}.{self.swap_table_name}\n')
+
+def _swap_in(self, index_names:list):
+    '''In one short transaction, drop this table and rename the swap table and its
+    indexes to take its place, moving any sequences it owns across first'''
+    swap_table = self._swap_table_identifier()
+    with self.conn.cursor() as cursor:
+        cursor.execute('SET LOCAL lock_timeout = %s', [SWAP_LOCK_TIMEOUT])
+        cursor.execute(sql.SQL('LOCK TABLE {} IN ACCESS EXCLUSIVE MODE').format(self.table_self_identifier))
+        for seq_schema, seq_name, column, deptype in self._swap_sequences():
+            sequence = sql.Identifier(seq_schema, seq_name)
+            if deptype == 'a':
+                # serial: the swap table's default already uses this sequence
+                cursor.execute(sql.SQL('ALTER SEQUENCE {} OWNED BY {}.{}').format(
+                    sequence, swap_table, sql.Identifier(column)))
+            else:
+                # identity: the swap table has its own sequence, carry on from this one
+                cursor.execute(sql.SQL('''
+    SELECT setval(pg_get_serial_sequence(%s, %s), last_value, is_called) FROM {}''').format(sequence),
+                    [f'{self.table_schema}.{self.swap_table_name}', column])
+        cursor.execute(sql.SQL('DROP TABLE {}').format(self.table_self_identifier))
+        cursor.execute(sql.SQL('ALTER TABLE {} RENAME TO {}').format(
+            swap_table, sql.Identifier(self.table_name)))
+        for temp_name, name in index_names:
+            cursor.execute(sql.SQL('ALTER INDEX {} RENAME TO {}').format(
+                sql.Identifier(self.table_schema, temp_name), sql.Identifier(name)))
+    self.conn.commit()
+
+def swap_load(self, column_mappings:str=None, mappings_file:str=None, stream:bool=False,
+              binary:bool=False):
+    '''
+    Replace the table's rows without DELETE-ing them: COPY the CSV from S3 into a
+    new sibling table ("<table>_swap") with the same columns, defaults and
+    constraints, build the table's indexes on it once the rows are in, ANALYZE it
+    and commit. Then, in a short transaction, drop the table and rename the
+    sibling and its indexes in its place. Readers keep using the old table until
+    then, and there are no dead rows to vacuum afterwards.
+
+    Refuses tables that other objects point at by identity rather than by name,
+    see `_swap_blockers()`. Owned sequences are moved to the new table, and the
+    owner, grants, comment and storage parameters are copied. The lock for the
+    swap is taken with a lock_timeout and retried, so a long running query on
+    the table delays the swap rather than blocking every reader queued behind it.
+    '''
+    from .postgres import Postgres
+    blockers = self._swap_blockers()
+    if blockers:
+        raise ValueError(f'Cannot swap load {self.fully_qualified_table_name} because '
+                         + '; '.join(blockers))
+    index_statements = self._swap_index_statements()
+
+    self._create_swap_table()
+    swap = Postgres(connector=self.connector, table_name=self.swap_table_name,
+                    table_schema=self.table_schema, s3_bucket=self.s3_bucket, s3_key=self.s3_key)
+    try:
+        swap.load(column_mappings=column_mappings, mappings_file=mappings_file,
+                  stream=stream, binary=binary)
+    finally:
+        swap.cleanup()
+    with self.conn.cursor() as cursor:
+        for temp_name, name, stmt in index_statements:
+            self.logger.info(f'Building index {name}: {cursor.mogrify(stmt).decode()}')
+            with metrics.span('index', index=name):
+                cursor.execute(stmt)
+        with metrics.span('analyze'):
+            cursor.execute(sql.SQL('ANALYZE {}').format(self._swap_table_identifier()))
+    self.conn.commit()
+
+    index_names = [(temp_name, name) for temp_name, name, _ in index_statements]
+    for attempt in range(1, SWAP_LOCK_ATTEMPTS + 1):
+        try:
+            with metrics.span('swap'):
+                self._swap_in(index_names)
+            break
+        except psycopg2.errors.LockNotAvailable:
+            self.conn.rollback()
+            if attempt == SWAP_LOCK_ATTEMPTS:
+                self.execute_sql(sql.SQL('DROP TABLE {}').format(self._swap_table_identifier()))
+                self.conn.commit()
+                raise
+            self.logger.info(f'Could not lock {self.fully_qualified_table_name} within '
+                             f'{SWAP_LOCK_TIMEOUT} (attempt {attempt:,}/{SWAP_LOCK_ATTEMPTS:,}), retrying...')
+            time.sleep(attempt * 5)
+    # The table is new, so there are no dead rows to vacuum and ANALYZE has run
+    self.vacuum_on_exit = False
+    self._metadata = None
+    self.logger.info(f'Swapped {self.table_schema}.{self.swap_table_name} in as '
+                     f'{self.fully_qualified_table_name}\n')
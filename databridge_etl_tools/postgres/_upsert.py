@@ -0,0 +1,257 @@
+import json
+import psycopg2.sql as sql
+
+
+def parse_resume_after(resume_after, key_count:int) -> list:
+    '''Return the primary key values of a resume_after given as the JSON list that
+    chunked upserts log, e.g. '[12, "a,b"]'. With one key, a value that isn't a
+    JSON list is taken as the key itself, commas and all.'''
+    if not isinstance(resume_after, str):
+        return resume_after
+    try:
+        values = json.loads(resume_after)
+    except ValueError:
+        values = None
+    if isinstance(values, list):
+        return values
+    if key_count == 1:
+        return [resume_after]
+    raise ValueError(f'resume_after should be a JSON list of the {key_count} primary key values, '
+                     f'as logged by the chunked upsert, got {resume_after}')
+
+def _column_types(self) -> dict:
+    '''Return {column: type} for this table, with type modifiers, e.g.
+    "numeric(38,8)" or "geometry(Point,2272)"'''
+    return self.metadata.column_types
+
+def _staging_keys(self, staging:'Postgres', mapping_dict:dict={}) -> list:
+    '''Return the staging column names of this table's primary keys, in sorted order
+    of the production names'''
+    prod_to_staging = {mapping_dict.get(staging_field, staging_field): staging_field
+                       for staging_field in staging.fields}
+    staging_keys = []
+    for pk in sorted(self.primary_keys):
+        if pk not in prod_to_staging:
+            raise ValueError(f'Primary key {pk} of {self.fully_qualified_table_name} is not in the staging data')
+        staging_keys.append(prod_to_staging[pk])
+    return staging_keys
+
+def _delete_missing_keys(self, staging:'Postgres', mapping_dict:dict={}) -> int:
+    '''Delete production rows whose primary key does not appear in staging with
+    an anti-join, returning the number of rows deleted'''
+    join_composed = sql.Composed([
+        sql.SQL('PROD.') + sql.Identifier(pk) + sql.SQL(' = ') + sql.SQL('STAGING.') + sql.Identifier(staging_key)
+        for pk, staging_key in zip(sorted(self.primary_keys), self._staging_keys(staging, mapping_dict))
+        ]).join(' AND ')
+    delete_stmt = sql.SQL('''
+    DELETE FROM {table_schema_name} AS PROD
+    WHERE NOT EXISTS (
+        SELECT 1 FROM {staging_table_schema_name} AS STAGING
+        WHERE {join_composed})
+    ''').format(
+        table_schema_name=self.table_self_identifier,
+        staging_table_schema_name=staging.table_self_identifier,
+        join_composed=join_composed)
+    with self.conn.cursor() as cursor:
+        self.logger.info(f'delete_statement:{cursor.mogrify(delete_stmt).decode()}')
+        cursor.execute(delete_stmt)
+        self.logger.info(f'Delete statement successful: {cursor.rowcount:,} rows deleted.\n')
+        return cursor.rowcount
+
+def _incremental_upsert_from_db(self, staging:'Postgres', mapping_dict:dict={},
+                                delete_stale:bool=False, staging_where:'sql.Composable'=None) -> dict:
+    '''
+    Upsert a table into another, only touching rows that actually changed. Rows
+    are compared by an md5 hash of their text form, with the staging values cast
+    to the production column types first so that e.g. 12 and 12.00000000 match:
+    ```
+    UPDATE {table_schema_name} AS PROD SET col1 = STAGING.col1, ...
+    FROM {staging_table_schema_name} AS STAGING
+    WHERE PROD.pk1 = STAGING.pk1 AND ...
+        AND md5(ROW(PROD.col1, ...)::text) IS DISTINCT FROM md5(ROW(STAGING.col1::type1, ...)::text)
+
+    INSERT INTO {table_schema_name} (col1, col2, ...)
+    SELECT STAGING.col1, STAGING.col2, ... FROM {staging_table_schema_name} AS STAGING
+    WHERE NOT EXISTS (SELECT 1 FROM {table_schema_name} AS PROD WHERE PROD.pk1 = STAGING.pk1 AND ...)
+    ```
+    and if delete_stale, an anti-join DELETE of production keys that are not in
+    staging. Return a dict of inserted, updated, deleted and unchanged row counts.
+
+    staging_where optionally restricts which STAGING rows are upserted.
+    '''
+    prod_types = self._column_types()
+    staging_to_prod = {staging_field: mapping_dict.get(staging_field, staging_field)
+                       for staging_field in staging.fields}
+
+    prod_fields_composables = []
+    staging_fields_composables = []
+    prod_hash_composables = []
+    staging_hash_composables = []
+    update_set_composables = []
+    for staging_field, prod_field in staging_to_prod.items():
+        prod_col = sql.SQL('PROD.') + sql.Identifier(prod_field)
+        staging_col = sql.SQL('STAGING.') + sql.Identifier(staging_field)
+        prod_fields_composables.append(sql.Identifier(prod_field))
+        staging_fields_composables.append(staging_col)
+        prod_hash_composables.append(prod_col)
+        staging_hash_composables.append(
+            sql.SQL('CAST({} AS {})').format(staging_col, sql.SQL(prod_types[prod_field])))
+        if prod_field not in self.primary_keys:
+            update_set_composables.append(sql.Identifier(prod_field) + sql.SQL(' = ') + staging_col)
+
+    join_composables = []
+    for pk, staging_key in zip(sorted(self.primary_keys), self._staging_keys(staging, mapping_dict)):
+        join_composables.append(
+            sql.SQL('PROD.') + sql.Identifier(pk) + sql.SQL(' = ') +
+            sql.SQL('STAGING.') + sql.Identifier(staging_key))
+
+    prod_fields_composed = sql.Composed(prod_fields_composables).join(', ')
+    staging_fields_composed = sql.Composed(staging_fields_composables).join(', ')
+    join_composed = sql.Composed(join_composables).join(' AND ')
+    staging_where_composed = sql.SQL('TRUE') if staging_where is None else staging_where
+    formats = dict(
+        table_schema_name=self.table_self_identifier,
+        staging_table_schema_name=staging.table_self_identifier,
+        prod_fields_composed=prod_fields_composed,
+        staging_fields_composed=staging_fields_composed,
+        join_composed=join_composed, 
+        staging_where_composed=staging_where_composed)
+
+    counts = {}
+    with self.conn.cursor() as cursor:
+        if staging.table_schema == None and staging_where is None:
+            # Temp tables are never analyzed by autovacuum, so give the planner
+            # row estimates for the joins below
+            cursor.execute(sql.SQL('ANALYZE {}').format(staging.table_self_identifier))
+        cursor.execute(sql.SQL('SELECT count(*) FROM {staging_table_schema_name} AS STAGING WHERE {staging_where_composed}').format(**formats))
+        staging_count = cursor.fetchone()[0]
+
+        if update_set_composables:
+            update_stmt = sql.SQL('''
+    UPDATE {table_schema_name} AS PROD
+    SET {update_set_composed}
+    FROM {staging_table_schema_name} AS STAGING
+    WHERE {join_composed} AND {staging_where_composed}
+        AND md5(ROW({prod_hash_composed})::text) IS DISTINCT FROM md5(ROW({staging_hash_composed})::text)
+    ''').format(
+                update_set_composed=sql.Composed(update_set_composables).join(', '),
+                prod_hash_composed=sql.Composed(prod_hash_composables).join(', '),
+                staging_hash_composed=sql.Composed(staging_hash_composables).join(', '),
+                **formats)
+            self.logger.info(f'update_statement:{cursor.mogrify(update_stmt).decode()}')
+            cursor.execute(update_stmt)
+            counts['updated'] = cursor.rowcount
+        else: # Every column is part of the primary key, so a matching key means an unchanged row
+            counts['updated'] = 0
+
+        insert_stmt = sql.SQL('''
+    INSERT INTO {table_schema_name} ({prod_fields_composed})
+    SELECT {staging_fields_composed}
+    FROM {staging_table_schema_name} AS STAGING
+    WHERE {staging_where_composed} AND NOT EXISTS (
+        SELECT 1 FROM {table_schema_name} AS PROD
+        WHERE {join_composed})
+    ''').format(**formats)
+        self.logger.info(f'insert_statement:{cursor.mogrify(insert_stmt).decode()}')
+        cursor.execute(insert_stmt)
+        counts['inserted'] = cursor.rowcount
+
+    counts['deleted'] = self._delete_missing_keys(staging, mapping_dict) if delete_stale else 0
+    counts['unchanged'] = staging_count - counts['inserted'] - counts['updated']
+    self.logger.info(f'Incremental Upsert Successful: {counts["inserted"]:,} rows inserted, '
+                     f'{counts["updated"]:,} updated, {counts["deleted"]:,} deleted, '
+                     f'{counts["unchanged"]:,} unchanged.\n')
+    return counts
+
+def _chunk_bounds(self, staging:'Postgres', staging_keys:list, chunk_size:int, 
+                  resume_after:list=None) -> list:
+    '''Return the primary key values that end each chunk of chunk_size staging rows, 
+    in key order, starting after the key resume_after if given'''
+    keys = sql.Composed([sql.Identifier(k) for k in staging_keys]).join(', ')
+    stmt = sql.SQL('''
+    SELECT {keys} FROM (
+        SELECT {keys}, row_number() OVER (ORDER BY {keys}) AS rn
+        FROM {staging_table_schema_name}
+        WHERE {resume_where}) AS numbered
+    WHERE rn %% %s = 0
+    ORDER BY rn''').format(
+        keys=keys, 
+        staging_table_schema_name=staging.table_self_identifier, 
+        resume_where=sql.SQL('TRUE') if resume_after is None else 
+            sql.SQL('({}) > ({})').format(keys, sql.Composed([sql.Literal(v) for v in resume_after]).join(', ')))
+    return self.execute_sql(stmt, data=[chunk_size], fetch='all')
+
+def _chunked_upsert_from_db(self, staging:'Postgres', mapping_dict:dict={}, 
+                            delete_stale:bool=False, incremental:bool=False, 
+                            chunk_size:int=100_000, resume_after:str=None):
+    '''
+    Upsert from staging in chunks of chunk_size rows in primary key order, 
+    committing after each chunk so that locks are held and WAL accumulates for one 
+    chunk at a time. The last committed key is logged after every chunk; if a run 
+    fails, pass it as resume_after (a JSON list of the primary key values in sorted 
+    key name order, see `parse_resume_after()`) to skip the chunks that were already 
+    committed. 
+    Stale rows are deleted after the last chunk, in their own transaction. 
+
+    Note that, unlike a single upsert, a failure part way through leaves the chunks 
+    before it committed.
+    '''
+    staging_keys = self._staging_keys(staging, mapping_dict)
+    if resume_after is not None: 
+        resume_after = parse_resume_after(resume_after, len(staging_keys))
+    if resume_after is not None and len(resume_after) != len(staging_keys): 
+        raise ValueError(f'resume_after should have one value for each of the primary keys {sorted(self.primary_keys)}')
+
+    keys = sql.Composed([sql.Identifier(k) for k in staging_keys]).join(', ')
+    staging_keys_composed = sql.Composed(
+        [sql.SQL('STAGING.') + sql.Identifier(k) for k in staging_keys]).join(', ')
+    with self.conn.cursor() as cursor: 
+        if staging.table_schema == None: 
+            # Range scans over a temp table need an index on the keys
+            cursor.execute(sql.SQL('CREATE INDEX ON {} ({})').format(staging.table_self_identifier, keys))
+            cursor.execute(sql.SQL('ANALYZE {}').format(staging.table_self_identifier))
+    
+    bounds = self._chunk_bounds(staging, staging_keys, chunk_size, resume_after)
+    # The last chunk has no upper bound
+    bounds.append(None)
+    self.logger.info(f'Upserting in {len(bounds):,} chunks of up to {chunk_size:,} rows\n')
+
+    counts = {'inserted': 0, 'updated': 0, 'deleted': 0, 'unchanged': 0}
+    lower = resume_after
+    for i, upper in enumerate(bounds, start=1): 
+        conditions = []
+        if lower is not None: 
+            conditions.append(sql.SQL('({}) > ({})').format(
+                staging_keys_composed, sql.Composed([sql.Literal(v) for v in lower]).join(', ')))
+        if upper is not None: 
+            conditions.append(sql.SQL('({}) <= ({})').format(
+                staging_keys_composed, sql.Composed([sql.Literal(v) for v in upper]).join(', ')))
+        staging_where = sql.Composed(conditions).join(' AND ') if conditions else None
+
+        if incremental: 
+            chunk_counts = self._incremental_upsert_from_db(staging, mapping_dict, staging_where=staging_where)
+            for k in chunk_counts: 
+                counts[k] += chunk_counts[k]
+        else: 
+            self._upsert_data_from_db(staging, mapping_dict, staging_where=staging_where)
+        self.conn.commit()
+
+        if upper is not None: 
+            lower = upper
+            self.logger.info(f'Committed chunk {i:,}/{len(bounds):,}, last committed key: '
+                             f'{json.dumps(list(upper), default=str)}\n')
+        else: 
+            self.logger.info(f'Committed chunk {i:,}/{len(bounds):,}, all chunks committed.\n')
+
+    if delete_stale: 
+        if incremental: 
+            counts['deleted'] = self._delete_missing_keys(staging, mapping_dict)
+        else: 
+            self._delete_using_except(staging=staging, mapping_dict=mapping_dict)
+        self.conn.commit()
+    
+    if incremental: 
+        self.logger.info(f'Chunked Incremental Upsert Successful: {counts["inserted"]:,} rows inserted, '
+                         f'{counts["updated"]:,} updated, {counts["deleted"]:,} deleted, '
+                         f'{counts["unchanged"]:,} unchanged.\n')
+        return counts
@@ -1,9 +1,12 @@
-import csv, sys, re, ast
+import csv, sys, os, re, ast
 import psycopg2.sql as sql
-import geopetl
 import pytz
 import petl as etl
 from .postgres_connector import Postgres_Connector
+from .. import utils, s3_transfer, parquet, metrics, pg_indexes
+from .postgres_map import MULTI_GEOM_TYPES
+from ._stream import STREAM_CHUNK_SIZE, Iterator_File, iter_csv_chunks, to_multi_geom
+from ._resumable import RESUME_CHUNK_MB
 
 csv.field_size_limit(sys.maxsize)
 
@@ -25,9 +28,22 @@ class Postgres():
         csv_path, temp_csv_path, json_schema_path, json_schema_s3_key, 
         export_json_schema, primary_keys, pk_constraint_name, table_self_identifier, 
         fields, fields_and_types, geom_field, geom_type, database_object_type)
-    from ._s3 import (get_csv_from_s3, get_json_schema_from_s3, load_csv_to_s3, 
-                      load_json_schema_to_s3)
+    from ._metadata import metadata
+    from ._s3 import (get_csv_from_s3, get_csv_stream_from_s3, get_json_schema_from_s3, 
+                      load_csv_to_s3, load_json_schema_to_s3)
+    from ._stream import (stream_rows, multi_geom_rows, parquet_rows, prepare_stream)
+    from ._binary import (binary_encoders, _copy_binary, write_binary)
+    from ._upsert import (_column_types, _staging_keys, _delete_missing_keys, 
+                          _incremental_upsert_from_db, _chunk_bounds, _chunked_upsert_from_db)
+    from ._extract import (naive_datetime_fields, export_select_stmt, copy_extract, 
+                           parquet_extract, _partition_predicates, _copy_partition, 
+                           parallel_extract)
     from ._cleanup import (vacuum_analyze, cleanup, check_remove_nulls)
+    from ._resumable import (_resume_table_identifier, _read_checkpoint, _write_checkpoint, 
+                             _checkpoint_problem, _create_resume_table, _copy_resume_chunk, 
+                             resumable_load)
+    from ._swap import (_swap_table_identifier, _swap_blockers, _swap_index_statements, 
+                        _swap_sequences, _create_swap_table, _swap_in, swap_load)
 
     def __init__(self, connector: 'Postgres_Connector', table_name:str, table_schema:str=None,
                  **kwargs):
@@ -39,8 +55,17 @@ class Postgres():
         self.table_schema = table_schema
         self.fully_qualified_table_name = f'{self.table_schema}.{self.table_name}'
         self.temp_table_name = self.table_name + '_t'
+        # UNLOGGED table that holds the committed chunks of a resumable load
+        self.resume_table_name = self.table_name + '_resume'
+        # Sibling table that a swap load fills and then renames over this one
+        self.swap_table_name = self.table_name + '_swap'
+        # Whether __exit__ should VACUUM ANALYZE, swap loads leave no dead rows
+        self.vacuum_on_exit = True
         self.s3_bucket = kwargs.get('s3_bucket', None)
         self.s3_key = kwargs.get('s3_key', None)
+        self.metadata_cache_dir = kwargs.get('metadata_cache_dir', None)
+        # Must be set before geom_field and geom_type, whose setters use it
+        self._metadata = None
         self.geom_field = kwargs.get('geom_field', None)
         self.geom_type = kwargs.get('geom_type', None)
         self.with_srid = kwargs.get('with_srid', None)
@@ -50,6 +75,7 @@ class Postgres():
         self._primary_keys = None
         self._pk_constraint_name = None
         self._fields = None
+        self._fields_and_types = None
         self._database_object_type = None
 
         # First make sure the table exists: 
@@ -88,7 +114,8 @@ class Postgres():
             try: 
                 self.get_row_count()   
                 self.conn.commit()
-                self.vacuum_analyze()
+                if self.vacuum_on_exit: 
+                    self.vacuum_analyze()
                 self.logger.info('Done! All transactions committed.\n')
             except Exception as e:
                 self.logger.error('Workflow failed... rolling back database transactions.\n')
@@ -147,58 +174,61 @@ class Postgres():
         '''
         Prepare a CSV file's geometry and header for insertion into Postgres; 
         write to CSV at self.temp_csv_path. If mapping_dict is not None, no edits 
-        are made to the data header.
+        are made to the data header. A gzip or zstd compressed file is decompressed 
+        as it is read, and a Parquet staging file is read in record batches.
         '''
-        try:
-            rows = etl.fromcsv(file, encoding='utf-8')
-        except UnicodeError:    
-            self.logger.info("Exception encountered trying to load rows with utf-8 encoding, trying latin-1...")
-            rows = etl.fromcsv(file, encoding='latin-1')
-
-        # Shape types we will transform on, hacky way so we can insert it into our lambda function below
-        # Note: this is for transforming non-multi types to multi, but we include multis in this list
-        # because we will compare this against self.geom_type, which is retrieved from the etl_staging table,
-        # which will probably be multi. This is safe becaue we will transform each row only if they are not already MULTI
-        shape_types = ['POLYGON', 'POLYGON Z', 'POLYGON M', 'POLYGON MZ', 'LINESTRING', 'LINESTRING Z', 'LINESTRING M', 'LINESTRING MZ', 'MULTIPOLYGON', 'MULTIPOLYGON Z', 'MULTIPOLYGON M', 'MULTIPOLYGON MZ', 'MULTILINESTRING', 'MULTILINESTRING Z', 'MULTILINESTRING M', 'MULTILINESTRING MZ']
+        if parquet.is_parquet_file(file): 
+            rows = parquet.Parquet_View(file)
+        else: 
+            source = s3_transfer.read_source(file)
+            try:
+                rows = etl.fromcsv(source, encoding='utf-8')
+            except UnicodeError:    
+                self.logger.info("Exception encountered trying to load rows with utf-8 encoding, trying latin-1...")
+                rows = etl.fromcsv(source, encoding='latin-1')
 
         # Note: also run this if the data type is 'MULTILINESTRING' some source datasets will export as LINESTRING but the dataset type is actually MULTILINESTRING (one example: GIS_PLANNING.pedbikeplan_bikerec)
         # Note2: Also happening with poygons, example dataset: GIS_PPR.ppr_properties
         self.logger.info(f'self.geom_field is: {self.geom_field}')
         self.logger.info(f'self.geom_type is: {self.geom_type}\n')
-        if self.geom_field is not None and (self.geom_type in shape_types):
+        if self.geom_field is not None and (self.geom_type in MULTI_GEOM_TYPES):
             self.logger.info('Detected that shape type needs conversion to MULTI....')
             # Multi-geom fix
             # ESRI seems to only store polygon feature clasess as only multipolygons,
             # so we need to convert all polygon datasets to multipolygon for a successful copy_export.
-            # 1) identify if multi in geom_field AND non-multi
-            # Grab the geom type in a wierd way for all rows and insert into new column
-            rows = rows.addfield('row_geom_type', lambda a: a[f'{self.geom_field}'].split('(')[0].split(';')[1].strip() if a[f'{self.geom_field}'] and '(' in a[f'{self.geom_field}'] else None)
-            # 2) Update geom_field "POLYGON" type values to "MULTIPOLYGON":
-            #    Also add a third paranthesis around the geom info to make it a MUTLIPOLYGON type
-            rows = rows.convert(self.geom_field, lambda u, row: u.replace(row.row_geom_type, 'MULTI' + row.row_geom_type + ' (' ) + ')' if 'MULTI' not in row.row_geom_type else u, pass_row=True)
-            # Remove our temporary column
-            rows = rows.cutout('row_geom_type')
+            # Each non-multi value, e.g. "POLYGON ((...))", becomes "MULTIPOLYGON (((...)))" 
+            # in the same pass that writes the file below
+            rows = rows.convert(self.geom_field, to_multi_geom)
 
         header = rows[0]
-        str_header = ', '.join(header)
         if mapping_dict != None: 
-            str_header = str_header.replace('#', '_')
-
-            # Many Oracle datasets have the objectid field as "objectid_1". Making an 
-            # empty dataset from Oracle with "create-beta-enterprise-table.py" remakes 
-            # the dataset with a proper 'objectid' primary key. However the CSV made from Oracle
-            # will still have "objectid_1" in it. Handle this by replacing "objectid_1" 
-            # with "objectid" in CSV header if "objectid" doesn't already exist.
-            match = re.search('(objectid_\d+),', str_header)
-            if (re.search('objectid,', str_header) == None and match != None): 
-                old_col = match.groups()[0]
-                self.logger.info(f'\nDetected {old_col} primary key, implementing workaround and modifying header...\n')
-                str_header = str_header.replace(f'{old_col}', 'objectid')
-            rows = rows.rename({old:new for old, new in zip(header, str_header.split(', '))})
+            rows = rows.rename({old:new for old, new in zip(header, self._fix_header(header, mapping_dict))})
         
         # Write our possibly modified lines into the temp_csv file
         write_file = self.temp_csv_path
-        rows.tocsv(write_file)
+        with metrics.span('prepare') as span: 
+            rows.tocsv(write_file)
+            span.bytes = os.path.getsize(write_file)
+
+    def _fix_header(self, header:list, mapping_dict:dict=None) -> list: 
+        '''Return the data file header with the same fixes applied by prepare_file(). 
+        If mapping_dict is None, the header is returned unchanged.'''
+        if mapping_dict == None: 
+            return list(header)
+        str_header = ', '.join(header)
+        str_header = str_header.replace('#', '_')
+
+        # Many Oracle datasets have the objectid field as "objectid_1". Making an 
+        # empty dataset from Oracle with "create-beta-enterprise-table.py" remakes 
+        # the dataset with a proper 'objectid' primary key. However the CSV made from Oracle
+        # will still have "objectid_1" in it. Handle this by replacing "objectid_1" 
+        # with "objectid" in CSV header if "objectid" doesn't already exist.
+        match = re.search('(objectid_\d+),', str_header)
+        if (re.search('objectid,', str_header) == None and match != None): 
+            old_col = match.groups()[0]
+            self.logger.info(f'\nDetected {old_col} primary key, implementing workaround and modifying header...\n')
+            str_header = str_header.replace(f'{old_col}', 'objectid')
+        return str_header.split(', ')
 
     def _make_mapping_dict(self, column_mappings:str = None, mappings_file:str = None) -> dict: 
         '''Transform a string dict or a file with a string dict into that dict'''
@@ -256,23 +286,32 @@ class Postgres():
             # f.readline() moves cursor position out of position
             str_header = f.readline(5_000_000).strip().split(',')            
             f.seek(0)
+            self._copy_from(f, str_header, table_identifier, mapping_dict)
 
-            with self.conn.cursor() as cursor:
-                cols_composables = []
-                for col in str_header: 
-                    mapped_col = mapping_dict.get(col, col)
-                    cols_composables.append(sql.Identifier(mapped_col))
-                cols_composed = sql.Composed(cols_composables).join(', ')
-                
-                copy_stmt = sql.SQL('''
+    def _copy_from(self, f, header:list, table_identifier:'sql.Identifier', 
+                   mapping_dict:dict={}, size:int=8192): 
+        '''Run COPY FROM STDIN for a file-like object f containing CSV data with a 
+        header line, where header is the list of data file columns. Return the number 
+        of rows copied.'''
+        with self.conn.cursor() as cursor:
+            cols_composables = []
+            for col in header: 
+                mapped_col = mapping_dict.get(col, col)
+                cols_composables.append(sql.Identifier(mapped_col))
+            cols_composed = sql.Composed(cols_composables).join(', ')
+            
+            copy_stmt = sql.SQL('''
     COPY {table} ({cols_composed}) 
     FROM STDIN WITH (FORMAT csv, HEADER true)''').format(
-                    table=table_identifier, 
-                    cols_composed=cols_composed)
-                self.logger.info(f'copy_statement:{cursor.mogrify(copy_stmt).decode()}') # Does this mean they need to be correctly capitalized as identifiers?
-                cursor.copy_expert(copy_stmt, f)
+                table=table_identifier, 
+                cols_composed=cols_composed)
+            self.logger.info(f'copy_statement:{cursor.mogrify(copy_stmt).decode()}') # Does this mean they need to be correctly capitalized as identifiers?
+            with metrics.span('copy') as span: 
+                cursor.copy_expert(copy_stmt, f, size)
+                span.rows = cursor.rowcount
 
-                self.logger.info(f'Postgres Write Successful: {cursor.rowcount:,} rows imported.\n')
+            self.logger.info(f'Postgres Write Successful: {cursor.rowcount:,} rows imported.\n')
+            return cursor.rowcount
 
     def get_row_count(self):
         '''Get the current table row count. Don't make this a property because 
@@ -285,7 +324,7 @@ class Postgres():
         self.logger.info(f'{self.fully_qualified_table_name} current row count: {count:,}\n')
         return count
 
-    def extract(self, return_data:bool=False):
+    def extract(self, return_data:bool=False, workers:int=1, engine:str='geopetl'):
         """Extract data from a postgres table into a CSV file in S3. 
         
         Has spatial and SRID detection and will output it in a way that the ago 
@@ -294,7 +333,30 @@ class Postgres():
         ### Params: 
         * return_data (bool): If True return the data in memory as a 'geopetl.postgis.PostgisQuery'
         otherwise perform null bytes checks, write to CSV, and load to S3. 
+        * workers (int): If greater than 1, split the table into that many key ranges 
+        and extract them in parallel under one snapshot. See `parallel_extract`. 
+        Cannot be combined with return_data.
+        * engine (str): One of "geopetl", "copy". "geopetl" reads rows through 
+        etl.frompostgis() and converts datetimes in Python; "copy" formats geometries 
+        and datetimes in the SELECT and streams it with COPY TO, see `copy_extract`. 
+        Parallel extracts always format on the server. 
+        
+        If s3_key ends in ".parquet", the table is extracted to a Parquet staging 
+        file instead, see `parquet_extract`, and workers and engine are ignored.
         """
+        if engine not in ('geopetl', 'copy'): 
+            raise ValueError(f'Extract engine {engine} not recognized')
+        if parquet.is_parquet_key(self.s3_key): 
+            if return_data: 
+                raise ValueError('return_data is not supported for Parquet extracts')
+            return self.parquet_extract()
+        if (workers > 1 or engine == 'copy') and return_data: 
+            raise ValueError('return_data is only supported by the serial geopetl extract')
+        if workers > 1: 
+            return self.parallel_extract(workers)
+        if engine == 'copy': 
+            return self.copy_extract()
+
         row_count = self.get_row_count()
         
         self.logger.info(f'Starting extract from {self.fully_qualified_table_name}')
@@ -314,6 +376,10 @@ class Postgres():
         if not interval:
             interval = 1
 
+        # geopetl adds frompostgis() to petl when imported, and is slow to import, so only
+        # load it on this path
+        import geopetl
+
         self.logger.info('Initializing data var with etl.frompostgis()..')
         if self.with_srid is True:
             rows = etl.frompostgis(self.conn, self.fully_qualified_table_name, geom_with_srid=True)
@@ -325,14 +391,9 @@ class Postgres():
             raise AssertionError('Error! Dataset is empty? Line count of CSV is 0.')
 
         # Find datetime fields so we can make everything timezone aware if it's naive.. This is important for Carto.
-        datetime_fields = []
         # Do not use etl.typeset to determine data types because otherwise it causes geopetl to
         # read the database multiple times
-        for field in self.fields_and_types: 
-            # Create list of datetime type fields that aren't timezone aware:
-            if ('timestamp' in field[1].lower() or 'date' in field[1].lower()) and \
-                ('tz' not in field[1].lower() and 'with time zone' not in field[1].lower()):
-                datetime_fields.append(field[0].lower())
+        datetime_fields = self.naive_datetime_fields()
 
         if datetime_fields:
             self.logger.info(f'\nConverting {datetime_fields} fields to Eastern timezone datetime\n')
@@ -347,13 +408,15 @@ class Postgres():
         if return_data: 
             return rows
         
-        # Dump to our CSV temp file
+        # Dump to our CSV temp file, removing any null bytes as it's written
         self.logger.info('Extracting csv...')
-        try:
-            rows.progress(interval).tocsv(self.csv_path, 'utf-8')
-        except UnicodeError:
-            self.logger.warning("Exception encountered trying to extract to CSV with utf-8 encoding, trying latin-1...")
-            rows.progress(interval).tocsv(self.csv_path, 'latin-1')
+        csv_source = utils.Byte_Filter_Source(self.csv_path, [b'\0'])
+        with metrics.span('extract', rows=num_rows_in_csv): 
+            try:
+                rows.progress(interval).tocsv(csv_source, 'utf-8')
+            except UnicodeError:
+                self.logger.warning("Exception encountered trying to extract to CSV with utf-8 encoding, trying latin-1...")
+                rows.progress(interval).tocsv(csv_source, 'latin-1')
 
         # New assert as well that will fail if row_count doesn't equal CSV again (because of time difference)
         db_newest_row_count = self.get_row_count()
@@ -361,7 +424,6 @@ class Postgres():
         self.logger.info(f'{db_newest_row_count} == {num_rows_in_csv}')
         assert db_newest_row_count == num_rows_in_csv
 
-        self.check_remove_nulls()
         self.load_csv_to_s3(path=self.csv_path)
     
     def create_temp_table(self): 
@@ -418,7 +480,9 @@ class Postgres():
             cursor.execute(truncate_stmt)
             self.logger.info(f'Truncate successful: {cursor.rowcount:,} rows updated/inserted.\n')
 
-    def load(self, column_mappings:str=None, mappings_file:str=None, truncate_before_load:bool=False):
+    def load(self, column_mappings:str=None, mappings_file:str=None, truncate_before_load:bool=False, 
+             stream:bool=False, binary:bool=False, resumable:bool=False, 
+             chunk_mb:int=RESUME_CHUNK_MB, swap:bool=False, defer_indexes:bool=False):
         '''
         Prepare and COPY a CSV from S3 to a Postgres table. If the keyword arguments 
         "column_mappings" or "mappings_file" are passed with values other than None, 
@@ -435,17 +499,81 @@ class Postgres():
                                              "data_col2": "db_table_col2", ... }
             - Note no quotes around the curly braces `{}`. 
     
+        - truncate_before_load: If True, DELETE all rows from the table in the same 
+        transaction before loading.
+        - stream: If True, stream the CSV from S3 straight into COPY, applying the 
+        same geometry and header fixes row by row, instead of downloading it and 
+        writing a prepared copy to local disk first. 
+        - binary: If True, encode values according to the table's column types and 
+        COPY them in binary format instead of CSV text. See `write_binary()`. 
+        - resumable: If True, read the CSV from S3 with ranged GETs and COPY it in 
+        chunks of about chunk_mb MB into an UNLOGGED resume table, committing a 
+        checkpoint after each chunk, so that running a failed load again resumes 
+        from the last committed chunk. The rows are inserted into the table in one 
+        transaction at the end. The CSV must be uncompressed. See `resumable_load()`. 
+        - swap: If True, replace all of the table's rows (truncate_before_load is 
+        implied) by loading into a new sibling table, building the indexes on it 
+        afterwards, and renaming it over the table in a short transaction, rather 
+        than DELETE-ing the rows. Readers are not blocked and there are no dead rows 
+        to vacuum. Tables with dependent views, referencing foreign keys, triggers or 
+        partitions are refused. Cannot be combined with resumable. See `swap_load()`. 
+        - defer_indexes: If True, drop the table's indexes (other than its primary 
+        key) before loading and build them again afterwards in the same transaction, 
+        with parallel index build workers. With resumable, only around the final 
+        insert. The table is locked against readers until the load commits, see 
+        `databridge_etl_tools.pg_indexes`. 
+
+        Parquet staging files (see `databridge_etl_tools.parquet`) are downloaded 
+        and COPY-ed straight from their record batches, with no prepared copy 
+        written to disk; they cannot be streamed. 
+
         Only one of column_mappings or mappings_file should be provided. Note that 
         only the columns whose headers differ between the data file and the database 
         table need to be included. All column names must be quoted. 
         '''
+        if swap: 
+            if resumable: 
+                raise ValueError('Swap loads cannot be resumable')
+            if defer_indexes: 
+                raise ValueError('Swap loads always build the indexes after loading, drop defer_indexes')
+            return self.swap_load(column_mappings, mappings_file, stream, binary)
         mapping_dict = self._make_mapping_dict(column_mappings, mappings_file)
+        if resumable: 
+            return self.resumable_load(mapping_dict, truncate_before_load, binary, chunk_mb, 
+                                       defer_indexes=defer_indexes)
+        if defer_indexes: 
+            with self.conn.cursor() as cursor, pg_indexes.Deferred_Indexes(
+                    cursor, self.table_schema, self.table_name, self.logger): 
+                return self.load(column_mappings, mappings_file, truncate_before_load, 
+                                 stream, binary)
+        if stream: 
+            if parquet.is_parquet_key(self.s3_key): 
+                raise ValueError('Parquet staging files are read from local disk and cannot be streamed')
+            header, rows = self.stream_rows(mapping_dict=mapping_dict)
+            return self._copy_rows(header, rows, mapping_dict, truncate_before_load, binary)
         self.get_csv_from_s3()
+        if parquet.is_parquet_file(self.csv_path): 
+            header, rows = self.parquet_rows(mapping_dict=mapping_dict)
+            return self._copy_rows(header, rows, mapping_dict, truncate_before_load, binary)
         self.prepare_file(file=self.csv_path, mapping_dict=mapping_dict)
         if truncate_before_load:
             self.delete_from_truncate()
-        self.write_csv(write_file=self.temp_csv_path, table_name=self.table_name, 
-                       schema_name=self.table_schema, mapping_dict=mapping_dict)
+        write = self.write_binary if binary else self.write_csv
+        write(write_file=self.temp_csv_path, table_name=self.table_name, 
+              schema_name=self.table_schema, mapping_dict=mapping_dict)
+
+    def _copy_rows(self, header:list, rows, mapping_dict:dict, truncate_before_load:bool, 
+                   binary:bool): 
+        '''COPY an iterator of rows into the table without writing them to disk, 
+        see `stream_rows()` and `parquet_rows()`'''
+        if truncate_before_load:
+            self.delete_from_truncate()
+        self.logger.info(f'Writing to table {self.fully_qualified_table_name} from s3://{self.s3_bucket}/{self.s3_key}...')
+        if binary: 
+            self._copy_binary(rows, header, self.table_self_identifier, mapping_dict)
+        else: 
+            self._copy_from(Iterator_File(iter_csv_chunks(header, rows)), header, 
+                            self.table_self_identifier, mapping_dict, size=STREAM_CHUNK_SIZE)
 
     def _delete_using_except(self, staging, mapping_dict:dict): 
         '''Run a query to delete the rows from a table that do not appear in another 
@@ -495,7 +623,7 @@ class Postgres():
             self.logger.info(f'Delete Using Except statement successful: {cursor.rowcount:,} rows deleted.\n')
     
     def _upsert_data_from_db(self, staging: 'Postgres', mapping_dict:dict={}, 
-                             delete_stale:bool=False): 
+                             delete_stale:bool=False, staging_where:'sql.Composable'=None): 
         '''
         Create the SQL statements to upsert a table into another, optionally deleting 
         stale data beforehand. In general form, this SQL takes the form of 
@@ -508,6 +636,7 @@ class Postgres():
             col1 = EXCLUDED.col1, col2 = EXCLUDED.col2, ...
         WHERE PROD.pk1 = EXCLUDED.pk1 AND PROD.pk2 = EXCLUDED.pk2 AND ...
         ```
+        staging_where optionally restricts which STAGING rows are upserted. 
         See https://www.psycopg.org/docs/sql.html for how sql.Composable, sql.SQL, 
         sql.Identifier, and sql.Composed related to each other       
         '''
@@ -552,6 +681,7 @@ class Postgres():
     INSERT INTO {table_schema_name} AS PROD ({prod_fields_composed})
     SELECT {staging_fields_composed}
     FROM {staging_table_schema_name} AS STAGING
+    WHERE {staging_where_composed}
     ON CONFLICT ON CONSTRAINT {pk_constraint}
     DO UPDATE SET {update_set_composed}
     WHERE {where_composed}
@@ -562,7 +692,8 @@ class Postgres():
             staging_table_schema_name=staging.table_self_identifier, 
             pk_constraint=sql.Identifier(self.pk_constraint_name), 
             update_set_composed=update_set_composed, 
-            where_composed=where_composed)
+            where_composed=where_composed, 
+            staging_where_composed=sql.SQL('TRUE') if staging_where is None else staging_where)
 
         with self.conn.cursor() as cursor: 
             self.logger.info(f'upsert_statement:{cursor.mogrify(upsert_stmt).decode()}')
@@ -572,7 +703,21 @@ class Postgres():
         if delete_stale: 
             self._delete_using_except(staging=staging, mapping_dict=mapping_dict)
 
-    def _upsert_csv(self, mapping_dict:dict, delete_stale:bool): 
+    def _upsert_from_staging(self, staging: 'Postgres', mapping_dict:dict, delete_stale:bool, 
+                             incremental:bool=False, chunk_size:int=None, resume_after:str=None): 
+        '''Upsert from a staging Postgres object, see _upsert_data_from_db, 
+        _incremental_upsert_from_db and _chunked_upsert_from_db'''
+        with metrics.span('upsert'): 
+            if chunk_size: 
+                return self._chunked_upsert_from_db(staging=staging, mapping_dict=mapping_dict, 
+                                                    delete_stale=delete_stale, incremental=incremental, 
+                                                    chunk_size=chunk_size, resume_after=resume_after)
+            if incremental: 
+                return self._incremental_upsert_from_db(staging=staging, mapping_dict=mapping_dict, 
+                                                        delete_stale=delete_stale)
+            self._upsert_data_from_db(staging=staging, mapping_dict=mapping_dict, delete_stale=delete_stale)
+
+    def _upsert_csv(self, mapping_dict:dict, delete_stale:bool, **kwargs): 
         '''Upsert a CSV file from S3 to a Postgres table'''
         assert self.check_exists(self.temp_table_name, self.table_schema) == False, f'Temporary Table {self.temp_table_name} already exists in this DB!'
 
@@ -583,19 +728,20 @@ class Postgres():
                        schema_name=self.table_schema, mapping_dict=mapping_dict, temp_table=True)
         staging = Postgres(connector=self.connector, table_name=self.temp_table_name, 
                          table_schema=None)
-        self._upsert_data_from_db(staging=staging, mapping_dict=mapping_dict, delete_stale=delete_stale)
+        return self._upsert_from_staging(staging, mapping_dict, delete_stale, **kwargs)
 
     def _upsert_table(self, mapping_dict:dict, staging_table:str, staging_schema:str, 
-                      delete_stale:bool): 
+                      delete_stale:bool, **kwargs): 
         '''Upsert a table within the same Postgres database to a Postgres table'''
         if not staging_schema: 
             staging_schema = self.table_schema
         staging = Postgres(connector=self.connector, table_name=staging_table, 
-                         table_schema=staging_schema)
-        self._upsert_data_from_db(staging=staging, mapping_dict=mapping_dict, delete_stale=delete_stale)
+                         table_schema=staging_schema, metadata_cache_dir=self.metadata_cache_dir)
+        return self._upsert_from_staging(staging, mapping_dict, delete_stale, **kwargs)
     
     def upsert(self, method:str, staging_table:str=None, staging_schema:str=None, 
-               column_mappings:str=None, mappings_file:str=None, delete_stale:bool=False): 
+               column_mappings:str=None, mappings_file:str=None, delete_stale:bool=False, 
+               incremental:bool=False, chunk_size:int=None, resume_after:str=None): 
         '''Upserts data from a CSV or from a table/view within the same database to a 
         Postgres table, which must have at least one primary key. Whether 
         upserting from a CSV or Postgres table, the keyword arguments 
@@ -617,6 +763,14 @@ class Postgres():
             - Note no quotes around the curly braces `{}`. 
         - delete_stale: If True, delete rows that do not appear in the staging 
         data table. 
+        - incremental: If True, compare rows by a hash of their values and only 
+        update rows that changed, insert missing keys and (with delete_stale) delete 
+        keys missing from staging, returning a dict of inserted/updated/deleted/unchanged 
+        row counts. See `_incremental_upsert_from_db`.
+        - chunk_size: If given, upsert in chunks of this many rows in primary key 
+        order, committing after each chunk. See `_chunked_upsert_from_db`. 
+        - resume_after: With chunk_size, the last committed key logged by a failed 
+        chunked upsert, as a JSON list of values, to skip the chunks already committed.
     
         Only one of column_mappings or mappings_file should be provided. Note that 
         only the columns whose headers differ between the data file and the database 
@@ -627,9 +781,11 @@ class Postgres():
             raise ValueError(f'Upsert method requires that table "{self.fully_qualified_table_name}" have at least one column as primary key.')
         mapping_dict = self._make_mapping_dict(column_mappings, mappings_file)
         
+        chunk_kwargs = dict(incremental=incremental, chunk_size=chunk_size, resume_after=resume_after)
         if method == 'csv': 
-            self._upsert_csv(mapping_dict, delete_stale)
+            return self._upsert_csv(mapping_dict, delete_stale, **chunk_kwargs)
         elif method == 'table': 
-            self._upsert_table(mapping_dict, staging_table, staging_schema, delete_stale)
+            return self._upsert_table(mapping_dict, staging_table, staging_schema, delete_stale, 
+                                      **chunk_kwargs)
         else: 
             raise KeyError('Method {method} not recognized for upsert')
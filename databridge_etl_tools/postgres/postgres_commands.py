@@ -1,5 +1,10 @@
 from .postgres import Postgres, Postgres_Connector as Connector
-from .. import utils
+from .postgres_connector import Postgres_Pool
+from .postgres_jobs import run_table_jobs, read_manifest, format_report
+from ._resumable import RESUME_CHUNK_MB
+from .. import utils, metrics
+import json
+import time
 import click
 
 # If debugging, in any command feel free to use
@@ -9,15 +14,26 @@ import click
 @click.group()
 @click.pass_context
 @click.option('--connection_string', required=True)
-@click.option('--table_name', required=True)
-@click.option('--table_schema', required=True)
+@click.option('--table_name', help='Required by every command except batch')
+@click.option('--table_schema', help='Required by every command except batch')
 @click.option('--s3_bucket')
 @click.option('--s3_key')
+@click.option('--metadata_cache_dir', required=False, help='''
+    Directory in which to cache table metadata (columns, types, primary key, geometry) 
+    between runs. Cached metadata is reused until the table's definition changes.''')
 def postgres(ctx, **kwargs):
     '''Run ETL commands for Postgres'''
     ctx.obj = {}
     ctx = utils.pass_params_to_ctx(ctx, **kwargs) # kwargs contains the click options and their values
     
+    # batch reads its tables from a manifest and borrows connections from its own pool
+    if ctx.invoked_subcommand == 'batch': 
+        return
+    for option in ('table_name', 'table_schema'): 
+        if ctx.obj[option] is None: 
+            raise click.UsageError(f"Missing option '--{option}'.", ctx=ctx)
+    metrics.set_labels(table=f"{ctx.obj['table_schema']}.{ctx.obj['table_name']}")
+
     # Open Postgres db connection for a subcommand - equivalent to `with Connector(...) as connector: `
     # See https://click.palletsprojects.com/en/8.1.x/advanced/#managing-resources
     ctx.obj['connector'] = ctx.with_resource(Connector(**ctx.obj)) 
@@ -28,11 +44,19 @@ def postgres(ctx, **kwargs):
         help='''Likely only needed for certain views. This
         controls whether the geopetl frompostgis() function exports with geom_with_srid. That wont work
         for some views so just export without.''')
-def extract(ctx, **kwargs):
+@click.option('--workers', type=int, default=1, required=False, show_default=True, 
+        help='''Number of key ranges to split the table into and extract in parallel, 
+        each on its own connection under one exported snapshot.''')
+@click.option('--engine', type=click.Choice(['geopetl', 'copy']), default='geopetl', 
+        required=False, show_default=True, 
+        help='''"geopetl" reads rows with geopetl and converts datetimes in Python. "copy" 
+        formats geometries and datetimes in the SELECT itself and streams the result 
+        with COPY TO STDOUT.''')
+def extract(ctx, workers, engine, **kwargs):
     """Extracts data from a postgres table into a CSV file in S3. Has spatial and SRID detection
     and will output it in a way that the ago append commands will recognize."""
     with Postgres(**ctx.obj, **kwargs) as postgres: # Using db connection already made, make a Postgres table object
-        postgres.extract()
+        postgres.extract(workers=workers, engine=engine)
 
 @postgres.command()
 @click.pass_context
@@ -44,6 +68,29 @@ def extract_json_schema(ctx):
 @postgres.command()
 @click.pass_context
 @click.option('--truncate_before_load', is_flag=True, required=False, help='Optionally truncate table before loading.')
+@click.option('--stream', is_flag=True, required=False, help='''
+    Stream the CSV from S3 straight into COPY instead of downloading it and writing 
+    a prepared copy to local disk first.''')
+@click.option('--binary', is_flag=True, required=False, help='''
+    Encode values according to the table's column types (geometries as EWKB) and 
+    COPY them in binary format instead of CSV text. Empty values, quoted or not, 
+    are loaded as NULL in every column, as the CSV text load does.''')
+@click.option('--resumable', is_flag=True, required=False, help='''
+    COPY the CSV in chunks into an UNLOGGED "<table>_resume" table, committing a 
+    checkpoint after each one, so that running a failed load again resumes from the 
+    last committed chunk. The CSV must be uncompressed.''')
+@click.option('--chunk_mb', type=int, default=RESUME_CHUNK_MB, required=False, show_default=True, 
+        help='With --resumable, the size of each committed chunk in MB.')
+@click.option('--swap', is_flag=True, required=False, help='''
+    Replace all of the table's rows by loading into a new "<table>_swap" table, 
+    building its indexes afterwards and renaming it over the table in a short 
+    transaction, instead of DELETE-ing them. Readers are not blocked and no vacuum is 
+    needed.''')
+@click.option('--defer_indexes', is_flag=True, required=False, help='''
+    Drop the table's indexes (other than its primary key) before loading and build 
+    them again afterwards in the same transaction, with parallel index build workers. 
+    Blocks every reader of the table until the load commits, so don't use it on 
+    tables that are read during loads.''')
 @click.option('--column_mappings', required=False, help='''
     A string that can be read as a dictionary using `ast.literal_eval()`. It should 
     take the form "{'data_col': 'db_table_col', 'data_col2': 'db_table_col2', ...}"''')
@@ -78,6 +125,15 @@ def load(ctx, **kwargs):
 @click.option('--delete_stale', required=False, type=bool, help='''
     If True/t/yes, etc., delete rows from PROD table that do not appear in the STAGING table 
     used for upserting. ''')
+@click.option('--incremental', is_flag=True, required=False, help='''
+    Only update rows whose values changed, insert missing keys and (with --delete_stale) 
+    delete keys missing from STAGING, reporting inserted/updated/deleted/unchanged counts.''')
+@click.option('--chunk_size', type=int, required=False, help='''
+    Upsert in chunks of this many rows in primary key order, committing after each chunk.''')
+@click.option('--resume_after', required=False, help='''
+    With --chunk_size, the "last committed key" logged by a failed chunked upsert, a 
+    JSON list of primary key values such as '[12, "a,b"]', to skip the chunks that were 
+    already committed.''')
 @click.pass_context
 def upsert_csv(ctx, **kwargs): 
     '''Upserts data from a CSV to a Postgres table, which must have at least one primary key.  
@@ -105,6 +161,15 @@ def upsert_csv(ctx, **kwargs):
 @click.option('--delete_stale', required=False, type=bool, help='''
     If True/t/yes, etc., delete rows from PROD table that do not appear in the STAGING table 
     used for upserting. ''')
+@click.option('--incremental', is_flag=True, required=False, help='''
+    Only update rows whose values changed, insert missing keys and (with --delete_stale) 
+    delete keys missing from STAGING, reporting inserted/updated/deleted/unchanged counts.''')
+@click.option('--chunk_size', type=int, required=False, help='''
+    Upsert in chunks of this many rows in primary key order, committing after each chunk.''')
+@click.option('--resume_after', required=False, help='''
+    With --chunk_size, the "last committed key" logged by a failed chunked upsert, a 
+    JSON list of primary key values such as '[12, "a,b"]', to skip the chunks that were 
+    already committed.''')
 @postgres.command()
 @click.pass_context
 def upsert_table(ctx, **kwargs): 
@@ -119,3 +184,32 @@ def upsert_table(ctx, **kwargs):
     '''
     with Postgres(**ctx.obj) as postgres: 
         postgres.upsert('table', **kwargs)
+
+@postgres.command()
+@click.pass_context
+@click.option('--manifest', required=True, type=click.Path(exists=True, dir_okay=False), help='''
+    YAML or JSON file listing the table jobs to run. Each entry needs "table", "schema" 
+    and "operation" (one of extract, extract_json_schema, load, upsert_csv, upsert_table) 
+    and can have "s3_key", "s3_bucket" and "args", the operation's options, e.g. 
+    {"truncate_before_load": true}.''')
+@click.option('--workers', type=int, default=4, show_default=True, help='''
+    Number of tables to run at once, which is also the size of the connection pool.''')
+@click.option('--report', required=False, type=click.Path(dir_okay=False), help='''
+    Optionally also write the outcome of each table job to this JSON file.''')
+def batch(ctx, manifest, workers, report): 
+    '''Run the tables listed in a manifest concurrently over a shared connection pool, 
+    then print a summary with each table's run time. Exits with an error if any table failed.'''
+    jobs = read_manifest(manifest, s3_bucket=ctx.obj['s3_bucket'], 
+                         metadata_cache_dir=ctx.obj['metadata_cache_dir'])
+    start = time.perf_counter()
+    with Postgres_Pool(ctx.obj['connection_string'], minconn=1, maxconn=workers) as pool: 
+        outcomes = run_table_jobs(pool, jobs, max_workers=workers)
+    
+    click.echo(format_report(outcomes))
+    click.echo(f'Wall time: {time.perf_counter() - start:,.1f} seconds')
+    if report: 
+        with open(report, 'w') as f: 
+            json.dump(outcomes, f, indent=2, default=str)
+    failed = [outcome for outcome in outcomes if outcome['status'] == 'failed']
+    if failed: 
+        raise click.ClickException(f'{len(failed):,} of {len(outcomes):,} table jobs failed')
@@ -1,11 +1,91 @@
 import sys
 import logging
+import threading
 import psycopg2
+import psycopg2.pool
 
-class Postgres_Connector(): 
-    '''Represent a Postgres connection. Do not remove **kwargs from class.'''
-    def __init__(self, connection_string, **kwargs): 
+def get_logger(): 
+    logger = logging.getLogger(__name__)
+    logger.setLevel(logging.INFO)
+    if logger.handlers == []: 
+        sh = logging.StreamHandler(sys.stdout)
+        logger.addHandler(sh)
+    return logger
+
+class Postgres_Pool(): 
+    '''
+    A thread-safe pool of Postgres connections that Postgres_Connector objects can 
+    borrow from, so that many tables can be handled by one process without paying 
+    connection setup for each of them. 
+    ```
+    with Postgres_Pool(connection_string, minconn=1, maxconn=4) as pool: 
+        with Postgres_Connector(pool=pool) as connector: 
+            ...
+    ```
+    Borrowing blocks while all maxconn connections are in use. Connections are 
+    health checked when borrowed and reset when returned. 
+    '''
+    def __init__(self, connection_string:str, minconn:int=1, maxconn:int=4): 
         self.connection_string = connection_string
+        self.minconn = minconn
+        self.maxconn = maxconn
+        self.logger = get_logger()
+        self._available = threading.BoundedSemaphore(maxconn)
+        self._pool = psycopg2.pool.ThreadedConnectionPool(
+            minconn, maxconn, connection_string, connect_timeout=5)
+        self.logger.info(f'Opened Postgres connection pool (min {minconn}, max {maxconn}).\n')
+
+    def __enter__(self): 
+        return self
+
+    def __exit__(self, type, value, traceback): 
+        self.closeall()
+
+    def getconn(self): 
+        '''Borrow a connection, replacing it if it is closed or no longer answers'''
+        self._available.acquire()
+        try: 
+            while True: 
+                conn = self._pool.getconn()
+                try: 
+                    if not conn.closed: 
+                        with conn.cursor() as cursor: 
+                            cursor.execute('SELECT 1')
+                        conn.rollback()
+                        return conn
+                except psycopg2.Error: 
+                    pass
+                self.logger.info('Discarding broken pooled connection.')
+                self._pool.putconn(conn, close=True)
+        except Exception as e: 
+            self._available.release()
+            raise e
+
+    def putconn(self, conn): 
+        '''Return a borrowed connection, rolling back anything uncommitted and 
+        resetting session characteristics such as isolation level'''
+        try: 
+            if not conn.closed: 
+                conn.reset()
+            self._pool.putconn(conn, close=bool(conn.closed))
+        except psycopg2.Error: 
+            self._pool.putconn(conn, close=True)
+        finally: 
+            self._available.release()
+
+    def closeall(self): 
+        self._pool.closeall()
+        self.logger.info('Connection pool closed.\n')
+
+class Postgres_Connector(): 
+    '''Represent a Postgres connection. Do not remove **kwargs from class. 
+    If pool is given, the connection is borrowed from that Postgres_Pool and 
+    returned to it on exit instead of being closed.'''
+    def __init__(self, connection_string=None, pool:'Postgres_Pool'=None, **kwargs): 
+        if connection_string is None and pool is None: 
+            raise ValueError('One of connection_string or pool is required')
+        self.pool = pool
+        self.connection_string = connection_string if pool is None else pool.connection_string
         self._logger = None
         self._conn = None
         self.conn
@@ -27,26 +107,34 @@ class Postgres_Connector():
             ...
         ```
         '''
-        self.conn.close()
-        self.logger.info('Connection closed.\n')
+        if self.pool is not None: 
+            self.pool.putconn(self.conn)
+            self.logger.info('Connection returned to pool.\n')
+        else: 
+            self.conn.close()
+            self.logger.info('Connection closed.\n')
     
     @property
     def conn(self):
         '''Create or Make the Postgres db connection'''
         if self._conn is None:
-            self.logger.info('Trying to connect to postgres...')
-            conn = psycopg2.connect(self.connection_string, connect_timeout=5)
+            if self.pool is not None: 
+                self.logger.info('Borrowing a connection from the pool...')
+                conn = self.pool.getconn()
+            else: 
+                self.logger.info('Trying to connect to postgres...')
+                conn = self.new_conn()
             self._conn = conn
             self.logger.info('Connected to postgres.\n')
         return self._conn
 
+    def new_conn(self):
+        '''Open and return an additional connection to the same database, e.g. for 
+        work done in parallel. The caller is responsible for closing it.'''
+        return psycopg2.connect(self.connection_string, connect_timeout=5)
+
     @property
     def logger(self):
         if self._logger is None:
-            logger = logging.getLogger(__name__)
-            logger.setLevel(logging.INFO)
-            if logger.handlers == []: 
-                sh = logging.StreamHandler(sys.stdout)
-                logger.addHandler(sh)
-            self._logger = logger
+            self._logger = get_logger()
         return self._logger
@@ -0,0 +1,125 @@
+import os
+import json
+import time
+from collections import Counter
+from concurrent.futures import ThreadPoolExecutor
+from .. import metrics
+from .postgres import Postgres
+from .postgres_connector import Postgres_Connector, Postgres_Pool
+
+# The Postgres method behind each operation, named after the CLI subcommands
+OPERATIONS = {
+    'extract':             lambda pg, **kwargs: pg.extract(**kwargs),
+    'extract_json_schema': lambda pg, **kwargs: pg.load_json_schema_to_s3(**kwargs),
+    'load':                lambda pg, **kwargs: pg.load(**kwargs),
+    'upsert_csv':          lambda pg, **kwargs: pg.upsert('csv', **kwargs),
+    'upsert_table':        lambda pg, **kwargs: pg.upsert('table', **kwargs),
+}
+
+
+def run_table_job(pool:'Postgres_Pool', table_name:str, table_schema:str, operation:str,
+                  args:dict=None, **kwargs) -> dict:
+    '''
+    Run one operation on one table with a connection borrowed from pool, the same
+    way the matching CLI subcommand would. kwargs are passed to `Postgres()` (e.g.
+    s3_bucket, s3_key, with_srid) and args to the operation (e.g. column_mappings).
+    Return a dict describing the outcome; exceptions are caught and reported in it.
+    '''
+    outcome = {'table_name': table_name, 'table_schema': table_schema,
+               'operation': operation, 'status': 'succeeded', 'result': None, 'error': None}
+    start = time.perf_counter()
+    try:
+        if operation not in OPERATIONS:
+            raise ValueError(f'Unknown operation "{operation}", expected one of {", ".join(OPERATIONS)}')
+        # Label this thread's spans with the table, see metrics.labels()
+        with metrics.labels(table=f'{table_schema}.{table_name}'), Postgres_Connector(pool=pool) as connector:
+            with Postgres(connector=connector, table_name=table_name, table_schema=table_schema,
+                          **kwargs) as pg:
+                outcome['result'] = OPERATIONS[operation](pg, **(args or {}))
+    except Exception as e:
+        pool.logger.error(f'{operation} of {table_schema}.{table_name} failed: {e!r}\n')
+        outcome['status'] = 'failed'
+        outcome['error'] = repr(e)
+    outcome['seconds'] = round(time.perf_counter() - start, 3)
+    return outcome
+
+def run_table_jobs(pool:'Postgres_Pool', jobs:list, max_workers:int=None) -> list:
+    '''
+    Run a list of table jobs concurrently through one connection pool, where each
+    job is a dict of keyword arguments for `run_table_job()`, e.g.
+    ```
+    with Postgres_Pool(connection_string, maxconn=4) as pool:
+        outcomes = run_table_jobs(pool, [
+            {'table_name': 'table_a', 'table_schema': 'citygeo', 'operation': 'extract',
+             's3_bucket': 'bucket', 's3_key': 'staging/citygeo/table_a.csv'},
+            ...])
+    ```
+    max_workers defaults to, and should not be more than, the pool's maxconn.
+    Return the outcome of each job in the order given. A failed job does not stop
+    the others.
+    '''
+    # Local files are named after the table (see Postgres.csv_path), so two jobs on
+    # the same table name would overwrite and clean up each other's files
+    duplicates = [name for name, count in Counter(job['table_name'] for job in jobs).items() if count > 1]
+    if duplicates:
+        raise ValueError(f'Table name(s) {", ".join(duplicates)} appear in more than one job')
+
+    max_workers = max_workers or pool.maxconn
+    pool.logger.info(f'Running {len(jobs):,} table jobs with {max_workers} workers...\n')
+    with ThreadPoolExecutor(max_workers=max_workers) as executor:
+        futures = [executor.submit(run_table_job, pool, **job) for job in jobs]
+        outcomes = [future.result() for future in futures]
+
+    failed = sum(outcome['status'] == 'failed' for outcome in outcomes)
+    pool.logger.info(f'Table jobs complete: {len(outcomes) - failed:,} succeeded, {failed:,} failed.\n')
+    return outcomes
+
+def read_manifest(path:str, **defaults) -> list:
+    '''
+    Read a YAML or JSON manifest of table jobs and return them as a list of kwargs
+    for `run_table_job()`. The manifest is a list of entries like
+    ```
+    - table: table_a
+      schema: citygeo
+      operation: load
+      s3_key: staging/citygeo/table_a.csv
+      args: {truncate_before_load: true}
+    ```
+    Any other keys (e.g. s3_bucket, with_srid) are passed to `Postgres()`, falling
+    back to defaults.
+    '''
+    with open(path) as f:
+        if os.path.splitext(path)[1].lower() == '.json':
+            entries = json.load(f)
+        else:
+            import yaml
+            entries = yaml.safe_load(f)
+    if not isinstance(entries, list):
+        raise ValueError(f'Manifest {path} should contain a list of table jobs')
+
+    jobs = []
+    for i, entry in enumerate(entries):
+        entry = dict(entry)
+        missing = [key for key in ('table', 'schema', 'operation') if key not in entry]
+        if missing:
+            raise ValueError(f'Manifest entry {i} is missing {", ".join(missing)}')
+        job = {key: value for key, value in defaults.items() if value is not None}
+        job['table_name'] = entry.pop('table')
+        job['table_schema'] = entry.pop('schema')
+        job.update(entry)
+        jobs.append(job)
+    return jobs
+
+def format_report(outcomes:list) -> str:
+    '''Return a plain text summary of run_table_jobs() outcomes, slowest first'''
+    lines = [f'{"status":<10} {"seconds":>9}  {"operation":<20} table']
+    for outcome in sorted(outcomes, key=lambda o: o['seconds'], reverse=True):
+        lines.append(f'{outcome["status"]:<10} {outcome["seconds"]:>9.3f}  {outcome["operation"]:<20} '
+                     f'{outcome["table_schema"]}.{outcome["table_name"]}')
+        if outcome['error']:
+            lines.append(f'{"":<10} {outcome["error"]}')
+    failed = sum(outcome['status'] == 'failed' for outcome in outcomes)
+    total = sum(outcome['seconds'] for outcome in outcomes)
+    lines.append(f'{len(outcomes) - failed:,} succeeded, {failed:,} failed, '
+                 f'{total:,.1f} seconds of table work')
+    return '\n'.join(lines)
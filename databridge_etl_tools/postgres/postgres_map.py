@@ -25,3 +25,12 @@ GEOM_TYPE_MAP = {
     'multilinestring': 'MultiLineString',
     'geometry':        'Geometry',
 }
+
+# Shape types that are promoted to MULTI when loading. Multis are included because 
+# this is compared against the destination table's geometry type, which will 
+# probably be multi; each row is only transformed if it is not already MULTI.
+MULTI_GEOM_TYPES = [
+    'POLYGON', 'POLYGON Z', 'POLYGON M', 'POLYGON MZ', 
+    'LINESTRING', 'LINESTRING Z', 'LINESTRING M', 'LINESTRING MZ', 
+    'MULTIPOLYGON', 'MULTIPOLYGON Z', 'MULTIPOLYGON M', 'MULTIPOLYGON MZ', 
+    'MULTILINESTRING', 'MULTILINESTRING Z', 'MULTILINESTRING M', 'MULTILINESTRING MZ']
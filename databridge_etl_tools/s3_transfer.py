@@ -0,0 +1,295 @@
+'''
+Shared S3 upload and download helpers. All transfers use multipart and parallel
+parts above a configurable size, and check the object's ETag against the local
+data afterwards. Tune them with environment variables:
+    - DBTOOLS_S3_PART_SIZE_MB: multipart threshold and part size (default 16)
+    - DBTOOLS_S3_MAX_CONCURRENCY: parts transferred at once (default 10)
+
+Staging objects may be gzip or zstd compressed, detected from the key suffix
+(e.g. "staging/schema/table.csv.gz") or else the object's ContentEncoding.
+Compressed files are kept compressed on local disk and decompressed as they are
+read, see `read_source()`.
+'''
+import os
+import gzip
+import zlib
+import shutil
+from contextlib import contextmanager
+import hashlib
+import logging
+from . import metrics
+
+MB = 1024 * 1024
+COMPRESSIONS = ('gzip', 'zstd')
+COMPRESSION_SUFFIXES = {'.gz': 'gzip', '.gzip': 'gzip', '.zst': 'zstd', '.zstd': 'zstd'}
+# Leading bytes of a gzip member and of a zstd frame
+COMPRESSION_MAGIC = {b'\x1f\x8b': 'gzip', b'\x28\xb5\x2f\xfd': 'zstd'}
+
+logger = logging.getLogger(__name__)
+
+
+def _s3_resource():
+    # boto3 takes a noticeable part of a second to import, so it's only imported
+    # once a command actually transfers something
+    import boto3
+    return boto3.resource('s3')
+
+def transfer_config() -> 'TransferConfig':
+    from boto3.s3.transfer import TransferConfig
+    part_size = int(os.environ.get('DBTOOLS_S3_PART_SIZE_MB', 16)) * MB
+    return TransferConfig(
+        multipart_threshold=part_size,
+        multipart_chunksize=part_size,
+        max_concurrency=int(os.environ.get('DBTOOLS_S3_MAX_CONCURRENCY', 10)),
+        use_threads=True)
+
+
+def _zstandard():
+    try:
+        import zstandard
+    except ImportError:
+        raise ImportError('zstd compression requires the zstandard package, install databridge-etl-tools[zstd]')
+    return zstandard
+
+
+def compression_for(key:str, content_encoding:str=None):
+    '''Return the compression of an S3 object, one of COMPRESSIONS or None, from
+    its key suffix or else its ContentEncoding'''
+    compression = COMPRESSION_SUFFIXES.get(os.path.splitext(key)[1].lower())
+    if compression is None and content_encoding:
+        compression = {'gzip': 'gzip', 'x-gzip': 'gzip', 'zstd': 'zstd'}.get(content_encoding.lower())
+    return compression
+
+def strip_compression_suffix(key:str) -> str:
+    '''"staging/schema/table.csv.gz" -> "staging/schema/table.csv"'''
+    root, ext = os.path.splitext(key)
+    return root if ext.lower() in COMPRESSION_SUFFIXES else key
+
+def file_compression(path:str):
+    '''Return the compression of a local file from its leading bytes, or None'''
+    with open(path, 'rb') as f:
+        head = f.read(4)
+    for magic, compression in COMPRESSION_MAGIC.items():
+        if head.startswith(magic):
+            return compression
+    return None
+
+
+class Etag_Hasher():
+    '''
+    Compute the ETag S3 gives an object uploaded with the given part size: the MD5
+    of the data for a single PUT, or for a multipart upload the MD5 of the
+    concatenated MD5s of the parts followed by "-<number of parts>". Objects
+    encrypted with SSE-KMS have ETags that are not MD5s and can't be checked.
+    '''
+    def __init__(self, part_size:int, multipart_threshold:int=None):
+        self.part_size = part_size
+        self.multipart_threshold = part_size if multipart_threshold is None else multipart_threshold
+        self.size = 0
+        self._whole = hashlib.md5()
+        self._part = hashlib.md5()
+        self._part_size = 0
+        self._part_digests = []
+
+    def update(self, data:bytes):
+        self.size += len(data)
+        self._whole.update(data)
+        view = memoryview(data)
+        while view:
+            take = view[:self.part_size - self._part_size]
+            self._part.update(take)
+            self._part_size += len(take)
+            view = view[len(take):]
+            if self._part_size == self.part_size:
+                self._part_digests.append(self._part.digest())
+                self._part = hashlib.md5()
+                self._part_size = 0
+
+    def etag(self) -> str:
+        if self.size < self.multipart_threshold:
+            return self._whole.hexdigest()
+        digests = self._part_digests + ([self._part.digest()] if self._part_size else [])
+        return f'{hashlib.md5(b"".join(digests)).hexdigest()}-{len(digests)}'
+
+
+def file_etag(path:str, part_size:int, multipart_threshold:int=None) -> str:
+    hasher = Etag_Hasher(part_size, multipart_threshold)
+    with open(path, 'rb') as f:
+        for block in iter(lambda: f.read(MB), b''):
+            hasher.update(block)
+    return hasher.etag()
+
+
+class Compressing_Reader():
+    '''Readable file-like object that returns the contents of fileobj compressed
+    with gzip or zstd, optionally feeding the compressed bytes to an Etag_Hasher'''
+    def __init__(self, fileobj, compression:str, hasher:'Etag_Hasher'=None):
+        if compression == 'gzip':
+            self._compressor = zlib.compressobj(6, zlib.DEFLATED, 31) # 31: gzip header and trailer
+        elif compression == 'zstd':
+            self._compressor = _zstandard().ZstdCompressor().compressobj()
+        else:
+            raise ValueError(f'Compression {compression} not recognized, expected one of {", ".join(COMPRESSIONS)}')
+        self._file = fileobj
+        self._hasher = hasher
+        self._buffer = b''
+        self._eof = False
+
+    def read(self, size:int=-1) -> bytes:
+        while not self._eof and (size < 0 or len(self._buffer) < size):
+            block = self._file.read(MB)
+            if block:
+                self._buffer += self._compressor.compress(block)
+            else:
+                self._buffer += self._compressor.flush()
+                self._eof = True
+        if size < 0:
+            data, self._buffer = self._buffer, b''
+        else:
+            data, self._buffer = self._buffer[:size], self._buffer[size:]
+        if self._hasher is not None:
+            self._hasher.update(data)
+        return data
+
+
+def open_decompressed(fileobj, compression:str):
+    '''Return a readable binary file-like object over the decompressed contents of
+    fileobj, which is read sequentially so it may be a non-seekable S3 body.
+    Concatenated gzip members and zstd frames are read through.'''
+    if compression is None:
+        return fileobj
+    if compression == 'gzip':
+        return gzip.GzipFile(fileobj=fileobj, mode='rb')
+    if compression == 'zstd':
+        return _zstandard().ZstdDecompressor().stream_reader(fileobj, read_across_frames=True)
+    raise ValueError(f'Compression {compression} not recognized, expected one of {", ".join(COMPRESSIONS)}')
+
+
+class Decompressing_Source():
+    '''petl read source for a compressed local file, e.g.
+    `etl.fromcsv(Decompressing_Source(path, 'zstd'))`, that decompresses it as it
+    is read instead of inflating it on disk first'''
+    def __init__(self, filename:str, compression:str):
+        self.filename = filename
+        self.compression = compression
+
+    @contextmanager
+    def open(self, mode='rb'):
+        if not mode.startswith('r'):
+            raise ValueError(f'{self.filename} is a compressed file and can only be read')
+        with open(self.filename, 'rb') as f:
+            reader = open_decompressed(f, self.compression)
+            try:
+                yield reader
+            finally:
+                reader.close()
+
+def decompress_file(path:str):
+    '''Decompress a gzip or zstd compressed local file in place, for the few
+    consumers that need a plain file on disk. Return its compression, or None if
+    it was not compressed.'''
+    compression = file_compression(path)
+    if compression is not None:
+        temp_path = path + '.inflate'
+        with open(path, 'rb') as f, open(temp_path, 'wb') as out:
+            with open_decompressed(f, compression) as reader:
+                shutil.copyfileobj(reader, out, MB)
+        os.replace(temp_path, path)
+    return compression
+
+def read_source(path:str):
+    '''Return what petl should read the local file at path from: the path itself,
+    or a Decompressing_Source if the file is gzip or zstd compressed'''
+    compression = file_compression(path)
+    return path if compression is None else Decompressing_Source(path, compression)
+
+
+def _verify(s3_object, expected_etag:str):
+    '''Compare an object's ETag with the one computed locally, raising AssertionError
+    if they differ'''
+    if s3_object.server_side_encryption == 'aws:kms':
+        logger.info(f's3://{s3_object.bucket_name}/{s3_object.key} is KMS encrypted, skipping ETag check.')
+        return
+    etag = s3_object.e_tag.strip('"')
+    assert etag == expected_etag, \
+        f'Checksum mismatch for s3://{s3_object.bucket_name}/{s3_object.key}: S3 ETag {etag}, local {expected_etag}'
+
+def upload_file(path:str, bucket:str, key:str, compression:str=None, verify:bool=True,
+                extra_args:dict=None):
+    '''
+    Upload a local file to s3://bucket/key with multipart and parallel parts above
+    the configured part size. If compression is "gzip" or "zstd", the file is
+    compressed as it is read and the object's ContentEncoding is set to match;
+    nothing extra is written to disk. Pass `compression=compression_for(key)` to
+    compress according to the key's suffix. If verify, the object's ETag is
+    checked against the uploaded bytes.
+    '''
+    config = transfer_config()
+    s3_object = _s3_resource().Object(bucket, key)
+    extra_args = dict(extra_args or {})
+    # bytes are as stored in S3, i.e. after compression
+    with metrics.span('upload') as span:
+        if compression is None:
+            s3_object.upload_file(path, ExtraArgs=extra_args or None, Config=config)
+            span.bytes = os.path.getsize(path)
+        else:
+            extra_args['ContentEncoding'] = compression
+            hasher = Etag_Hasher(config.multipart_chunksize, config.multipart_threshold)
+            with open(path, 'rb') as f:
+                s3_object.upload_fileobj(Compressing_Reader(f, compression, hasher),
+                                         ExtraArgs=extra_args, Config=config)
+            span.bytes = hasher.size
+            expected_etag = hasher.etag()
+    if verify:
+        if compression is None:
+            from s3transfer.utils import ChunksizeAdjuster
+            part_size = ChunksizeAdjuster().adjust_chunksize(config.multipart_chunksize, span.bytes)
+            expected_etag = file_etag(path, part_size, config.multipart_threshold)
+        s3_object.reload()
+        _verify(s3_object, expected_etag)
+
+def download_file(bucket:str, key:str, path:str, verify:bool=True):
+    '''
+    Download s3://bucket/key to a local file using parallel ranged GETs above the
+    configured part size. Compressed objects are downloaded as they are. If
+    verify, the local file is hashed the way the object was uploaded (the part
+    size of a multipart object is read from its first part) and checked against
+    the object's ETag. Return the object's compression, see `compression_for()`.
+    '''
+    s3_object = _s3_resource().Object(bucket, key)
+    with metrics.span('download') as span:
+        s3_object.download_file(path, Config=transfer_config())
+        span.bytes = os.path.getsize(path)
+    if verify:
+        etag = s3_object.e_tag.strip('"')
+        if '-' in etag:
+            part_size = s3_object.meta.client.head_object(
+                Bucket=bucket, Key=key, PartNumber=1)['ContentLength']
+            expected_etag = file_etag(path, part_size, multipart_threshold=0)
+        else:
+            expected_etag = file_etag(path, MB, multipart_threshold=float('inf'))
+        _verify(s3_object, expected_etag)
+    return compression_for(key, s3_object.content_encoding)
+
+def open_object(bucket:str, key:str):
+    '''Return a readable binary file-like object streaming the decompressed
+    contents of s3://bucket/key, without downloading it'''
+    response = _s3_resource().Object(bucket, key).get()
+    return open_decompressed(response['Body'], compression_for(key, response.get('ContentEncoding')))
+
+def head_object(bucket:str, key:str) -> dict:
+    '''Return the size in bytes, ETag and compression (see `compression_for()`) of
+    s3://bucket/key'''
+    s3_object = _s3_resource().Object(bucket, key)
+    s3_object.load()
+    return {'size': s3_object.content_length, 'etag': s3_object.e_tag.strip('"'),
+            'compression': compression_for(key, s3_object.content_encoding)}
+
+def open_range(bucket:str, key:str, start:int=0, etag:str=None):
+    '''Return a readable binary file-like object streaming s3://bucket/key as it is
+    stored (not decompressed) from byte offset start to the end, with a ranged GET.
+    If etag is given, the GET fails if the object no longer has that ETag.'''
+    kwargs = {'Range': f'bytes={start}-'}
+    if etag is not None:
+        kwargs['IfMatch'] = etag
+    return _s3_resource().Object(bucket, key).get(**kwargs)['Body']
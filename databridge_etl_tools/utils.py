@@ -1,3 +1,7 @@
+import io
+import os
+import shutil
+from contextlib import contextmanager
 import click
 
 def pass_params_to_ctx(context: 'click.Context', **kwargs): 
@@ -5,3 +9,88 @@ def pass_params_to_ctx(context: 'click.Context', **kwargs):
     for param, value in kwargs.items(): 
         context.obj[param] = value
     return context
+
+# Block size for scanning and filtering whole files as bytes
+SCRUB_CHUNK_SIZE = 8 * 1024 * 1024
+
+def file_contains(path:str, patterns:list, chunk_size:int=SCRUB_CHUNK_SIZE) -> bool: 
+    '''Return True if any of the byte strings in patterns occurs anywhere in the 
+    file at path, reading it in large binary blocks'''
+    overlap = max(len(p) for p in patterns) - 1
+    tail = b''
+    with open(path, 'rb') as f: 
+        while True: 
+            chunk = f.read(chunk_size)
+            if not chunk: 
+                return False
+            # Prepend the end of the previous block in case a pattern spans both
+            block = tail + chunk
+            if any(p in block for p in patterns): 
+                return True
+            tail = block[-overlap:] if overlap else b''
+
+class Byte_Filter_Writer(io.RawIOBase): 
+    '''
+    Writable binary file-like object that removes every occurrence of the byte 
+    strings in patterns before writing to file_obj. The last few bytes of each 
+    write are held back until the next one (or close()) so that patterns split 
+    across writes are still removed. Closing this also closes file_obj.
+    '''
+    def __init__(self, file_obj, patterns:list): 
+        self._file = file_obj
+        self.patterns = patterns
+        self._overlap = max(len(p) for p in patterns) - 1
+        self._tail = b''
+        self.removed = 0
+
+    def writable(self): 
+        return True
+
+    def write(self, b): 
+        block = self._tail + bytes(b)
+        size = len(block)
+        for p in self.patterns: 
+            block = block.replace(p, b'')
+        self.removed += size - len(block)
+        if self._overlap: 
+            self._tail = block[-self._overlap:]
+            block = block[:-self._overlap]
+        self._file.write(block)
+        return len(b)
+
+    def flush(self): 
+        self._file.flush()
+
+    def close(self): 
+        if not self.closed: 
+            super().close()
+            self._file.write(self._tail)
+            self._tail = b''
+            self._file.close()
+
+class Byte_Filter_Source(): 
+    '''petl write source for a local file that removes the byte strings in patterns 
+    as it is written, e.g. `etl.tocsv(rows, Byte_Filter_Source(path, [b'\\0']))`, so 
+    that the file doesn't need to be scrubbed and rewritten afterwards'''
+    def __init__(self, filename:str, patterns:list): 
+        self.filename = filename
+        self.patterns = patterns
+
+    @contextmanager
+    def open(self, mode='wb'): 
+        writer = Byte_Filter_Writer(open(self.filename, mode), self.patterns)
+        try: 
+            yield writer
+        finally: 
+            writer.close()
+
+def remove_bytes(path:str, patterns:list, chunk_size:int=SCRUB_CHUNK_SIZE) -> int: 
+    '''Remove every occurrence of the byte strings in patterns from the file at path 
+    with a streaming binary copy, without parsing it. Return the number of bytes removed.'''
+    temp_path = path + '.scrub'
+    with open(path, 'rb') as infile: 
+        writer = Byte_Filter_Writer(open(temp_path, 'wb'), patterns)
+        with writer: 
+            shutil.copyfileobj(infile, writer, chunk_size)
+    os.replace(temp_path, path)
+    return writer.removed
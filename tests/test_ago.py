@@ -2,6 +2,7 @@ import pytest
 
 from .constants import S3_BUCKET
 from databridge_etl_tools.ago.ago import AGO
+from databridge_etl_tools.ago.batches import Batch_Pipeline
 
 @pytest.fixture
 def ago_point(ago_user, ago_password):
@@ -21,6 +22,51 @@ def test_ago_point_truncate_append(ago_point):
     ago_point.append(truncate=True)
     ago_point.verify_count()
 
+def test_ago_point_truncate_append_concurrent(ago_point):
+    ago_point.batch_size = 50
+    ago_point.concurrent_batches = 4
+    ago_point.get_csv_from_s3()
+    ago_point.append(truncate=True)
+    ago_point.verify_count()
+
+def test_batch_pipeline():
+    import threading, time
+    sent, in_flight, most = [], [], []
+    lock = threading.Lock()
+    def send(rows, method='adds'):
+        with lock:
+            in_flight.append(rows)
+            most.append(len(in_flight))
+        time.sleep(0.01)
+        with lock:
+            in_flight.remove(rows)
+            sent.append(rows)
+    batches = Batch_Pipeline(send, concurrent=3)
+    for i in range(20):
+        batches.submit(rows=[i], method='adds')
+    batches.close()
+    assert sorted(sent) == [[i] for i in range(20)]
+    assert max(most) <= 3
+
+    def fail(rows):
+        raise ValueError('bad batch')
+    batches = Batch_Pipeline(fail, concurrent=2)
+    with pytest.raises(ValueError):
+        for i in range(10):
+            batches.submit(rows=[i])
+        batches.close()
+
+    # A failure formatting rows waits for the batches in flight, and sends no more
+    sent.clear()
+    with pytest.raises(KeyError):
+        with Batch_Pipeline(send, concurrent=3) as batches:
+            for i in range(20):
+                if i == 5:
+                    raise KeyError('shape')
+                batches.submit(rows=[i], method='adds')
+    assert sorted(sent) == [[i] for i in range(5)]
+    assert batches._executor._shutdown
+
 
 @pytest.fixture
 def ago_multipolygon(ago_user, ago_password):
@@ -40,3 +86,178 @@ def test_ago_multipolygon_truncate_append(ago_multipolygon):
     ago_multipolygon.append(truncate=True)
     ago_multipolygon.verify_count()
 
+
+def test_ago_primary_key_objectids():
+    from types import SimpleNamespace
+    class Properties(dict):
+        __getattr__ = dict.__getitem__
+    features = [{'PARCEL_ID': pk, 'OBJECTID': oid} for oid, pk in
+                enumerate([101, 102.0, ' 103', 102, 104], start=1)]
+    queries = []
+    class Layer():
+        properties = Properties(objectIdField='OBJECTID', maxRecordCount=2)
+        def query(self, where, result_offset, result_record_count, **kwargs):
+            queries.append(result_offset)
+            page = features[result_offset:result_offset + result_record_count]
+            return SimpleNamespace(features=[SimpleNamespace(attributes=f) for f in page])
+    ago = AGO(ago_org_url='https://localhost', ago_user='test', ago_pw='test', ago_item_name='test',
+              s3_bucket=None, s3_key=None, primary_key='parcel_id')
+    ago._layer_object = Layer()
+    pk_objectids = ago.primary_key_objectids()
+    assert queries == [0, 2, 4]
+    assert pk_objectids == {'101': [1], '102': [2, 4], '103': [3], '104': [5]}
+    assert ago.upsert_objectid('101', pk_objectids, 1) == 1
+    assert ago.upsert_objectid(105, pk_objectids, 1) is False
+
+def test_ago_sync(tmp_path):
+    from types import SimpleNamespace
+    class Properties(dict):
+        __getattr__ = dict.__getitem__
+    ago_features = [{'OBJECTID': 1, 'ID': 1, 'NAME': 'same', 'UPDATED': 1577836800000},
+                    {'OBJECTID': 2, 'ID': 2, 'NAME': 'old', 'UPDATED': None},
+                    {'OBJECTID': 3, 'ID': 3, 'NAME': 'gone', 'UPDATED': None},
+                    {'OBJECTID': 4, 'ID': 1, 'NAME': 'duplicate', 'UPDATED': None}]
+    edits = []
+    class Layer():
+        properties = Properties(objectIdField='OBJECTID', maxRecordCount=1000)
+        def query(self, where, result_offset, result_record_count, **kwargs):
+            page = ago_features[result_offset:result_offset + result_record_count]
+            return SimpleNamespace(features=[SimpleNamespace(attributes=f) for f in page])
+        def edit_features(self, **kwargs):
+            edits.append(kwargs)
+            return {'addResults': []}
+    csv_path = tmp_path / 'sync.csv'
+    csv_path.write_text('objectid,id,name,updated\n'
+                        '1,1,same,2020-01-01 00:00:00\n'
+                        '2,2,new,\n'
+                        '5,5,added,\n')
+    ago = AGO(ago_org_url='https://localhost', ago_user='test', ago_pw='test', ago_item_name='test',
+              s3_bucket=None, s3_key=None, primary_key='id')
+    ago.csv_path = str(csv_path)
+    ago._layer_object = Layer()
+    ago._geometric = False
+    ago._item_fields = {'objectid': 'esrifieldtypeoid', 'id': 'esrifieldtypeinteger',
+                        'name': 'esrifieldtypestring', 'updated': 'esrifieldtypedate'}
+    ago.sync()
+    methods = {edit_method: rows for edit in edits for edit_method, rows in edit.items() 
+               if edit_method != 'rollback_on_failure'}
+    assert [row['attributes']['name'] for row in methods['adds']] == ['added']
+    assert [(row['attributes']['objectid'], row['attributes']['name']) for row in methods['updates']] == [(2, 'new')]
+    assert methods['deletes'] == '4,3'
+
+    # A duplicated key is found before anything is sent, even at the end of the CSV
+    edits.clear()
+    ago.batch_size = 1
+    csv_path.write_text('objectid,id,name,updated\n'
+                        '1,1,changed,\n'
+                        '5,5,added,\n'
+                        '6,5,duplicate,\n')
+    with pytest.raises(AssertionError, match='more than once'):
+        ago.sync()
+    assert edits == []
+
+def test_ago_project_and_format_shapes():
+    ago = AGO(ago_org_url='https://localhost', ago_user='test', ago_pw='test', ago_item_name='test',
+              s3_bucket=None, s3_key=None, in_srid=2272)
+    ago._ago_srid = (102100, 3857)
+    ago._geometric = 'esriGeometryPolygon'
+    wkt_shapes = ['POINT (2694000 235000)',
+                  'LINESTRING (2694000 235000, 2694100 235100, 2694200 235000)',
+                  'POLYGON ((2694000 235000, 2694100 235000, 2694100 235100, 2694000 235000), '
+                  '(2694010 235010, 2694050 235010, 2694050 235050, 2694010 235010))',
+                  'MULTIPOLYGON (((2694000 235000, 2694100 235000, 2694100 235100, 2694000 235000)), '
+                  '((2695000 236000, 2695100 236000, 2695100 236100, 2695000 236000)))']
+    assert ago.project_and_format_shapes(wkt_shapes) == [ago.project_and_format_shape(wkt) for wkt in wkt_shapes]
+    with pytest.raises(NotImplementedError):
+        ago.project_and_format_shapes(['MULTIPOINT ((2694000 235000), (2694100 235100))'])
+
+def test_geometry_encoder():
+    import numpy as np
+    from databridge_etl_tools.ago.geometry import Geometry_Encoder, resolution_decimals
+    encoder = Geometry_Encoder('esriGeometryPolygon', 102100, 3857)
+    ring = [[0.0, 0.0], [1.0, 0.0], [1.0, 1.0], [0.0, 0.0]]
+    polygon = encoder.encode('POLYGON ((0 0, 1 0, 1 1, 0 0))', ring)
+    multipolygon = encoder.encode('MULTIPOLYGON (((0 0, 1 0, 1 1, 0 0)))', [ring])
+    assert polygon['rings'] == multipolygon['rings'] == [ring]
+    assert polygon['spatial_reference'] is multipolygon['spatial_reference'] is encoder.empty()['spatial_reference']
+    assert encoder.encode('POLYGON EMPTY', None) == {'rings': [], 'spatial_reference': {'wkid': 102100, 'latestWkid': 3857}}
+    assert resolution_decimals(0.001) == 4
+    coords = np.array([[0.123456, 0.0], [1.0, 0.0004], [2.0, 0.0], [3.0, 0.0], [9.87654, 1.0]])
+    assert Geometry_Encoder('esriGeometryPolyline', 102100, 3857, precision=2).compact_parts(coords, [3, 2]) == \
+        [[[0.12, 0.0], [1.0, 0.0], [2.0, 0.0]], [[3.0, 0.0], [9.88, 1.0]]]
+    generalized = Geometry_Encoder('esriGeometryPolyline', 102100, 3857, generalize=0.01).compact_parts(coords, [3, 2])
+    assert generalized == [[[0.123456, 0.0], [2.0, 0.0]], [[3.0, 0.0], [9.87654, 1.0]]]
+    # Rings that would collapse are kept as they are
+    sliver = np.array([[0.0, 0.0], [1.0, 0.001], [2.0, 0.0], [0.0, 0.0]])
+    assert Geometry_Encoder('esriGeometryPolygon', 102100, 3857, generalize=1).compact_parts(sliver, [4]) == [sliver.tolist()]
+
+def test_ago_write_errors_to_s3(monkeypatch):
+    import sys
+    from databridge_etl_tools import s3_transfer
+    uploads = []
+    def upload_file(path, bucket, key):
+        with open(path) as f:
+            uploads.append((key, f.read()))
+    monkeypatch.setattr(s3_transfer, 'upload_file', upload_file)
+    monkeypatch.setattr(sys.modules[AGO.__module__], 'time', lambda: 1700000000)
+    ago = AGO(ago_org_url='https://localhost', ago_user='test', ago_pw='test', ago_item_name='test',
+              s3_bucket='bucket', s3_key='staging/test/table.csv')
+    # Two batches failing in the same second
+    ago.write_errors_to_s3([{'attributes': {'id': 1}}])
+    ago.write_errors_to_s3([{'attributes': {'id': 2}}])
+    assert len({key for key, _ in uploads}) == 2
+    assert [contents for _, contents in uploads] == ["{'attributes': {'id': 1}}", "{'attributes': {'id': 2}}"]
+
+def test_ago_error_rows_counted_per_batch(monkeypatch):
+    from databridge_etl_tools import s3_transfer
+    monkeypatch.setattr(s3_transfer, 'upload_file', lambda path, bucket, key: None)
+    class Layer():
+        def edit_features(self, **kwargs):
+            # Three rows of the batch too long for their fields
+            return {'addResults': [{'error': {'code': 1019}}] * 3 + [{'success': True}] * 2}
+    ago = AGO(ago_org_url='https://localhost', ago_user='test', ago_pw='test', ago_item_name='test',
+              s3_bucket='bucket', s3_key='staging/test/table.csv')
+    ago._layer_object = Layer()
+    ago.edit_features([{'attributes': {'id': i}} for i in range(5)], row_count=5)
+    assert sum(ago._error_batches.values()) == 5
+    ago._unchecked_batches = 1
+    with pytest.raises(AssertionError):
+        ago.check_unchecked_batches(ago_count=90, expected_count=100)
+    ago.check_unchecked_batches(ago_count=95, expected_count=100)
+
+def test_ago_normalize_geometry():
+    from types import SimpleNamespace
+    def local_ago(wkid, xy_tolerance=None, **kwargs):
+        ago = AGO(ago_org_url='https://localhost', ago_user='test', ago_pw='test', ago_item_name='test',
+                  s3_bucket=None, s3_key=None, **kwargs)
+        ago._ago_srid = (wkid, wkid)
+        ago._geometric = 'esriGeometryPoint'
+        spatial_reference = {'wkid': wkid, 'latestWkid': wkid}
+        if xy_tolerance:
+            spatial_reference['xyTolerance'] = xy_tolerance
+        ago._layer_object = SimpleNamespace(container=SimpleNamespace(
+            properties=SimpleNamespace(initialExtent=SimpleNamespace(spatialReference=spatial_reference))))
+        return ago
+    # 0.0005 degrees is about 50 meters, a move that sync() must not miss
+    geographic = local_ago(4326)
+    assert geographic.geometry_decimals == 9
+    assert geographic.normalize_geometry({'x': -75.1635, 'y': 39.9526}) != \
+        geographic.normalize_geometry({'x': -75.1640, 'y': 39.9526})
+    assert local_ago(2272).geometry_decimals == 4
+    assert local_ago(3857, xy_tolerance=0.001).geometry_decimals == 4
+    assert local_ago(3857, coordinate_precision='2').geometry_decimals == 2
+
+def test_ago_apply_edits_rows(monkeypatch):
+    from databridge_etl_tools import metrics
+    recorder = metrics.Recorder()
+    monkeypatch.setattr(metrics, 'recorder', recorder)
+    class Layer():
+        def edit_features(self, **kwargs):
+            return {'deleteResults': []}
+    ago = AGO(ago_org_url='https://localhost', ago_user='test', ago_pw='test', ago_item_name='test',
+              s3_bucket=None, s3_key=None)
+    ago._layer_object = Layer()
+    ago.apply_edits('101,102,1003', method='deletes')
+    ago.apply_edits([{'attributes': {'id': 1}}], method='adds')
+    rows = {entry['labels']['method']: entry['rows'] for entry in recorder.stages()}
+    assert rows == {'deletes': 3, 'adds': 1}
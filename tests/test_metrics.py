@@ -0,0 +1,58 @@
+import json
+import pytest
+from databridge_etl_tools import metrics
+
+
+@pytest.fixture
+def recorder(monkeypatch):
+    recorder = metrics.Recorder()
+    recorder.command = 'postgres load'
+    monkeypatch.setattr(metrics, 'recorder', recorder)
+    monkeypatch.setattr(metrics, '_outputs', dict(metrics._outputs))
+    return recorder
+
+def test_span_totals(recorder):
+    metrics.set_labels(table='citygeo.table_a')
+    with metrics.span('copy', rows=100, bytes=2048) as span:
+        span.rows += 50
+    for _ in range(3):
+        with metrics.span('project', rows=1, log=False):
+            pass
+    with pytest.raises(ValueError):
+        with metrics.span('upsert'):
+            raise ValueError('failed')
+    with metrics.labels(table='citygeo.table_b'):
+        with metrics.span('copy', rows=10):
+            pass
+
+    stages = {(entry['stage'], entry['labels']['table']): entry for entry in recorder.stages()}
+    assert stages['copy', 'citygeo.table_a']['rows'] == 150
+    assert stages['copy', 'citygeo.table_a']['bytes'] == 2048
+    assert stages['copy', 'citygeo.table_a']['rows_per_second'] > 0
+    assert stages['copy', 'citygeo.table_b']['rows'] == 10
+    assert stages['project', 'citygeo.table_a']['count'] == 3
+    assert stages['upsert', 'citygeo.table_a']['errors'] == 1
+    assert stages['upsert', 'citygeo.table_a']['rows'] is None
+
+def test_flush_outputs(recorder, tmp_path):
+    metrics.set_labels(table='citygeo.table_a')
+    with metrics.span('download', bytes=1024):
+        pass
+
+    json_path = tmp_path / 'metrics.jsonl'
+    metrics.configure(str(json_path), 'json')
+    metrics.flush()
+    metrics.flush()
+    runs = [json.loads(line) for line in json_path.read_text().splitlines()]
+    assert len(runs) == 2
+    assert runs[0]['command'] == 'postgres load'
+    assert runs[0]['status'] == 'succeeded'
+    assert runs[0]['stages'][0]['stage'] == 'download'
+
+    prom_path = tmp_path / 'metrics.prom'
+    metrics.configure(str(prom_path), 'prometheus')
+    metrics.flush()
+    assert ('dbtools_stage_bytes{command="postgres load",stage="download",table="citygeo.table_a"} 1024'
+            in prom_path.read_text().splitlines())
+
+    assert 'dbtools.postgres_load.citygeo_table_a.download.bytes:1024|c' in metrics.to_statsd()
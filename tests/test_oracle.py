@@ -35,4 +35,13 @@ def test_oracle_extract_and_assert_one_db_call_multipolygon_table(oracle_multipo
     oracle_multipolygon.extract()
     assert oracle_multipolygon.times_db_called == 1
 
+def test_oracle_load_json_schema_to_s3_fresh_process(conn_string):
+    # In a process where nothing else has imported geopetl, as for `oracle extract_json_schema`
+    import sys, subprocess
+    script = ('import sys\n'
+              'from databridge_etl_tools.oracle.oracle import Oracle\n'
+              'Oracle(connection_string=sys.argv[1], table_name="point_table_2272", table_schema="gis_test", '
+              f's3_bucket="{S3_BUCKET}", s3_key="staging/test/point_table_2272.csv").load_json_schema_to_s3()')
+    subprocess.run([sys.executable, '-c', script, conn_string], check=True)
+
 # More tests are needed
@@ -0,0 +1,15 @@
+import sys
+import subprocess
+
+
+def test_lazy_module_exports():
+    # In a fresh process, so that no command module has been imported yet
+    script = ('import sys\n'
+              'import databridge_etl_tools\n'
+              'assert "databridge_etl_tools.postgres.postgres" not in sys.modules\n'
+              'import databridge_etl_tools.carto.carto_commands\n'
+              'from databridge_etl_tools import carto, postgres\n'
+              'assert carto.__name__ == "databridge_etl_tools.carto.carto_"\n'
+              'assert postgres.__name__ == "databridge_etl_tools.postgres.postgres"\n'
+              'assert databridge_etl_tools.carto is carto\n')
+    subprocess.run([sys.executable, '-c', script], check=True)
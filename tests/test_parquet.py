@@ -0,0 +1,43 @@
+import datetime
+import pytz
+import petl as etl
+from shapely import wkb
+from databridge_etl_tools import parquet
+
+FIELDS = [('objectid', 'int32'), ('textfield', 'string'), ('numericfield', 'string'), 
+          ('timestampfield', 'timestamp_eastern'), ('shape', 'geometry')]
+
+
+def write_polygons(path, rows:int=10): 
+    eastern = pytz.timezone('US/Eastern')
+    with parquet.Parquet_Writer(path, FIELDS, geom_field='shape', geometry_format='ewkt', 
+                                json_schema={'fields': []}, batch_size=4) as writer: 
+        return writer.write_rows(
+            (i, f'row\0 {i}', 1.5, eastern.localize(datetime.datetime(2023, 1, 1, 12)), 
+             f'SRID=2272;POLYGON ((0 0, {i + 1} 0, {i + 1} 1, 0 0))' if i % 2 else '')
+            for i in range(rows))
+
+def test_parquet_round_trip(tmp_path): 
+    path = str(tmp_path / 'polygons.parquet')
+    assert write_polygons(path) == 10
+    assert parquet.is_parquet_file(path)
+    assert parquet.read_metadata(path)['srid'] == 2272
+
+    rows = parquet.Parquet_View(path, batch_size=3)
+    assert rows.nrows() == 10
+    assert list(rows.head(2)) == [
+        ('objectid', 'textfield', 'numericfield', 'timestampfield', 'shape'), 
+        # Null bytes are removed and nulls read back as '', as from a CSV
+        ('0', 'row 0', '1.5', '2023-01-01 12:00:00-05:00', ''), 
+        ('1', 'row 1', '1.5', '2023-01-01 12:00:00-05:00', 'SRID=2272;POLYGON ((0 0, 2 0, 2 1, 0 0))')]
+
+def test_parquet_hexewkb_to_multi(tmp_path): 
+    path = str(tmp_path / 'polygons.parquet')
+    write_polygons(path)
+    rows = parquet.Parquet_View(path, geometry_format='hexewkb', to_multi=True)
+    shapes = [shape for shape in etl.values(rows, 'shape') if shape]
+    assert len(shapes) == 5
+    for shape in shapes: 
+        value = bytes.fromhex(shape)
+        assert parquet.ewkb_srid(value) == 2272
+        assert wkb.loads(value).geom_type == 'MultiPolygon'
@@ -2,6 +2,8 @@ import pytest
 import os, textwrap
 import petl as etl
 from databridge_etl_tools.postgres.postgres import Postgres, Postgres_Connector
+from databridge_etl_tools.postgres.postgres_connector import Postgres_Pool
+from databridge_etl_tools.postgres.postgres_jobs import run_table_jobs, read_manifest
 from .constants import (S3_BUCKET, POINT_TABLE_2272_S3_KEY_CSV, 
                         POINT_TABLE_2272_NAME, FIXTURES_DIR, STAGING_DIR, 
                         POINT_TABLE_2272_CSV)
@@ -85,11 +87,158 @@ def test_postgres_upsert(extract_data, pg):
     upserted_data = pg.extract(return_data=True)
     assert_two_datasets_same(extract_data, upserted_data)
 
+def test_postgres_upsert_incremental(extract_data, pg):
+    counts = pg.upsert('csv', incremental=True)
+    assert counts['inserted'] == 0 and counts['updated'] == 0
+    upserted_data = pg.extract(return_data=True)
+    assert_two_datasets_same(extract_data, upserted_data)
+
+def test_postgres_upsert_chunked(extract_data, pg):
+    counts = pg.upsert('csv', incremental=True, chunk_size=100)
+    assert counts['inserted'] == 0 and counts['updated'] == 0
+    upserted_data = pg.extract(return_data=True)
+    assert_two_datasets_same(extract_data, upserted_data)
+
 def test_postgres_load(extract_data, pg):
     pg.truncate()
     pg.load()
     loaded_data = pg.extract(return_data=True)
     assert_two_datasets_same(extract_data, loaded_data)
 
+def test_postgres_load_stream(extract_data, pg):
+    pg.truncate()
+    pg.load(stream=True)
+    loaded_data = pg.extract(return_data=True)
+    assert_two_datasets_same(extract_data, loaded_data)
+
+def test_postgres_load_binary(extract_data, pg):
+    pg.truncate()
+    pg.load(binary=True)
+    loaded_data = pg.extract(return_data=True)
+    assert_two_datasets_same(extract_data, loaded_data)
+
+def test_postgres_load_resumable(extract_data, pg):
+    pg.truncate()
+    # A tiny chunk size so that the fixture CSV is committed in several chunks
+    pg.load(resumable=True, chunk_mb=0)
+    assert not pg.check_exists(pg.resume_table_name, pg.table_schema)
+    loaded_data = pg.extract(return_data=True)
+    assert_two_datasets_same(extract_data, loaded_data)
+
+def test_postgres_load_swap(extract_data, pg):
+    index_stmt = '''SELECT indexname, indexdef FROM pg_indexes 
+    WHERE schemaname = %s AND tablename = %s ORDER BY indexname'''
+    indexes = pg.execute_sql(index_stmt, data=[pg.table_schema, pg.table_name], fetch='all')
+    pg.load(swap=True)
+    assert not pg.check_exists(pg.swap_table_name, pg.table_schema)
+    # Same index names and definitions on the new table
+    assert pg.execute_sql(index_stmt, data=[pg.table_schema, pg.table_name], fetch='all') == indexes
+    loaded_data = pg.extract(return_data=True)
+    assert_two_datasets_same(extract_data, loaded_data)
+
+def test_postgres_load_defer_indexes(extract_data, pg):
+    index_stmt = '''SELECT indexname, indexdef FROM pg_indexes 
+    WHERE schemaname = %s AND tablename = %s ORDER BY indexname'''
+    indexes = pg.execute_sql(index_stmt, data=[pg.table_schema, pg.table_name], fetch='all')
+    pg.load(truncate_before_load=True, defer_indexes=True)
+    assert pg.execute_sql(index_stmt, data=[pg.table_schema, pg.table_name], fetch='all') == indexes
+    loaded_data = pg.extract(return_data=True)
+    assert_two_datasets_same(extract_data, loaded_data)
+
+def test_iter_record_blocks():
+    from databridge_etl_tools.postgres._resumable import iter_record_blocks, split_first_record
+    data = b'a,b\n1,"two\nlines"\n2,"quote "" and\nnewline"\n3,x\n'
+    for size in (1, 5, 11, 100): 
+        blocks = list(iter_record_blocks(data[i:i + size] for i in range(0, len(data), size)))
+        assert b''.join(blocks) == data
+        # Every block ends on a newline outside quotes
+        assert all(b.endswith(b'\n') and b.count(b'"') % 2 == 0 for b in blocks)
+    assert split_first_record(data) == (b'a,b\n', data[4:])
+
+def test_binary_encode_numeric():
+    from databridge_etl_tools.postgres._binary import encode_numeric
+    # ndigits, weight, sign, dscale followed by base 10000 digits
+    assert encode_numeric('12.5') == bytes.fromhex('0002 0000 0000 0001 000c 1388')
+    assert encode_numeric('-0.001') == bytes.fromhex('0001 ffff 4000 0003 000a')
+    assert encode_numeric('100000') == bytes.fromhex('0001 0001 0000 0000 000a')
+    assert encode_numeric('0.00') == bytes.fromhex('0000 0000 0000 0002')
+
+def test_binary_empty_strings_are_null():
+    import csv, struct
+    from databridge_etl_tools.postgres._binary import (ENCODERS, NULL_FIELD, 
+        COPY_BINARY_HEADER, COPY_BINARY_TRAILER, iter_binary_chunks)
+    from databridge_etl_tools.postgres._stream import iter_csv_chunks
+    header, *rows = csv.reader(['a,b', '"",x', ',y'])
+    # Binary: a quoted and an unquoted empty value are both NULL in a text column
+    encoded = b''.join(iter_binary_chunks(header, [ENCODERS['text']] * 2, rows))
+    field = lambda value: struct.pack('!i', len(value)) + value
+    assert encoded == (COPY_BINARY_HEADER 
+                       + struct.pack('!h', 2) + NULL_FIELD + field(b'x') 
+                       + struct.pack('!h', 2) + NULL_FIELD + field(b'y') 
+                       + COPY_BINARY_TRAILER)
+    # Text: the CSV is rewritten with both unquoted, which CSV COPY also loads as NULL
+    assert ''.join(iter_csv_chunks(header, rows)) == 'a,b\r\n,x\r\n,y\r\n'
+
+def test_parse_resume_after():
+    from databridge_etl_tools.postgres._upsert import parse_resume_after
+    assert parse_resume_after('[12, "a,b"]', 2) == [12, 'a,b']
+    assert parse_resume_after('Smith, John', 1) == ['Smith, John']
+    assert parse_resume_after('12', 1) == ['12']
+    with pytest.raises(ValueError):
+        parse_resume_after('12,a', 2)
+
+def test_postgres_parallel_extract(append_to_table, pg):
+    pg.extract(workers=3)
+    assert etl.nrows(etl.fromcsv(pg.csv_path)) == pg.get_row_count()
+
+def test_postgres_copy_extract(append_to_table, pg):
+    pg.extract(engine='copy')
+    assert etl.nrows(etl.fromcsv(pg.csv_path)) == pg.get_row_count()
+
+def test_eastern_timestamp(pg):
+    import pytz
+    import psycopg2.sql as sql
+    from datetime import datetime
+    from databridge_etl_tools.postgres._extract import eastern_timestamp
+    # Formatted like geopetl's extract, which writes pytz-localized datetimes
+    with pg.conn.cursor() as cursor:
+        cursor.execute("SET LOCAL TIME ZONE 'US/Eastern'")
+        for value in (datetime(2023, 1, 1, 12), datetime(2023, 7, 1, 12, 30, 0, 500)):
+            cursor.execute(sql.SQL('SELECT {}').format(eastern_timestamp(sql.Literal(value))))
+            assert cursor.fetchone()[0] == str(pytz.timezone('US/Eastern').localize(value))
+    pg.conn.rollback()
+
+def test_postgres_metadata_cache(connector, tmp_path):
+    kwargs = dict(connector=connector, table_name=POINT_TABLE_2272_NAME, 
+                  table_schema='citygeo', metadata_cache_dir=str(tmp_path))
+    first = Postgres(**kwargs)
+    assert len(os.listdir(tmp_path)) == 1
+    second = Postgres(**kwargs)
+    assert second.metadata.to_dict() == first.metadata.to_dict()
+    assert second.primary_keys == {'objectid'}
+    assert second.geom_field == 'shape'
+    assert second.fields_and_types == first.fields_and_types
+
+def test_postgres_pool_jobs(append_to_table, user, password, host, database):
+    with Postgres_Pool(f'postgresql://{user}:{password}@{host}:5432/{database}', maxconn=2) as pool: 
+        outcomes = run_table_jobs(pool, [
+            {'table_name': POINT_TABLE_2272_NAME, 'table_schema': 'citygeo', 'operation': 'extract', 
+             's3_bucket': S3_BUCKET, 's3_key': POINT_TABLE_2272_S3_KEY_CSV}, 
+            {'table_name': 'does_not_exist', 'table_schema': 'citygeo', 'operation': 'extract'}])
+    assert [outcome['status'] for outcome in outcomes] == ['succeeded', 'failed']
+
+def test_read_manifest(tmp_path):
+    manifest = tmp_path / 'tables.yml'
+    manifest.write_text(textwrap.dedent('''
+        - {table: table_a, schema: citygeo, operation: load, s3_key: staging/citygeo/table_a.csv}
+        - {table: table_b, schema: citygeo, operation: extract, s3_bucket: other, with_srid: false}
+        '''))
+    jobs = read_manifest(str(manifest), s3_bucket=S3_BUCKET, metadata_cache_dir=None)
+    assert jobs == [
+        {'s3_bucket': S3_BUCKET, 'table_name': 'table_a', 'table_schema': 'citygeo', 
+         'operation': 'load', 's3_key': 'staging/citygeo/table_a.csv'}, 
+        {'s3_bucket': 'other', 'table_name': 'table_b', 'table_schema': 'citygeo', 
+         'operation': 'extract', 'with_srid': False}]
+
 def test_postgres_json_schema_extract(pg):
     pg.load_json_schema_to_s3()
@@ -0,0 +1,71 @@
+import gzip
+import hashlib
+import pytest
+import boto3
+import petl as etl
+from moto.s3 import mock_s3
+from databridge_etl_tools import s3_transfer
+
+MB = 1024 * 1024
+
+
+@pytest.fixture
+def bucket(monkeypatch):
+    # S3's minimum part size, so that an 11MB file is uploaded in 3 parts
+    monkeypatch.setenv('DBTOOLS_S3_PART_SIZE_MB', '5')
+    with mock_s3():
+        boto3.client('s3', region_name='us-east-1').create_bucket(Bucket='test-transfer')
+        yield 'test-transfer'
+
+def test_etag_hasher():
+    data = b'x' * 25
+    single = s3_transfer.Etag_Hasher(part_size=100)
+    single.update(data)
+    assert single.etag() == hashlib.md5(data).hexdigest()
+
+    multi = s3_transfer.Etag_Hasher(part_size=10)
+    for i in range(0, 25, 7): 
+        multi.update(data[i:i + 7])
+    parts = [hashlib.md5(data[i:i + 10]).digest() for i in (0, 10, 20)]
+    assert multi.etag() == hashlib.md5(b''.join(parts)).hexdigest() + '-3'
+
+def test_multipart_round_trip(bucket, tmp_path):
+    src, dst = tmp_path / 'src.csv', tmp_path / 'dst.csv'
+    src.write_bytes(b'a,b\n' + b'1,2\n' * (11 * MB // 4))
+    s3_transfer.upload_file(str(src), bucket, 'staging/src.csv')
+    s3_transfer.download_file(bucket, 'staging/src.csv', str(dst))
+    assert dst.read_bytes() == src.read_bytes()
+
+def test_gzip_upload(bucket, tmp_path):
+    src, dst = tmp_path / 'src.csv', tmp_path / 'dst.csv.gz'
+    src.write_bytes(b'a,b\n' + b'1,2\n' * 1000)
+    s3_transfer.upload_file(str(src), bucket, 'staging/src.csv.gz', compression='gzip')
+    assert s3_transfer.download_file(bucket, 'staging/src.csv.gz', str(dst)) == 'gzip'
+    assert gzip.decompress(dst.read_bytes()) == src.read_bytes()
+
+def test_read_compressed_source(bucket, tmp_path):
+    src, dst = tmp_path / 'src.csv', tmp_path / 'dst.csv'
+    src.write_bytes(b'a,b\n' + b'1,2\n' * 1000)
+    s3_transfer.upload_file(str(src), bucket, 'staging/src.csv.gz', 
+                            compression=s3_transfer.compression_for('staging/src.csv.gz'))
+    s3_transfer.download_file(bucket, 'staging/src.csv.gz', str(dst))
+    # Kept compressed on disk, decompressed by petl as it is read
+    assert s3_transfer.file_compression(str(dst)) == 'gzip'
+    rows = etl.fromcsv(s3_transfer.read_source(str(dst)))
+    assert rows.nrows() == 1000
+    with s3_transfer.open_object(bucket, 'staging/src.csv.gz') as f: 
+        assert f.read() == src.read_bytes()
+
+def test_strip_compression_suffix():
+    assert s3_transfer.strip_compression_suffix('staging/citygeo/t.csv.gz') == 'staging/citygeo/t.csv'
+    assert s3_transfer.strip_compression_suffix('staging/citygeo/t.csv.zst') == 'staging/citygeo/t.csv'
+    assert s3_transfer.strip_compression_suffix('staging/citygeo/t.csv') == 'staging/citygeo/t.csv'
+
+def test_open_range(bucket):
+    boto3.client('s3', region_name='us-east-1').put_object(
+        Bucket=bucket, Key='staging/src.csv', Body=b'a,b\n1,2\n3,4\n')
+    s3_object = s3_transfer.head_object(bucket, 'staging/src.csv')
+    assert s3_object['size'] == 12 and s3_object['compression'] is None
+    assert s3_transfer.open_range(bucket, 'staging/src.csv', 8, s3_object['etag']).read() == b'3,4\n'
+    with pytest.raises(Exception): 
+        s3_transfer.open_range(bucket, 'staging/src.csv', 8, etag='0' * 32).read()
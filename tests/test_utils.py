@@ -0,0 +1,28 @@
+import io
+import csv
+from databridge_etl_tools import utils
+
+
+def test_remove_bytes_across_blocks(tmp_path):
+    path = str(tmp_path / 'nulls.csv')
+    data = b'a,b\n' + b'x\xc2\xa0y,\x00z\n' * 1000
+    with open(path, 'wb') as f: 
+        f.write(data)
+    patterns = [b'\0', u'\xa0'.encode('utf-8')]
+    # Small blocks so that patterns are split between them
+    assert utils.file_contains(path, patterns, chunk_size=3)
+    assert utils.remove_bytes(path, patterns, chunk_size=3) == 3000
+    with open(path, 'rb') as f: 
+        assert f.read() == b'a,b\n' + b'xy,z\n' * 1000
+    assert not utils.file_contains(path, patterns, chunk_size=3)
+
+def test_byte_filter_source(tmp_path):
+    path = str(tmp_path / 'filtered.csv')
+    # The same way petl's tocsv() writes to a source
+    with utils.Byte_Filter_Source(path, [b'\0']).open('wb') as buf: 
+        csvfile = io.TextIOWrapper(buf, encoding='utf-8', newline='')
+        csv.writer(csvfile).writerows([['a', 'b'], ['c\0', '\0d']])
+        csvfile.flush()
+        csvfile.detach()
+    with open(path, newline='') as f: 
+        assert list(csv.reader(f)) == [['a', 'b'], ['c', 'd']]